@@ -0,0 +1,50 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from learney_web.import_time import measure_startup_import_times
+
+
+class Command(BaseCommand):
+    help = (
+        "Reports the time Django processes spend importing each app and third-party package at "
+        "startup, measured with `python -X importtime`"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--top", type=int, default=20, help="Number of packages to report, slowest first"
+        )
+        parser.add_argument(
+            "--max-total-ms",
+            type=float,
+            default=None,
+            help="Fail if startup imports take longer than this in total",
+        )
+        parser.add_argument(
+            "--forbid",
+            nargs="*",
+            default=["jax", "jaxlib", "numpyro"],
+            help="Fail if any of these packages are imported at startup",
+        )
+
+    def handle(self, *args, **options):
+        times_ms = measure_startup_import_times(os.environ["DJANGO_SETTINGS_MODULE"])
+        apps = {app.split(".")[0] for app in settings.INSTALLED_APPS}
+        total_ms = sum(times_ms.values())
+        self.stdout.write(f"Startup imports take {total_ms:.0f}ms in total")
+        for package, time_ms in list(times_ms.items())[: options["top"]]:
+            kind = "app" if package in apps else ""
+            self.stdout.write(
+                f"{package:<24}{time_ms:>10.1f}ms {100 * time_ms / total_ms:>5.1f}% {kind}"
+            )
+
+        forbidden = [package for package in options["forbid"] if package in times_ms]
+        if forbidden:
+            raise CommandError(f"Packages imported at startup which shouldn't be: {forbidden}")
+        if options["max_total_ms"] is not None and total_ms > options["max_total_ms"]:
+            raise CommandError(
+                f"Startup imports take {total_ms:.0f}ms, over the limit of "
+                f"{options['max_total_ms']:.0f}ms"
+            )
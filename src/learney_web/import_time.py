@@ -0,0 +1,49 @@
+"""Measures what Django processes spend importing at startup, per app and third-party package.
+
+Runs `django.setup()` and imports the URL conf in a fresh interpreter with `python -X importtime`
+- the imports every web worker and management command (through Django's system checks) pays for.
+Report it with `python manage.py import_time_report`.
+"""
+import os
+import subprocess
+import sys
+from typing import Dict
+
+STARTUP_IMPORTS = (
+    "import importlib, django; django.setup(); from django.conf import settings; "
+    "importlib.import_module(settings.ROOT_URLCONF)"
+)
+
+
+def import_times_by_package(importtime_output: str) -> Dict[str, float]:
+    """Sums the time spent importing each top-level package's modules, from the output of
+    `python -X importtime`. Each module's own import time is counted, not time spent importing
+    other packages it imports.
+
+    Returns: milliseconds spent importing each top-level package, largest first
+    """
+    times_ms: Dict[str, float] = {}
+    for line in importtime_output.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        self_us, _, module = line[len("import time:") :].split("|")
+        if not self_us.strip().isdigit():
+            continue  # The header
+        package = module.strip().split(".")[0]
+        times_ms[package] = times_ms.get(package, 0) + int(self_us) / 1000
+    return dict(sorted(times_ms.items(), key=lambda item: item[1], reverse=True))
+
+
+def measure_startup_import_times(settings_module: str) -> Dict[str, float]:
+    """Runs the startup imports with the settings module given in a new interpreter.
+
+    Returns: see `import_times_by_package()`
+    """
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", STARTUP_IMPORTS],
+        env={**os.environ, "DJANGO_SETTINGS_MODULE": settings_module},
+        capture_output=True,
+        text=True,
+    )
+    assert process.returncode == 0, f"Startup imports failed! Error: {process.stderr[-2000:]}"
+    return import_times_by_package(process.stderr)
@@ -246,6 +246,34 @@ CACHES = {
     }
 }
 
+# Which engine infers learners' knowledge states from their answers. See `INFERENCE_ENGINES` in
+#  questions/inference.py for the options. "nuts_multichain" runs a NUTS chain on each CPU core.
+#  `manage.py compare_inference_engines` reports how far each is from NUTS on recorded batches
+INFERENCE_ENGINE = os.environ.get("INFERENCE_ENGINE", "nuts")
+# Redis URL of the queue read by inference workers (started with `manage.py run_inference_workers`)
+#  or "local" to run a worker in a thread of each web process (which, like not setting it, runs
+#  NUTS in the web processes - so they still take turns with the global MCMC mutex). If not set,
+#  inference runs in the web process itself
+INFERENCE_SERVICE_URL = os.environ.get("INFERENCE_SERVICE_URL")
+# Seconds a web worker waits for the result from an inference worker
+INFERENCE_SERVICE_TIMEOUT = 10
+# Redis URL of the pools of pre-rendered questions (refilled by `manage.py run_question_pool_workers`)
+#  or "local" to keep a pool in each web process, refilled in a thread. If not set, questions are
+#  rendered as they're selected
+QUESTION_POOL_URL = os.environ.get("QUESTION_POOL_URL")
+# If true, while a question is being answered the posterior and next question are computed for both
+#  a correct and an incorrect answer, so the answer is served from whichever matches. Not used when
+#  NUTS runs in the web process
+SPECULATIVE_SELECTION = os.environ.get("SPECULATIVE_SELECTION", "false") == "true"
+# If true, the posterior and next question's template after each likely sequence of answers are
+#  planned when a question batch starts (see questions/batch_plan.py), so answers in the plan don't
+#  run inference or question selection
+BATCH_PLANNING = os.environ.get("BATCH_PLANNING", "false") == "true"
+# Number of sandboxed worker processes each process renders question templates in (see
+#  questions/template_sandbox.py), so slow or looping <<>> expressions time out. If 0, templates are
+#  rendered in the process itself
+TEMPLATE_SANDBOX_WORKERS = int(os.environ.get("TEMPLATE_SANDBOX_WORKERS", "0"))
+
 if "RDS_DB_NAME" in os.environ:
     DATABASES = {
         "default": {
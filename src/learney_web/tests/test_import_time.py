@@ -0,0 +1,16 @@
+from learney_web.import_time import import_times_by_package
+
+IMPORTTIME_OUTPUT = """import time: self [us] | cumulative | imported package
+import time:       150 |        150 |   numpy.core._multiarray_umath
+import time:      2000 |       2150 | numpy
+import time:       300 |        300 |     questions.gaussian_params
+import time:       500 |       2950 |   questions.inference
+import time:       100 |       3050 | questions
+Some other warning printed to stderr
+"""
+
+
+def test_import_times_by_package():
+    times_ms = import_times_by_package(IMPORTTIME_OUTPUT)
+    assert times_ms == {"numpy": 2.15, "questions": 0.9}
+    assert list(times_ms) == ["numpy", "questions"]
@@ -8,8 +8,25 @@ https://docs.djangoproject.com/en/3.2/howto/deployment/wsgi/
 
 import os
 
+from django.conf import settings
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "learney_web.settings")
 
 application = get_wsgi_application()
+
+from questions.inference import (  # noqa: E402
+    MultiChainMCMCInference,
+    enable_parallel_chains,
+    get_inference_engine,
+    uses_nuts,
+    warm_up_nuts_kernels,
+)
+
+if uses_nuts(settings.INFERENCE_ENGINE) and settings.INFERENCE_SERVICE_URL in (None, "local"):
+    # Compile the NUTS kernels before serving requests, so answers never wait for compilation.
+    #  With a (non-"local") inference service, NUTS runs in the inference workers, which set up
+    #  parallel chains themselves - so this process never imports JAX
+    if get_inference_engine(settings.INFERENCE_ENGINE) is MultiChainMCMCInference:
+        enable_parallel_chains()
+    warm_up_nuts_kernels(settings.INFERENCE_ENGINE)
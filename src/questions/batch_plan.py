@@ -0,0 +1,121 @@
+"""Plans of question batches (see `batch_plan_tree`), computed in the background when the
+question batch starts and kept in the cache.
+
+When a question is answered, the node for the answers given so far is found and its posterior and
+template are used instead of running inference and question selection. Until the plan is cached,
+and once the answers leave the plan (or a planned template can't generate a question), both are
+run live.
+"""
+import threading
+import warnings
+from typing import Any, Dict, List, Optional
+
+from django.core.cache import cache
+
+from questions.batch_plan_tree import BatchPlan, compute_batch_plan
+from questions.inference import Posterior
+from questions.models.inferred_knowledge_state import InferredKnowledgeState
+from questions.question_batch_cache_manager import QuestionBatchCacheManager
+from questions.question_selection import (
+    generate_question,
+    get_template_counts_to_avoid,
+    get_template_options,
+    save_questions_asked,
+)
+from questions.template_catalog import get_template_catalog
+
+BATCH_PLAN_TIMEOUT = 1200
+
+# Answers served from a plan and answers to planned question batches which had left the plan
+BATCH_PLAN_STATS = {"hits": 0, "misses": 0}
+
+
+def batch_plan_key(question_batch_id: Any) -> str:
+    return f"batch_plan:{question_batch_id}"
+
+
+def get_batch_plan(question_batch_id: Any) -> Optional[BatchPlan]:
+    return cache.get(batch_plan_key(question_batch_id))
+
+
+def start_batch_planning(question_batch_id: Any, ks: InferredKnowledgeState) -> None:
+    threading.Thread(target=plan_in_background, args=(question_batch_id, ks), daemon=True).start()
+
+
+def plan_in_background(question_batch_id: Any, ks: InferredKnowledgeState) -> None:
+    try:
+        plan_question_batch(QuestionBatchCacheManager(question_batch_id), ks)
+    except Exception as e:
+        warnings.warn(f"Planning failed for question batch {question_batch_id}. Error: {e}")
+
+
+def plan_question_batch(
+    qb_cache_manager: QuestionBatchCacheManager,
+    ks: InferredKnowledgeState,
+) -> Optional[BatchPlan]:
+    """Plans the question batch and caches the plan, unless it's been answered or planned already.
+    The plan isn't cached if a question was answered while it was computed - it starts from no
+    answers, and questions chosen live since may not be the ones it planned.
+
+    Returns: the plan, if one was cached
+    """
+    q_batch_json = qb_cache_manager.q_batch_json
+    if q_batch_json["answers_given"] or get_batch_plan(qb_cache_manager.question_batch_id):
+        return None
+    concept_templates, prereq_templates = get_template_options(
+        qb_cache_manager, qb_cache_manager.user, ks
+    )
+    plan = compute_batch_plan(
+        qb_cache_manager.q_batch.initial_knowledge_state,
+        get_template_catalog(concept_templates, prereq_templates),
+        q_batch_json["questions"],
+        get_template_counts_to_avoid(
+            qb_cache_manager.user, qb_cache_manager.concept_id, qb_cache_manager.batch_id
+        ),
+        qb_cache_manager.max_num_questions,
+    )
+    if QuestionBatchCacheManager(qb_cache_manager.question_batch_id).q_batch_json["answers_given"]:
+        return None
+    cache.set(batch_plan_key(qb_cache_manager.question_batch_id), plan, timeout=BATCH_PLAN_TIMEOUT)
+    return plan
+
+
+def select_planned_question(
+    qb_cache_manager: QuestionBatchCacheManager,
+    plan: BatchPlan,
+    node: int,
+    ks: InferredKnowledgeState,
+    session_id: str,
+    posterior: Posterior,
+) -> List[Dict[str, Any]]:
+    """Generates the question planned at the node from its template, saves it in the DB and adds
+    it to the question batch. `posterior` is the node's posterior.
+
+    Returns: the question, or no questions if none was planned or the template can't generate one
+    """
+    template_id = plan.planned_template_id(node)
+    if template_id is None:
+        return []
+    concept_templates, prereq_templates = get_template_options(
+        qb_cache_manager, qb_cache_manager.user, ks
+    )
+    catalog = get_template_catalog(concept_templates, prereq_templates)
+    template_ids = [str(option_id) for option_id in catalog.template_ids]
+    if template_id not in template_ids:
+        return []
+    template_index = template_ids.index(template_id)
+    template = [*concept_templates, *prereq_templates][template_index]
+    question = generate_question(template, template_index, catalog, qb_cache_manager)
+    if question is None:
+        return []
+
+    correct_probs = posterior.calculate_correct_probs(catalog.difficulties, catalog.guess_probs)
+    save_questions_asked(
+        qb_cache_manager,
+        qb_cache_manager.user,
+        session_id,
+        [question],
+        [correct_probs[template_index]],
+    )
+    qb_cache_manager.add_questions_asked([question])
+    return [question]
@@ -0,0 +1,204 @@
+"""Plans of question batches - the posterior and the next question's template after each sequence
+of answers.
+
+A question batch is at most `max_num_questions` answers and the posterior depends only on the
+answers given, so question selection can be run ahead of time for every sequence of answers. The
+plan is a tree of answer sequences, cut off at `BATCH_PLAN_MAX_DEPTH` answers and at sequences
+less likely than `BATCH_PLAN_MIN_PATH_PROB` under the posteriors on the way. Its nodes are rows of
+a few arrays, so a plan is small enough to keep in the cache.
+
+Plans use quadrature, whatever `INFERENCE_ENGINE` is: it's deterministic, takes ~0.2ms per node
+and every node's posterior is on the grid of the prior, so only the weights need storing.
+
+Only needs numpy (no Django) - caching plans and serving questions from them is in `batch_plan`.
+"""
+import copy
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from questions.inference import GaussianParams, QuadratureInference, WeightedThetaPosterior
+from questions.template_weights import (
+    QuestionCounts,
+    TemplateCatalog,
+    get_novelty_terms,
+    gumbel_top_k,
+    prob_correct_to_weighting,
+)
+
+# Answers planned ahead. Prerequisites' templates can become options after 5 answers, so plans stop
+#  before then
+BATCH_PLAN_MAX_DEPTH = 4
+# Answer sequences less likely than this aren't planned
+BATCH_PLAN_MIN_PATH_PROB = 0.05
+
+
+@dataclass
+class BatchPlan:
+    """Tree of answer sequences, each node a row of the arrays. Node 0 is the root - no answers."""
+
+    prior: GaussianParams
+    # Grid of theta values each node's posterior is given on
+    theta: np.ndarray
+    # Posterior probability mass on the grid at each node (num_nodes, num_theta)
+    weights: np.ndarray
+    # Number of answers given at each node
+    depths: np.ndarray
+    # Node reached by answering the node's next question incorrectly (column 0) or correctly
+    #  (column 1), -1 if not planned (num_nodes, 2)
+    children: np.ndarray
+    # Difficulty and guess probability of the question answered to reach each node
+    difficulties: np.ndarray
+    guess_probs: np.ndarray
+    # Index in `template_ids` of the template each node's next question is chosen from, -1 if none
+    template_indices: np.ndarray
+    template_ids: List[str]
+
+    def __len__(self) -> int:
+        return len(self.depths)
+
+    def find_node(
+        self, difficulties: np.ndarray, guess_probs: np.ndarray, correct: np.ndarray
+    ) -> Optional[int]:
+        """Node reached by the answers given, or None if they're not in the plan - e.g. if a
+        question asked wasn't the question planned."""
+        node = 0
+        for difficulty, guess_prob, answer in zip(difficulties, guess_probs, correct):
+            node = int(self.children[node, int(answer)])
+            if (
+                node < 0
+                or not np.isclose(self.difficulties[node], difficulty)
+                or not np.isclose(self.guess_probs[node], guess_prob)
+            ):
+                return None
+        return node
+
+    def posterior(self, node: int) -> WeightedThetaPosterior:
+        return WeightedThetaPosterior(
+            self.prior,
+            self.theta,
+            self.weights[node].astype(float),
+            num_observations=int(self.depths[node]),
+        )
+
+    def planned_template_id(self, node: int) -> Optional[str]:
+        template_index = int(self.template_indices[node])
+        return self.template_ids[template_index] if template_index >= 0 else None
+
+
+def choose_template(
+    catalog: TemplateCatalog,
+    posterior: QuadratureInference,
+    question_counts: QuestionCounts,
+    template_counts_to_avoid: Dict[str, int],
+) -> int:
+    """Draws a template as `select_questions()` does, or returns -1 if none can be chosen."""
+    correct_probs = posterior.calculate_correct_probs(catalog.difficulties, catalog.guess_probs)
+    num_batch_qs = np.array(
+        [question_counts.templates[str(template_id)] for template_id in catalog.template_ids]
+    )
+    question_weights = (
+        prob_correct_to_weighting(correct_probs)
+        * get_novelty_terms(catalog, question_counts, template_counts_to_avoid)
+        * (num_batch_qs < catalog.num_questions)
+    )
+    chosen_indices = gumbel_top_k(question_weights, 1)
+    return int(chosen_indices[0]) if len(chosen_indices) > 0 else -1
+
+
+def compute_batch_plan(
+    prior: GaussianParams,
+    catalog: TemplateCatalog,
+    questions: List[Dict[str, Any]],
+    template_counts_to_avoid: Dict[str, int],
+    max_num_questions: int,
+    max_depth: int = BATCH_PLAN_MAX_DEPTH,
+    min_path_prob: float = BATCH_PLAN_MIN_PATH_PROB,
+) -> BatchPlan:
+    """Plans a question batch which has been asked `questions` and had no answers yet.
+
+    After each answer, the next question is chosen (as in `QuestionResponseView`) if fewer than
+    `max_num_questions` have been asked, so the questions answered after the first
+    `len(questions)` are those chosen by the nodes on the way.
+    """
+    root = QuadratureInference(prior)
+    theta, root_weights = root.theta_weights
+    weights, depths, children = [root_weights], [0], [[-1, -1]]
+    difficulties, guess_probs, template_indices = [np.nan], [np.nan], [-1]
+
+    # Nodes to expand: index, posterior, probability of its answers, (difficulty, guess
+    #  probability) of each question asked and the batch's question counts
+    to_expand: Deque[
+        Tuple[int, QuadratureInference, float, List[Tuple[float, float]], QuestionCounts]
+    ] = deque(
+        [
+            (
+                0,
+                root,
+                1.0,
+                [(q["difficulty"], 1 / len(q["answers_order_randomised"])) for q in questions],
+                QuestionCounts.from_questions(questions),
+            )
+        ]
+    )
+    while to_expand:
+        node, posterior, path_prob, asked, question_counts = to_expand.popleft()
+        depth = depths[node]
+        # The question batch's first questions were chosen when it started
+        if depth > 0 and len(asked) < max_num_questions:
+            template_indices[node] = choose_template(
+                catalog, posterior, question_counts, template_counts_to_avoid
+            )
+            if template_indices[node] >= 0:
+                question_counts = copy.deepcopy(question_counts)
+                question_counts.add(
+                    {
+                        "template_id": catalog.template_ids[template_indices[node]],
+                        "question_type": catalog.question_types[template_indices[node]],
+                    }
+                )
+                asked = asked + [
+                    (
+                        catalog.difficulties[template_indices[node]],
+                        catalog.guess_probs[template_indices[node]],
+                    )
+                ]
+        if depth >= max_depth or depth >= len(asked):
+            continue
+
+        difficulty, guess_prob = asked[depth]
+        prob_correct = posterior.calculate_correct_probs(
+            np.array([difficulty]), np.array([guess_prob])
+        )[0]
+        for correct, answer_prob in [(False, 1 - prob_correct), (True, prob_correct)]:
+            if path_prob * answer_prob < min_path_prob:
+                continue
+            child_posterior = copy.copy(posterior)
+            child_posterior.run_mcmc_inference(
+                np.array([difficulty]), np.array([guess_prob]), np.array([int(correct)])
+            )
+            child = len(depths)
+            children[node][int(correct)] = child
+            weights.append(child_posterior.theta_weights[1])
+            depths.append(depth + 1)
+            children.append([-1, -1])
+            difficulties.append(difficulty)
+            guess_probs.append(guess_prob)
+            template_indices.append(-1)
+            to_expand.append(
+                (child, child_posterior, path_prob * answer_prob, asked, question_counts)
+            )
+
+    return BatchPlan(
+        prior=prior,
+        theta=theta,
+        weights=np.array(weights, dtype=np.float32),
+        depths=np.array(depths, dtype=np.int8),
+        children=np.array(children, dtype=np.int16),
+        difficulties=np.array(difficulties, dtype=float),
+        guess_probs=np.array(guess_probs, dtype=float),
+        template_indices=np.array(template_indices, dtype=np.int16),
+        template_ids=[str(template_id) for template_id in catalog.template_ids],
+    )
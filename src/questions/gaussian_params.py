@@ -0,0 +1,22 @@
+from dataclasses import dataclass
+from statistics import NormalDist
+
+
+@dataclass
+class GaussianParams:
+    mean: float
+    std_dev: float
+    # The 'level' is where CDF(user's knowledge state = level) = LEVEL_THRESHOLD
+    LEVEL_THRESHOLD = 0.25  # Ie we think there's a 75% prob that they're at this level or higher
+
+    def __post_init__(self):
+        assert self.std_dev >= 0
+        self._dist = NormalDist(mu=self.mean, sigma=self.std_dev)
+
+    @property
+    def level(self) -> float:
+        return max(self.raw_level, 0)
+
+    @property
+    def raw_level(self) -> float:
+        return self._dist.inv_cdf(self.LEVEL_THRESHOLD)
@@ -0,0 +1,134 @@
+"""Compares the accuracy and latency of inference engines against a reference engine.
+
+Used to pick the cheapest engine whose posteriors stay within tolerance of NUTS on recorded
+question batches - run it with `python manage.py compare_inference_engines`.
+"""
+import time
+from dataclasses import dataclass
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from questions.inference import InferenceProblem, KnowledgeStateInference, get_inference_engine
+
+# Questions the posteriors' predictions are compared on - every difficulty the question templates
+#  use, with 2 and 4 possible answers
+COMPARISON_DIFFICULTIES = np.repeat(np.arange(6, dtype=float), 2)
+COMPARISON_GUESS_PROBS = np.tile([0.5, 0.25], 6)
+
+
+@dataclass
+class EngineComparison:
+    """How far an engine's posteriors are from the reference engine's, and how long it takes.
+
+    Errors in the mean are in standard deviations of the reference posterior. Errors in the
+    standard deviation are relative. Errors in the probability of being correct are absolute, the
+    largest over the comparison questions. Tolerances are checked against the 95th percentile of
+    errors over the problems, since the Monte-Carlo error of a NUTS reference makes its largest
+    errors noisy.
+    """
+
+    engine_name: str
+    num_problems: int
+    p95_mean_error: float
+    max_mean_error: float
+    max_std_dev_error: float
+    p95_correct_prob_error: float
+    median_latency_ms: float
+    p95_latency_ms: float
+
+    def within_tolerance(self, mean_tolerance: float, correct_prob_tolerance: float) -> bool:
+        return (
+            self.p95_mean_error <= mean_tolerance
+            and self.p95_correct_prob_error <= correct_prob_tolerance
+        )
+
+
+def run_timed_inference(
+    engine_name: str, problems: Sequence[InferenceProblem]
+) -> Tuple[List[KnowledgeStateInference], np.ndarray]:
+    """Runs inference for each problem one at a time, as it's run when serving answers.
+
+    The first problem is run once untimed first, so compiling NUTS kernels isn't counted.
+
+    Returns: the posterior of each problem and its latency in milliseconds
+    """
+    engine = get_inference_engine(engine_name)
+    warm_up = engine(problems[0].prior)
+    warm_up.run_mcmc_inference(
+        problems[0].difficulties, problems[0].guess_probs, problems[0].answers
+    )
+
+    posteriors, latencies_ms = [], []
+    for problem in problems:
+        start_time = time.perf_counter()
+        posterior = engine(problem.prior)
+        posterior.run_mcmc_inference(problem.difficulties, problem.guess_probs, problem.answers)
+        posterior.calculate_correct_probs(COMPARISON_DIFFICULTIES, COMPARISON_GUESS_PROBS)
+        latencies_ms.append((time.perf_counter() - start_time) * 1000)
+        posteriors.append(posterior)
+    return posteriors, np.array(latencies_ms)
+
+
+def compare_inference_engines(
+    problems: Sequence[InferenceProblem],
+    engine_names: Sequence[str],
+    reference_engine_name: str = "nuts",
+) -> List[EngineComparison]:
+    """Runs each engine and the reference engine on every problem and compares their posteriors.
+
+    Returns: the comparison of each engine, starting with the reference engine itself
+    """
+    assert len(problems) > 0, "No problems given to compare inference engines on!"
+    references, reference_latencies_ms = run_timed_inference(reference_engine_name, problems)
+    reference_params = [reference.inferred_theta_params for reference in references]
+    reference_probs = np.array([reference.correct_probs for reference in references])
+
+    comparisons = []
+    for engine_name in [reference_engine_name, *engine_names]:
+        if engine_name == reference_engine_name:
+            posteriors, latencies_ms = references, reference_latencies_ms
+        else:
+            posteriors, latencies_ms = run_timed_inference(engine_name, problems)
+        params = [posterior.inferred_theta_params for posterior in posteriors]
+        mean_errors = np.array(
+            [
+                abs(param.mean - reference.mean) / reference.std_dev
+                for param, reference in zip(params, reference_params)
+            ]
+        )
+        std_dev_errors = np.array(
+            [
+                abs(param.std_dev / reference.std_dev - 1)
+                for param, reference in zip(params, reference_params)
+            ]
+        )
+        probs = np.array([posterior.correct_probs for posterior in posteriors])
+        prob_errors = np.max(np.abs(probs - reference_probs), axis=1)
+        comparisons.append(
+            EngineComparison(
+                engine_name=engine_name,
+                num_problems=len(problems),
+                p95_mean_error=float(np.percentile(mean_errors, 95)),
+                max_mean_error=float(np.max(mean_errors)),
+                max_std_dev_error=float(np.max(std_dev_errors)),
+                p95_correct_prob_error=float(np.percentile(prob_errors, 95)),
+                median_latency_ms=float(np.median(latencies_ms)),
+                p95_latency_ms=float(np.percentile(latencies_ms, 95)),
+            )
+        )
+    return comparisons
+
+
+def cheapest_engine_within_tolerance(
+    comparisons: Sequence[EngineComparison], mean_tolerance: float, correct_prob_tolerance: float
+) -> Optional[str]:
+    """The engine with the lowest median latency of those within tolerance, if there are any."""
+    within_tolerance = [
+        comparison
+        for comparison in comparisons
+        if comparison.within_tolerance(mean_tolerance, correct_prob_tolerance)
+    ]
+    if not within_tolerance:
+        return None
+    return min(within_tolerance, key=lambda comparison: comparison.median_latency_ms).engine_name
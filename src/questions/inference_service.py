@@ -0,0 +1,353 @@
+"""Runs knowledge state inference in dedicated worker processes.
+
+Web workers push inference jobs onto a queue and wait for the result. This means web workers don't
+run numpyro themselves, so they don't need to take turns using a global mutex - throughput scales
+with the number of inference workers. Each worker keeps its JIT-compiled models warm between jobs.
+
+Jobs arriving within a short window of each other are run together in one batch, so under peak
+traffic engines which vectorise batched inference spend less CPU time per job. Jobs expire when the
+web worker stops waiting for their result, and expired jobs are dropped without being run - so a
+backlog of abandoned jobs doesn't hold up new ones.
+
+Start the workers with `python manage.py run_inference_workers`.
+"""
+
+import json
+import queue
+import threading
+import time
+from abc import ABC, abstractmethod
+from dataclasses import asdict
+from typing import Any, Dict, List, Optional
+from uuid import uuid4
+
+import numpy as np
+import redis
+
+from questions.inference import (
+    MCMC_BATCH_SIZE_BUCKETS,
+    GaussianParams,
+    InferenceProblem,
+    MultiChainMCMCInference,
+    NUTSAdaptationState,
+    NUTSDiagnostics,
+    Posterior,
+    WeightedThetaPosterior,
+    enable_parallel_chains,
+    get_inference_engine,
+    uses_nuts,
+    warm_up_nuts_kernels,
+)
+
+INFERENCE_JOBS_KEY = "inference_jobs"
+# Results not collected by the web worker within this time (e.g. it timed out) are deleted
+RESULT_EXPIRY_SECS = 60
+# After taking a job, workers wait up to this long for more jobs to run in the same batch
+INFERENCE_BATCH_WINDOW_SECS = 0.02
+INFERENCE_MAX_BATCH_SIZE = MCMC_BATCH_SIZE_BUCKETS[-1]
+
+
+class InferenceTimeoutError(TimeoutError):
+    pass
+
+
+class InferenceJobError(RuntimeError):
+    pass
+
+
+class InferenceQueue(ABC):
+    """Sends inference jobs to inference workers and their results back."""
+
+    @abstractmethod
+    def push_job(self, job: Dict[str, Any]) -> None:
+        """Adds the job to the end of the queue."""
+
+    @abstractmethod
+    def pop_job(self, timeout: float) -> Optional[Dict[str, Any]]:
+        """Blocks until a job is available, or returns None after `timeout` seconds."""
+
+    @abstractmethod
+    def pop_jobs(self, max_jobs: int) -> List[Dict[str, Any]]:
+        """Takes up to `max_jobs` jobs already in the queue, without blocking."""
+
+    @abstractmethod
+    def push_result(self, job_id: str, result: Dict[str, Any]) -> None:
+        """Sends the job's result back to the web worker waiting for it."""
+
+    @abstractmethod
+    def pop_result(self, job_id: str, timeout: float) -> Optional[Dict[str, Any]]:
+        """Blocks until the job's result is available, or returns None after `timeout` seconds."""
+
+
+class RedisInferenceQueue(InferenceQueue):
+    """Queue shared by all processes on Redis lists - one for jobs and one per job for its
+    result."""
+
+    def __init__(self, redis_url: str):
+        self._redis = redis.Redis.from_url(redis_url)
+
+    @staticmethod
+    def _result_key(job_id: str) -> str:
+        return f"inference_result:{job_id}"
+
+    def push_job(self, job: Dict[str, Any]) -> None:
+        self._redis.rpush(INFERENCE_JOBS_KEY, json.dumps(job))
+
+    def pop_job(self, timeout: float) -> Optional[Dict[str, Any]]:
+        popped = self._redis.blpop([INFERENCE_JOBS_KEY], timeout=timeout)
+        return json.loads(popped[1]) if popped is not None else None
+
+    def pop_jobs(self, max_jobs: int) -> List[Dict[str, Any]]:
+        pipeline = self._redis.pipeline(transaction=True)
+        pipeline.lrange(INFERENCE_JOBS_KEY, 0, max_jobs - 1)
+        pipeline.ltrim(INFERENCE_JOBS_KEY, max_jobs, -1)
+        popped, _ = pipeline.execute()
+        return [json.loads(job) for job in popped]
+
+    def push_result(self, job_id: str, result: Dict[str, Any]) -> None:
+        self._redis.rpush(self._result_key(job_id), json.dumps(result))
+        self._redis.expire(self._result_key(job_id), RESULT_EXPIRY_SECS)
+
+    def pop_result(self, job_id: str, timeout: float) -> Optional[Dict[str, Any]]:
+        popped = self._redis.blpop([self._result_key(job_id)], timeout=timeout)
+        return json.loads(popped[1]) if popped is not None else None
+
+
+class LocalInferenceQueue(InferenceQueue):
+    """In-process stand-in for `RedisInferenceQueue`, for tests and local development."""
+
+    def __init__(self):
+        self._jobs: "queue.Queue[Dict[str, Any]]" = queue.Queue()
+        self._results: Dict[str, "queue.Queue[Dict[str, Any]]"] = {}
+        self._results_lock = threading.Lock()
+
+    def _result_queue(self, job_id: str) -> "queue.Queue[Dict[str, Any]]":
+        with self._results_lock:
+            return self._results.setdefault(job_id, queue.Queue())
+
+    def push_job(self, job: Dict[str, Any]) -> None:
+        self._jobs.put(job)
+
+    def pop_job(self, timeout: float) -> Optional[Dict[str, Any]]:
+        try:
+            return self._jobs.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def pop_jobs(self, max_jobs: int) -> List[Dict[str, Any]]:
+        jobs = []
+        while len(jobs) < max_jobs:
+            try:
+                jobs.append(self._jobs.get_nowait())
+            except queue.Empty:
+                break
+        return jobs
+
+    def push_result(self, job_id: str, result: Dict[str, Any]) -> None:
+        self._result_queue(job_id).put(result)
+
+    def pop_result(self, job_id: str, timeout: float) -> Optional[Dict[str, Any]]:
+        try:
+            return self._result_queue(job_id).get(timeout=timeout)
+        except queue.Empty:
+            return None
+        finally:
+            with self._results_lock:
+                self._results.pop(job_id, None)
+
+
+def inference_problem(job: Dict[str, Any]) -> InferenceProblem:
+    return InferenceProblem(
+        prior=GaussianParams(*job["prior"]),
+        difficulties=np.array(job["difficulties"]),
+        guess_probs=np.array(job["guess_probs"]),
+        answers=np.array(job["answers"]),
+        adaptation_state=(
+            NUTSAdaptationState(**job["adaptation_state"])
+            if job.get("adaptation_state") is not None
+            else None
+        ),
+    )
+
+
+def inference_result(inference: Posterior) -> Dict[str, Any]:
+    """The posterior as weighted values of theta, along with the engine's adaptation state for the
+    next job on the same question batch and its diagnostics."""
+    theta, weights = inference.theta_weights
+    adaptation_state = inference.adaptation_state
+    return {
+        "theta": theta.tolist(),
+        "weights": weights.tolist(),
+        "num_observations": inference.num_observations,
+        "adaptation_state": asdict(adaptation_state) if adaptation_state is not None else None,
+        "diagnostics": (
+            asdict(inference.diagnostics) if inference.diagnostics is not None else None
+        ),
+    }
+
+
+def run_inference_job(job: Dict[str, Any]) -> Dict[str, Any]:
+    """Runs inference for a job and returns the result (see `inference_result()`)."""
+    return run_inference_jobs([job])[0]
+
+
+def run_inference_jobs(jobs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Runs inference for a batch of jobs, using each engine's batched inference. If a batch fails,
+    its jobs are run one at a time so only the failing jobs return an error.
+
+    Returns: the result of each job, in the same order
+    """
+    results: List[Optional[Dict[str, Any]]] = [None] * len(jobs)
+    jobs_by_engine: Dict[str, List[int]] = {}
+    for index, job in enumerate(jobs):
+        jobs_by_engine.setdefault(job["engine"], []).append(index)
+
+    def run_batch(engine_name: str, indices: List[int]) -> None:
+        posteriors = get_inference_engine(engine_name).run_batched_inference(
+            [inference_problem(jobs[index]) for index in indices]
+        )
+        for index, posterior in zip(indices, posteriors):
+            results[index] = inference_result(posterior)
+
+    for engine_name, indices in jobs_by_engine.items():
+        try:
+            run_batch(engine_name, indices)
+        except Exception:
+            for index in indices:
+                try:
+                    run_batch(engine_name, [index])
+                except Exception as e:
+                    results[index] = {"error": f"{type(e).__name__}: {e}"}
+    return results
+
+
+class InferenceWorker:
+    """Takes inference jobs from the queue, runs them and pushes back the results.
+
+    After taking a job, it takes more jobs as they arrive and runs them all as a batch once there
+    are `max_batch_size` of them or `batch_window_secs` have passed since the first.
+    """
+
+    def __init__(
+        self,
+        inference_queue: InferenceQueue,
+        batch_window_secs: float = INFERENCE_BATCH_WINDOW_SECS,
+        max_batch_size: int = INFERENCE_MAX_BATCH_SIZE,
+    ):
+        self.inference_queue = inference_queue
+        self.batch_window_secs = batch_window_secs
+        self.max_batch_size = max_batch_size
+
+    def run_once(self, timeout: float = 1) -> bool:
+        """Runs a batch of jobs if one arrives within `timeout` seconds. Returns whether any jobs
+        were taken."""
+        job = self.inference_queue.pop_job(timeout=timeout)
+        if job is None:
+            return False
+        jobs = [job]
+        window_end = time.monotonic() + self.batch_window_secs
+        while len(jobs) < self.max_batch_size:
+            jobs += self.inference_queue.pop_jobs(self.max_batch_size - len(jobs))
+            time_left = window_end - time.monotonic()
+            if len(jobs) >= self.max_batch_size or time_left <= 0:
+                break
+            job = self.inference_queue.pop_job(timeout=time_left)
+            if job is None:
+                break
+            jobs.append(job)
+        # The web workers which submitted expired jobs have stopped waiting for their results
+        now = time.time()
+        jobs = [job for job in jobs if job["expires_at"] > now]
+        for job, result in zip(jobs, run_inference_jobs(jobs)):
+            self.inference_queue.push_result(job["id"], result)
+        return True
+
+    def run_forever(self) -> None:
+        while True:
+            self.run_once()
+
+
+def run_inference_worker(redis_url: str, engine_name: str) -> None:
+    """Entry point of each inference worker process."""
+    if get_inference_engine(engine_name) is MultiChainMCMCInference:
+        enable_parallel_chains()
+    if uses_nuts(engine_name):
+        warm_up_nuts_kernels(engine_name, batch_size_buckets=MCMC_BATCH_SIZE_BUCKETS)
+    InferenceWorker(RedisInferenceQueue(redis_url)).run_forever()
+
+
+# Queues by inference service URL, so each process makes one Redis connection pool per URL
+_inference_queues: Dict[str, InferenceQueue] = {}
+_inference_queues_lock = threading.Lock()
+
+
+def get_inference_queue(inference_service_url: str) -> InferenceQueue:
+    """Gets the queue for the inference service URL, made once per process. "local" gives an
+    in-process queue with a worker running in a background thread."""
+    with _inference_queues_lock:
+        inference_queue = _inference_queues.get(inference_service_url)
+        if inference_queue is None:
+            if inference_service_url == "local":
+                inference_queue = LocalInferenceQueue()
+                worker = InferenceWorker(inference_queue)
+                threading.Thread(target=worker.run_forever, daemon=True).start()
+            else:
+                inference_queue = RedisInferenceQueue(inference_service_url)
+            _inference_queues[inference_service_url] = inference_queue
+    return inference_queue
+
+
+def submit_inference(
+    inference_queue: InferenceQueue,
+    engine_name: str,
+    prior: GaussianParams,
+    difficulties: np.ndarray,
+    guess_probs: np.ndarray,
+    answers: np.ndarray,
+    timeout: float,
+    adaptation_state: Optional[NUTSAdaptationState] = None,
+) -> Posterior:
+    """Sends an inference job to the inference workers and waits for the result. The job expires
+    after `timeout` seconds, so it isn't run if it's still queued by then.
+
+    `adaptation_state` is passed on to the worker's inference engine to warm-start it. The
+    returned posterior holds the engine's new adaptation state and diagnostics.
+
+    Raises:
+        InferenceTimeoutError: if no result is returned within `timeout` seconds
+        InferenceJobError: if the inference worker failed to run the job
+    """
+    job_id = str(uuid4())
+    inference_queue.push_job(
+        {
+            "id": job_id,
+            "engine": engine_name,
+            "prior": [prior.mean, prior.std_dev],
+            "difficulties": np.asarray(difficulties, dtype=float).tolist(),
+            "guess_probs": np.asarray(guess_probs, dtype=float).tolist(),
+            "answers": np.asarray(answers, dtype=int).tolist(),
+            "adaptation_state": asdict(adaptation_state) if adaptation_state is not None else None,
+            "expires_at": time.time() + timeout,
+        }
+    )
+    result = inference_queue.pop_result(job_id, timeout=timeout)
+    if result is None:
+        raise InferenceTimeoutError(f"No inference result for job {job_id} after {timeout}s.")
+    if "error" in result:
+        raise InferenceJobError(f"Inference job {job_id} failed! Error: {result['error']}")
+    return WeightedThetaPosterior(
+        prior,
+        theta=np.array(result["theta"]),
+        weights=np.array(result["weights"]),
+        num_observations=result["num_observations"],
+        adaptation_state=(
+            NUTSAdaptationState(**result["adaptation_state"])
+            if result.get("adaptation_state") is not None
+            else None
+        ),
+        diagnostics=(
+            NUTSDiagnostics(**result["diagnostics"])
+            if result.get("diagnostics") is not None
+            else None
+        ),
+    )
@@ -0,0 +1,61 @@
+from django.core.management.base import BaseCommand
+
+from questions.models import QuestionResponse
+
+
+class Command(BaseCommand):
+    help = (
+        "Stores the question snapshot of each response saved before snapshots were stored, "
+        "rendered from its template as it is now, in chunks. Run again to carry on - responses "
+        "which have a snapshot are skipped"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=500,
+            help="Number of responses rendered and saved in each update",
+        )
+        parser.add_argument(
+            "--after-id",
+            default=None,
+            help="Only backfill responses with a greater id, e.g. the last id of a previous run",
+        )
+        parser.add_argument(
+            "--max-chunks",
+            type=int,
+            default=None,
+            help="Stop after this many chunks",
+        )
+
+    def handle(self, *args, **options):
+        # Responses are taken in id order from after the last one seen, so ones which can't be
+        #  rendered are only tried once per run
+        last_id = options["after_id"]
+        num_chunks, num_backfilled, num_failed = 0, 0, 0
+        while options["max_chunks"] is None or num_chunks < options["max_chunks"]:
+            responses = QuestionResponse.objects.filter(
+                question_snapshot__isnull=True
+            ).select_related("question_template", "question_batch")
+            if last_id is not None:
+                responses = responses.filter(id__gt=last_id)
+            chunk = list(responses.order_by("id")[: options["chunk_size"]])
+            if not chunk:
+                break
+            to_update = []
+            for response in chunk:
+                response.question_snapshot = response.snapshot_from_template()
+                if response.question_snapshot is None:
+                    num_failed += 1
+                    self.stdout.write(f"Response {response.id} can't be rendered")
+                else:
+                    to_update.append(response)
+            QuestionResponse.objects.bulk_update(to_update, ["question_snapshot", "answer_letters"])
+            last_id = chunk[-1].id
+            num_chunks += 1
+            num_backfilled += len(to_update)
+            self.stdout.write(f"Backfilled {num_backfilled} responses, up to id {last_id}")
+        self.stdout.write(
+            f"Backfilled {num_backfilled} question snapshots, {num_failed} couldn't be rendered"
+        )
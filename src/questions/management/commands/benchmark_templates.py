@@ -0,0 +1,65 @@
+from django.core.management.base import BaseCommand
+
+from questions.models import QuestionTemplate
+from questions.template_benchmark import (
+    BENCHMARK_LIST_ITEMS,
+    benchmark_param_lines,
+    benchmark_rendering,
+    test_data_templates,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmarks rendering question templates by substituting parameters into the text of "
+        "each <<>> expression against rendering compiled templates, and parsing parameter lines "
+        "with long lists against the regex they were parsed with"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--min-secs",
+            type=float,
+            default=1,
+            help="Minimum time each template is rendered for, each way",
+        )
+        parser.add_argument(
+            "--active-templates",
+            action="store_true",
+            help="Benchmark the active templates in the DB instead of the test data templates",
+        )
+        parser.add_argument(
+            "--list-items",
+            type=int,
+            nargs="+",
+            default=BENCHMARK_LIST_ITEMS,
+            help="Numbers of items in the lists of the parameter lines parsed",
+        )
+
+    def handle(self, *args, **options):
+        templates = (
+            [
+                (str(template.id), template.template_text)
+                for template in QuestionTemplate.objects.filter(active=True)
+            ]
+            if options["active_templates"]
+            else test_data_templates()
+        )
+        benchmarks = benchmark_rendering(templates, options["min_secs"])
+        self.stdout.write(
+            f"{'template':<40}{'exprs':>6}{'text renders/s':>16}{'compiled renders/s':>20}"
+            f"{'speedup':>9}{'compile ms':>12}"
+        )
+        for benchmark in benchmarks:
+            self.stdout.write(
+                f"{benchmark.name:<40}{benchmark.num_expressions:>6}"
+                f"{benchmark.text_renders_per_sec:>16.0f}{benchmark.compiled_renders_per_sec:>20.0f}"
+                f"{benchmark.speedup:>8.1f}x{benchmark.compile_ms:>12.2f}"
+            )
+
+        self.stdout.write(f"\n{'list items':>10}{'regex ms':>14}{'split ms':>12}")
+        for benchmark in benchmark_param_lines(options["list_items"]):
+            regex_ms = "-" if benchmark.regex_ms is None else f"{benchmark.regex_ms:.2f}"
+            self.stdout.write(
+                f"{benchmark.num_list_items:>10}{regex_ms:>14}{benchmark.split_ms:>12.2f}"
+            )
@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand
+
+from questions.models import QuestionTemplate
+from questions.models.question_template import MAX_CHECKED_PARAM_COMBINATIONS
+from questions.template_parser import num_param_combinations, parse_params
+
+
+class Command(BaseCommand):
+    help = (
+        "Generates the question from every parameter combination of each question template and "
+        "stores which combinations are valid, so questions are only drawn from valid combinations"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Check templates again even if their text hasn't changed since they were checked",
+        )
+        parser.add_argument(
+            "--max-combinations",
+            type=int,
+            default=MAX_CHECKED_PARAM_COMBINATIONS * 10,
+            help="Templates with more parameter combinations than this are left unchecked",
+        )
+
+    def handle(self, *args, **options):
+        num_checked, num_deactivated = 0, 0
+        for template in QuestionTemplate.objects.select_related("concept").order_by(
+            "concept__cytoscape_id", "difficulty"
+        ):
+            if not options["force"] and template.params_checked_hash == template.template_text_hash:
+                continue
+            was_active = template.active
+            template.check_param_combinations(max_combinations=options["max_combinations"])
+            template.save()
+            num_checked += 1
+            num_deactivated += was_active and not template.active
+
+            if template.valid_params_bitmap is None:
+                self.stdout.write(f"{template.title} ({template.id}): not checked")
+                continue
+            num_combinations = num_param_combinations(parse_params(template.template_text))
+            num_valid = num_combinations - len(template.invalid_param_combinations)
+            self.stdout.write(
+                f"{template.title} ({template.id}): {num_valid}/{num_combinations} valid, "
+                f"{len(template.param_errors)} errors, "
+                f"{len(template.duplicate_question_groups)} duplicate question groups"
+                + (" - deactivated" if was_active and not template.active else "")
+            )
+            for index, error in list(template.param_errors.items())[:3]:
+                self.stdout.write(f"    combination {index}: {error}")
+        self.stdout.write(
+            f"Checked {num_checked} question templates, deactivated {num_deactivated}"
+        )
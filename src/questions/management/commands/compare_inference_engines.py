@@ -0,0 +1,85 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from questions.inference import INFERENCE_ENGINES, InferenceProblem
+from questions.inference_comparison import (
+    cheapest_engine_within_tolerance,
+    compare_inference_engines,
+)
+from questions.models.question_batch import QuestionBatch
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares the accuracy and latency of inference engines against a reference engine on "
+        "recorded question batches, and reports the cheapest engine within tolerance"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--num-batches",
+            type=int,
+            default=200,
+            help="Number of question batches to compare on, the most recent first",
+        )
+        parser.add_argument(
+            "--engines",
+            nargs="+",
+            default=["quadrature", "laplace", "variational"],
+            choices=list(INFERENCE_ENGINES),
+            help="Inference engines to compare against the reference engine",
+        )
+        parser.add_argument(
+            "--reference",
+            default="nuts",
+            choices=list(INFERENCE_ENGINES),
+            help="Inference engine whose posteriors are taken as correct",
+        )
+        parser.add_argument(
+            "--mean-tolerance",
+            type=float,
+            default=0.2,
+            help="95th percentile error allowed in the posterior mean, in posterior standard "
+            "deviations",
+        )
+        parser.add_argument(
+            "--correct-prob-tolerance",
+            type=float,
+            default=0.05,
+            help="95th percentile error allowed in predicted probabilities of answering correctly",
+        )
+
+    def handle(self, *args, **options):
+        problems = []
+        for question_batch in QuestionBatch.objects.order_by("-time_started")[
+            : options["num_batches"]
+        ]:
+            difficulties, guess_probs, answers = question_batch.training_data
+            if len(answers) > 0:
+                problems.append(
+                    InferenceProblem(
+                        question_batch.initial_knowledge_state,
+                        difficulties.astype(float),
+                        guess_probs.astype(float),
+                        answers.astype(int),
+                    )
+                )
+        if not problems:
+            raise CommandError("No answered question batches to compare inference engines on")
+
+        comparisons = compare_inference_engines(problems, options["engines"], options["reference"])
+        self.stdout.write(
+            f"Compared on {len(problems)} question batches against '{options['reference']}'\n"
+            f"{'engine':<16}{'mean err (p95/max)':>24}{'std err':>10}{'prob err':>10}"
+            f"{'latency ms (median/p95)':>26}"
+        )
+        for comparison in comparisons:
+            self.stdout.write(
+                f"{comparison.engine_name:<16}"
+                f"{f'{comparison.p95_mean_error:.3f} / {comparison.max_mean_error:.3f}':>24}"
+                f"{comparison.max_std_dev_error:>10.3f}{comparison.p95_correct_prob_error:>10.3f}"
+                f"{f'{comparison.median_latency_ms:.2f} / {comparison.p95_latency_ms:.2f}':>26}"
+            )
+        cheapest = cheapest_engine_within_tolerance(
+            comparisons, options["mean_tolerance"], options["correct_prob_tolerance"]
+        )
+        self.stdout.write(f"Cheapest engine within tolerance: {cheapest}")
@@ -0,0 +1,38 @@
+import multiprocessing
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from questions.inference_service import run_inference_worker
+
+
+class Command(BaseCommand):
+    help = "Starts a pool of inference worker processes taking jobs from the inference queue"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--num-workers",
+            type=int,
+            default=os.cpu_count(),
+            help="Number of inference worker processes to start",
+        )
+
+    def handle(self, *args, **options):
+        if settings.INFERENCE_SERVICE_URL is None or settings.INFERENCE_SERVICE_URL == "local":
+            raise CommandError("INFERENCE_SERVICE_URL must be set to a Redis URL to run workers")
+        # Spawn rather than fork, so each worker initialises JAX itself
+        context = multiprocessing.get_context("spawn")
+        workers = [
+            context.Process(
+                target=run_inference_worker,
+                args=(settings.INFERENCE_SERVICE_URL, settings.INFERENCE_ENGINE),
+                daemon=True,
+            )
+            for _ in range(options["num_workers"])
+        ]
+        for worker in workers:
+            worker.start()
+        self.stdout.write(f"Started {len(workers)} inference workers")
+        for worker in workers:
+            worker.join()
@@ -0,0 +1,17 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from questions.question_pool import QuestionPoolWorker, get_question_pool
+
+
+class Command(BaseCommand):
+    help = (
+        "Starts a worker refilling the pools of pre-rendered questions of concepts whose pools are "
+        "running low. Run more of these to refill pools faster"
+    )
+
+    def handle(self, *args, **options):
+        if settings.QUESTION_POOL_URL is None or settings.QUESTION_POOL_URL == "local":
+            raise CommandError("QUESTION_POOL_URL must be set to a Redis URL to run workers")
+        self.stdout.write("Started question pool worker")
+        QuestionPoolWorker(get_question_pool(settings.QUESTION_POOL_URL)).run_forever()
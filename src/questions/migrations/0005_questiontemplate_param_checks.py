@@ -0,0 +1,53 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("questions", "0004_questionbatch_time_taken_to_complete"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="questiontemplate",
+            name="valid_params_bitmap",
+            field=models.BinaryField(
+                default=None,
+                editable=False,
+                help_text="Bitmap of the parameter combinations which generate valid questions, or "
+                "null if they haven't been checked",
+                null=True,
+            ),
+        ),
+        migrations.AddField(
+            model_name="questiontemplate",
+            name="param_errors",
+            field=models.JSONField(
+                default=dict,
+                editable=False,
+                help_text="Why each invalid parameter combination doesn't generate a valid "
+                "question, by combination index",
+            ),
+        ),
+        migrations.AddField(
+            model_name="questiontemplate",
+            name="duplicate_question_groups",
+            field=models.JSONField(
+                default=list,
+                editable=False,
+                help_text="Groups of parameter combinations which generate the same question text "
+                "- only the first of each group is valid",
+            ),
+        ),
+        migrations.AddField(
+            model_name="questiontemplate",
+            name="params_checked_hash",
+            field=models.CharField(
+                blank=True,
+                default="",
+                editable=False,
+                help_text="MD5 hash of the template text the parameter combinations were checked on",
+                max_length=32,
+            ),
+        ),
+    ]
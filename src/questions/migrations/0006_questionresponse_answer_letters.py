@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("questions", "0005_questiontemplate_param_checks"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="questionresponse",
+            name="answer_letters",
+            field=models.JSONField(
+                default=None,
+                help_text="Letters of the template's answers, in the order they were shown. Null "
+                "for responses saved before this was stored",
+                null=True,
+            ),
+        ),
+    ]
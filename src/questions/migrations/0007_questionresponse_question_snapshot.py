@@ -0,0 +1,23 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("questions", "0006_questionresponse_answer_letters"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="questionresponse",
+            name="question_snapshot",
+            field=models.JSONField(
+                default=None,
+                help_text="The question as it was asked - its text, answers in the order shown, "
+                "correct answer, feedback and difficulty - so it's shown without rendering the "
+                "template again. Null for responses saved before this was stored, until they're "
+                "backfilled",
+                null=True,
+            ),
+        ),
+    ]
@@ -10,7 +10,7 @@ from django.db.models import UniqueConstraint
 from accounts.models import User
 from knowledge_maps.models import Concept
 from learney_backend.base_models import UUIDModel
-from questions.inference import GaussianParams
+from questions.gaussian_params import GaussianParams
 
 
 class InferredKnowledgeState(UUIDModel):
@@ -3,11 +3,12 @@ from typing import Any, Dict, Tuple
 
 import numpy as np
 from django.db import models
+from django.db.models import prefetch_related_objects
 
 from accounts.models import User
 from knowledge_maps.models import Concept
 from learney_backend.base_models import UUIDModel
-from questions.inference import GaussianParams
+from questions.gaussian_params import GaussianParams
 
 
 class QuestionBatch(UUIDModel):
@@ -88,8 +89,11 @@ class QuestionBatch(UUIDModel):
         return self.responses.count()
 
     def json(self) -> Dict[str, Any]:
-        responses = (
-            self.responses.all().select_related("question_template__concept").order_by("time_asked")
+        responses = list(self.responses.all().order_by("time_asked"))
+        # Only responses saved before snapshots were stored are rendered from their templates
+        prefetch_related_objects(
+            [response for response in responses if response.question_snapshot is None],
+            "question_template__concept",
         )
         answers_list = [response.response for response in responses]
         assert (
@@ -114,12 +118,8 @@ class QuestionBatch(UUIDModel):
     @property
     def training_data(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
         answered_responses = self.responses.all().exclude(response=None)
-        difficulties = np.array(
-            [response.question_template.difficulty for response in answered_responses]
-        )
-        guess_probs = np.array(
-            [1 / response.question_template.number_of_answers for response in answered_responses]
-        )
+        difficulties = np.array([response.difficulty for response in answered_responses])
+        guess_probs = np.array([1 / response.number_of_answers for response in answered_responses])
         correct = np.array([response.correct for response in answered_responses])
         return difficulties, guess_probs, correct
 
@@ -1,4 +1,4 @@
-from typing import Any, Dict
+from typing import Any, Dict, Optional
 
 from django.db import models
 from django.db.models import CheckConstraint
@@ -8,6 +8,22 @@ from learney_backend.base_models import UUIDModel
 from questions.models.question_batch import QuestionBatch
 from questions.models.question_template import QuestionTemplate
 
+# Keys of the question JSON which are stored in the response's snapshot - the rest it stores itself
+QUESTION_SNAPSHOT_KEYS = [
+    "title",
+    "question_type",
+    "question_text",
+    "answers_order_randomised",
+    "correct_answer",
+    "feedback",
+    "difficulty",
+]
+
+
+def question_snapshot(question: Dict[str, Any]) -> Dict[str, Any]:
+    """The parts of the question JSON which are rendered from its template, as it was asked."""
+    return {key: question[key] for key in QUESTION_SNAPSHOT_KEYS}
+
 
 class QuestionResponse(UUIDModel):
     user = models.ForeignKey(
@@ -25,6 +41,19 @@ class QuestionResponse(UUIDModel):
     question_params = models.JSONField(
         help_text="question parameter values chosen from the template parameters",
     )
+    answer_letters = models.JSONField(
+        null=True,
+        default=None,
+        help_text="Letters of the template's answers, in the order they were shown. Null for "
+        "responses saved before this was stored",
+    )
+    question_snapshot = models.JSONField(
+        null=True,
+        default=None,
+        help_text="The question as it was asked - its text, answers in the order shown, correct "
+        "answer, feedback and difficulty - so it's shown without rendering the template again. "
+        "Null for responses saved before this was stored, until they're backfilled",
+    )
     question_batch = models.ForeignKey(
         QuestionBatch,
         on_delete=models.CASCADE,
@@ -56,10 +85,51 @@ class QuestionResponse(UUIDModel):
 
     @property
     def json(self) -> Dict[str, Any]:
-        json = self.question_template.to_question_json(self.question_params)
+        if self.question_snapshot is None:
+            json = self.question_template.to_question_json(
+                self.question_params, answer_letters=self.answer_letters
+            )
+        else:
+            json = {
+                **self.question_snapshot,
+                "template_id": self.question_template_id,
+                "answer_letters": self.answer_letters,
+                "params": self.question_params,
+            }
         json["id"] = self.id
         return json
 
+    @property
+    def difficulty(self) -> float:
+        """Difficulty of the question as it was asked."""
+        if self.question_snapshot is None:
+            return self.question_template.difficulty
+        return self.question_snapshot["difficulty"]
+
+    @property
+    def number_of_answers(self) -> int:
+        if self.question_snapshot is None:
+            return self.question_template.number_of_answers
+        return len(self.question_snapshot["answers_order_randomised"])
+
+    def snapshot_from_template(self) -> Optional[Dict[str, Any]]:
+        """Renders the snapshot of a response saved before snapshots were stored from its template
+        as it is now, with the answers in the order they were shown if that was stored.
+
+        Returns: the snapshot, or None if the question can't be rendered
+        """
+        question = self.question_template.to_question_json(
+            self.question_params,
+            prerequisite_concept=self.question_batch.concept_id
+            != self.question_template.concept_id,
+            answer_letters=self.answer_letters,
+        )
+        if question is None:
+            return None
+        if self.answer_letters is None:
+            self.answer_letters = question["answer_letters"]
+        return question_snapshot(question)
+
     class Meta:
         constraints = [
             CheckConstraint(
@@ -1,24 +1,50 @@
+import hashlib
+import json
 import random
+import threading
 import warnings
-from typing import Any, Dict, List, Optional, Tuple
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Set, Tuple, Union
 
+from django.core.cache import cache
 from django.db import models
 
 from knowledge_maps.models import Concept
 from learney_backend.base_models import UUIDModel
+from learney_web.settings import TEMPLATE_SANDBOX_WORKERS
 from questions.template_parser import (
+    CompiledTemplate,
+    ParamOptionsDict,
+    ParsingError,
     answer_regex,
-    expand_params_in_text,
+    combinations_bitmap,
     is_param_line,
+    num_param_combinations,
+    param_value_strings,
+    params_from_combination_index,
     parse_params,
     remove_start_and_end_newlines,
     sample_params,
     says_feedback,
+    unset_combinations,
 )
+from questions.template_sandbox import get_template_sandbox
 from questions.utils import SampledParamsDict
 from questions.validators import integer_is_positive, not_null
 
 PREREQ_QUESTION_DIFF = 0
+# Templates with more parameter combinations than this aren't checked when they're saved - their
+#  questions are checked as they're generated instead
+MAX_CHECKED_PARAM_COMBINATIONS = 2000
+# Number of compiled templates kept in each process
+COMPILED_TEMPLATES_MAX_SIZE = 1024
+# Number of rendered question bodies kept in each process, and how long they're kept in the cache
+RENDERED_BODIES_MAX_SIZE = 4096
+RENDERED_BODY_TIMEOUT = 60 * 60 * 24
+
+# Question text, feedback and answers by letter of a template rendered with a combination of
+#  parameter values, as returned by `parse_template()`
+QuestionBody = Tuple[str, str, Dict[str, str]]
 
 
 class QuestionTemplate(UUIDModel):
@@ -65,6 +91,43 @@ class QuestionTemplate(UUIDModel):
     )
     last_updated = models.DateTimeField(auto_now=True)
 
+    # Results of generating the question from every combination of parameter values (see
+    #  check_param_combinations()). Combinations are indexed as in
+    #  template_parser.params_from_combination_index()
+    valid_params_bitmap = models.BinaryField(
+        null=True,
+        default=None,
+        editable=False,
+        help_text="Bitmap of the parameter combinations which generate valid questions, or null if "
+        "they haven't been checked",
+    )
+    param_errors = models.JSONField(
+        default=dict,
+        editable=False,
+        help_text="Why each invalid parameter combination doesn't generate a valid question, by "
+        "combination index",
+    )
+    duplicate_question_groups = models.JSONField(
+        default=list,
+        editable=False,
+        help_text="Groups of parameter combinations which generate the same question text - only "
+        "the first of each group is valid",
+    )
+    params_checked_hash = models.CharField(
+        max_length=32,
+        blank=True,
+        default="",
+        editable=False,
+        help_text="MD5 hash of the template text the parameter combinations were checked on",
+    )
+
+    PARAM_CHECK_FIELDS = [
+        "valid_params_bitmap",
+        "param_errors",
+        "duplicate_question_groups",
+        "params_checked_hash",
+    ]
+
     @property
     def number_of_answers(self) -> int:
         num_answers = sum(
@@ -76,45 +139,221 @@ class QuestionTemplate(UUIDModel):
         ], f"Invalid number of answers ({num_answers}) for {self.id}. Template:\n{self.template_text}"
         return num_answers
 
+    @property
+    def template_text_hash(self) -> str:
+        return hashlib.md5(self.template_text.encode()).hexdigest()
+
+    @property
+    def invalid_param_combinations(self) -> Optional[Set[int]]:
+        """Indices of the parameter combinations which don't generate valid questions, or None if
+        the current template text hasn't been checked."""
+        if self.valid_params_bitmap is None or self.params_checked_hash != self.template_text_hash:
+            return None
+        return unset_combinations(
+            bytes(self.valid_params_bitmap),
+            num_param_combinations(parse_params(self.template_text)),
+        )
+
+    @property
+    def compiled_template(self) -> CompiledTemplate:
+        """The template text compiled for rendering. Kept in this process by template id and
+        `last_updated`, so it's compiled once per version of the template (and again if the text
+        is edited but not yet saved)."""
+        key = (self.id, self.last_updated)
+        with _compiled_templates_lock:
+            compiled = _compiled_templates.get(key)
+            if compiled is not None and compiled.text == self.template_text:
+                _compiled_templates.move_to_end(key)
+                return compiled
+        try:
+            param_names = list(parse_params(self.template_text))
+        except ParsingError:
+            param_names = []
+        compiled = CompiledTemplate(self.template_text, param_names)
+        with _compiled_templates_lock:
+            _compiled_templates[key] = compiled
+            while len(_compiled_templates) > COMPILED_TEMPLATES_MAX_SIZE:
+                _compiled_templates.popitem(last=False)
+        return compiled
+
+    def check_param_combinations(
+        self, max_combinations: int = MAX_CHECKED_PARAM_COMBINATIONS
+    ) -> None:
+        """Generates the question from every combination of parameter values and records which
+        are valid, why the others aren't and which generate the same question text.
+
+        Templates which can't be parsed or have more than `max_combinations` combinations are left
+        unchecked. Templates with no valid combinations are deactivated.
+        """
+        self.valid_params_bitmap = None
+        self.param_errors = {}
+        self.duplicate_question_groups = []
+        self.params_checked_hash = self.template_text_hash
+        try:
+            param_options = parse_params(self.template_text)
+        except ParsingError:
+            return
+        num_combinations = num_param_combinations(param_options)
+        if num_combinations > max_combinations:
+            return
+
+        value_strings = param_value_strings(param_options)
+        combinations = [
+            params_from_combination_index(value_strings, index) for index in range(num_combinations)
+        ]
+        combinations_by_question_text: Dict[str, List[int]] = {}
+        for index, rendered in enumerate(self.render_texts(combinations)):
+            try:
+                question = self.question_from_body(parse_rendered(rendered), combinations[index])
+            except (Exception, ParsingError) as error:
+                self.param_errors[str(index)] = f"{type(error).__name__}: {error}"
+                continue
+            if question is None:
+                self.param_errors[str(index)] = "Answers aren't all different"
+                continue
+            combinations_by_question_text.setdefault(question["question_text"], []).append(index)
+
+        self.duplicate_question_groups = [
+            indices for indices in combinations_by_question_text.values() if len(indices) > 1
+        ]
+        self.valid_params_bitmap = combinations_bitmap(
+            [indices[0] for indices in combinations_by_question_text.values()], num_combinations
+        )
+        if self.active and not any(self.valid_params_bitmap):
+            warnings.warn(f"No parameter combinations of {self.id} are valid - deactivating it")
+            self.active = False
+
+    def save(self, *args, **kwargs) -> None:
+        update_fields = kwargs.get("update_fields")
+        # Saves of other fields (e.g. deactivating a broken template) don't check the template, as
+        #  that renders every combination
+        if self.params_checked_hash != self.template_text_hash and (
+            update_fields is None or "template_text" in update_fields
+        ):
+            self.check_param_combinations()
+            if update_fields is not None:
+                kwargs["update_fields"] = [*update_fields, *self.PARAM_CHECK_FIELDS, "active"]
+        super(QuestionTemplate, self).save(*args, **kwargs)
+
+    def render_texts(
+        self, combinations: List[SampledParamsDict]
+    ) -> List[Union[str, BaseException]]:
+        """The template text rendered with each combination of parameter values, or the error
+        rendering it raised. Rendered in the template sandbox's workers in one request if
+        `TEMPLATE_SANDBOX_WORKERS` is set."""
+        compiled = self.compiled_template
+        if TEMPLATE_SANDBOX_WORKERS > 0:
+            return get_template_sandbox(TEMPLATE_SANDBOX_WORKERS).render(
+                self.template_text, compiled.param_names, combinations
+            )
+        rendered: List[Union[str, BaseException]] = []
+        for sampled_params in combinations:
+            try:
+                rendered.append(compiled.render(sampled_params))
+            except (Exception, ParsingError) as error:
+                rendered.append(error)
+        return rendered
+
+    def rendered_body(self, sampled_params: SampledParamsDict) -> QuestionBody:
+        """The question body rendered with these parameter values. Kept in this process and the
+        cache by template id, `last_updated` and parameter values, along with the hash of the
+        template text it was rendered from (as unsaved edits don't change `last_updated`)."""
+        key = rendered_body_key(self, sampled_params)
+        text_hash = self.template_text_hash
+        with _rendered_bodies_lock:
+            cached = _rendered_bodies.get(key)
+            if cached is not None:
+                _rendered_bodies.move_to_end(key)
+        if cached is None:
+            cached = cache.get(key)
+        if cached is None or cached[0] != text_hash:
+            cached = (text_hash, parse_rendered(self.render_texts([sampled_params])[0]))
+            cache.set(key, cached, timeout=RENDERED_BODY_TIMEOUT)
+        with _rendered_bodies_lock:
+            _rendered_bodies[key] = cached
+            while len(_rendered_bodies) > RENDERED_BODIES_MAX_SIZE:
+                _rendered_bodies.popitem(last=False)
+        return cached[1]
+
+    def render_question(
+        self,
+        sampled_params: SampledParamsDict,
+        prerequisite_concept: bool = False,
+        answer_letters: Optional[List[str]] = None,
+    ) -> Optional[Dict[str, Any]]:
+        """Gets the question dictionary generated with these parameter values, or None if its
+        answers aren't all different. See `question_from_body()` for `answer_letters`."""
+        return self.question_from_body(
+            self.rendered_body(sampled_params), sampled_params, prerequisite_concept, answer_letters
+        )
+
+    def question_from_body(
+        self,
+        body: QuestionBody,
+        sampled_params: SampledParamsDict,
+        prerequisite_concept: bool = False,
+        answer_letters: Optional[List[str]] = None,
+    ) -> Optional[Dict[str, Any]]:
+        """Gets the question dictionary from the question body rendered with these parameter
+        values, with its answers in the order of `answer_letters` - or shuffled if not given or
+        they aren't the body's letters."""
+        question_text, feedback, answers = body
+        # For many question templates, it's possible that 2 answers are the same.
+        # This is a problem because users need to have different answers to pick from!
+        if not self.answers_all_different(answer_list=list(answers.values())):
+            return None
+        if answer_letters is None or sorted(answer_letters) != sorted(answers):
+            answer_letters = list(answers)
+            random.shuffle(answer_letters)
+        return {
+            "title": self.title,
+            "template_id": self.id,
+            "question_text": remove_start_and_end_newlines(question_text),
+            "question_type": self.question_type,
+            "answers_order_randomised": [answers[letter] for letter in answer_letters],
+            # Stored with the question's response, so it's shown in the same order again
+            "answer_letters": answer_letters,
+            "correct_answer": answers[self.correct_answer_letter],
+            "feedback": remove_start_and_end_newlines(feedback),
+            "difficulty": self.difficulty if not prerequisite_concept else PREREQ_QUESTION_DIFF,
+            "params": sampled_params,
+        }
+
     def to_question_json(
         self,
         sampled_params: Optional[SampledParamsDict] = None,
         params_to_avoid: Optional[List[SampledParamsDict]] = None,
         prerequisite_concept: bool = False,
+        param_options: Optional[ParamOptionsDict] = None,
+        invalid_param_combinations: Optional[Set[int]] = None,
+        answer_letters: Optional[List[str]] = None,
     ) -> Optional[Dict[str, Any]]:
         """Gets question dictionary from a template and set of sampled parameters.
 
-        If a question can't be generated, return None.
+        `param_options` are the template's parsed parameters and `invalid_param_combinations` the
+        parameter combinations known not to generate valid questions, if already found (e.g. from
+        the template catalog). Sampled parameters are only drawn from combinations known to be
+        valid, if the template's been checked. If a question can't be generated, return None.
+        `answer_letters` is the order the answers of a question asked before were shown in.
         """
+        if invalid_param_combinations is None and sampled_params is None:
+            invalid_param_combinations = self.invalid_param_combinations
+        params_to_avoid = list(params_to_avoid or [])
         for _ in range(1000):  # This loop is to ensure that multiple answers aren't identical
             if sampled_params is None:
-                parsed_params = parse_params(self.template_text)
-                sampled_params = sample_params(parsed_params, params_to_avoid)
+                if param_options is None:
+                    param_options = parse_params(self.template_text)
+                sampled_params = sample_params(
+                    param_options, params_to_avoid, invalid_param_combinations
+                )
                 if sampled_params is None:
                     return None
-            text_expanded = expand_params_in_text(self.template_text, sampled_params)
-
-            question_text, feedback, answers = parse_template(text_expanded)
-
-            answers_order_randomised = list(answers.values())
-            # For many question templates, it's possible that 2 answers are the same.
-            # This is a problem because users need to have different answers to pick from!
-            if self.answers_all_different(answer_list=answers_order_randomised):
-                random.shuffle(answers_order_randomised)
-                return {
-                    "title": self.title,
-                    "template_id": self.id,
-                    "question_text": remove_start_and_end_newlines(question_text),
-                    "question_type": self.question_type,
-                    "answers_order_randomised": answers_order_randomised,
-                    "correct_answer": answers[self.correct_answer_letter],
-                    "feedback": remove_start_and_end_newlines(feedback),
-                    "difficulty": self.difficulty
-                    if not prerequisite_concept
-                    else PREREQ_QUESTION_DIFF,
-                    "params": sampled_params,
-                }
-            sampled_params = None  # Try again with new params
+            question = self.render_question(sampled_params, prerequisite_concept, answer_letters)
+            if question is not None:
+                return question
+            # Try again with params that haven't been tried
+            params_to_avoid.append(sampled_params)
+            sampled_params = None
         warnings.warn(f"Could not ensure all answers are different for {self.id} after 1000 tries.")
         return None
 
@@ -128,37 +367,53 @@ class QuestionTemplate(UUIDModel):
         return f"{self.id} on {self.concept.cytoscape_id}, {self.question_type}"
 
 
+_compiled_templates: "OrderedDict[Tuple[Any, Any], CompiledTemplate]" = OrderedDict()
+_compiled_templates_lock = threading.Lock()
+_rendered_bodies: "OrderedDict[str, Tuple[str, QuestionBody]]" = OrderedDict()
+_rendered_bodies_lock = threading.Lock()
+
+
+def rendered_body_key(template: QuestionTemplate, sampled_params: SampledParamsDict) -> str:
+    last_updated = template.last_updated.isoformat() if template.last_updated else None
+    params_hash = hashlib.md5(json.dumps(sampled_params, sort_keys=True).encode()).hexdigest()
+    return f"rendered_question:{template.id}:{last_updated}:{params_hash}"
+
+
+def parse_rendered(rendered: Union[str, BaseException]) -> QuestionBody:
+    """Parses the template text rendered by `QuestionTemplate.render_texts()`, raising the error if
+    rendering it failed."""
+    if isinstance(rendered, BaseException):
+        raise rendered
+    return parse_template(rendered)
+
+
 def parse_template(text: str) -> Tuple[str, str, Dict[str, str]]:
     answers: Dict[str, str] = {}
-    question_text, feedback, is_feedback, current_answer = "", "", False, ""
+    question_lines, feedback_lines, is_feedback, current_answer = [], [], False, ""
     for line in text.splitlines():
-        if not is_param_line(line):  # Ignore param lines
-            is_feedback = is_feedback or says_feedback(line)
-            regex = answer_regex(line)
-            # Allow for answers spanning multiple lines - remember if it's on an answer from previous line
-            current_answer = (
-                regex.groups()[0].lower()
-                if (regex is not None)
-                else current_answer
-                if not is_feedback
-                else ""
-            )
-            if not current_answer and not is_feedback:
-                question_text += line + "\n"
-            elif current_answer:
-                # Add new line to prev line if answer spans multiple lines
-                prev_answer_line = (
-                    f"{current_answer}) {answers[current_answer]}"
-                    if answers.get(current_answer)
-                    else ""
-                )
-                regex = answer_regex(prev_answer_line + line)
-                assert (
-                    regex is not None
-                ), f"This is a bug. This should enInvalid answer line: {prev_answer_line + line}"
-                answers[current_answer] = regex.groups()[1]
-            elif is_feedback and not says_feedback(line):  # skip the word 'feedback'
-                feedback += line + "\n"
+        if is_param_line(line):  # Ignore param lines
+            continue
+        line_says_feedback = says_feedback(line)
+        is_feedback = is_feedback or line_says_feedback
+        regex = answer_regex(line)
+        # Allow for answers spanning multiple lines - remember if it's on an answer from previous line
+        current_answer = (
+            regex.groups()[0].lower()
+            if (regex is not None)
+            else current_answer
+            if not is_feedback
+            else ""
+        )
+        if not current_answer and not is_feedback:
+            question_lines.append(line + "\n")
+        elif current_answer in answers:
+            # Add line to the answer if it spans multiple lines (or its letter is repeated)
+            answers[current_answer] += line
+        elif current_answer:
+            answers[current_answer] = regex.groups()[1]
+        elif not line_says_feedback:  # skip the word 'feedback'
+            feedback_lines.append(line + "\n")
+    question_text, feedback = "".join(question_lines), "".join(feedback_lines)
 
     # Remove zero width spaces
     question_text = question_text.replace("\u200b", "")
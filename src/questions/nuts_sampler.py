@@ -0,0 +1,207 @@
+"""NUTS sampler for the knowledge state, theta, built on JAX and numpyro.
+
+Importing this imports JAX and numpyro, so it's only imported when NUTS is first run - use
+`questions.inference.load_nuts_sampler()` rather than importing it directly.
+"""
+from functools import partial
+from typing import Callable, Optional, Tuple
+
+import numpy as np
+
+import jax
+import jax.numpy as jnp
+import numpyro
+import numpyro.distributions as dist
+from jax import lax, random
+from numpyro import handlers, plate, sample
+from numpyro.diagnostics import effective_sample_size, split_gelman_rubin
+from numpyro.infer.hmc import HMCState, hmc
+from numpyro.infer.util import potential_energy
+
+from questions.inference import MISTAKE_PROB, SPECIAL_K
+
+
+def answers_model(
+    prior_mean: float,
+    prior_std_dev: float,
+    difficulties: np.ndarray,
+    guess_probabilities: np.ndarray,
+    answers: Optional[np.ndarray] = None,
+    mask: Optional[np.ndarray] = None,
+):
+    """
+    Numpyro model for learner answers. Can either be used for observed data (answers present) or to
+     predict new data (answers = None).
+
+    The prior is given as 2 floats rather than `GaussianParams` so all arguments can be traced by
+     JAX, letting a compiled kernel be reused with new arguments.
+
+    Args:
+        prior_mean: prior mean over knowledge state
+        prior_std_dev: prior standard deviation over knowledge state
+        difficulties: Question difficulties
+        guess_probabilities: Probability of correctly guessing the answer
+        answers: None if generative, otherwise the array of answers. 1 is correct and 0 incorrect
+        mask: None if all observations are real, otherwise a bool array - False for padding
+    """
+    theta = sample("theta", dist.Normal(prior_mean, prior_std_dev))
+
+    p = guess_probabilities + (1 - guess_probabilities - MISTAKE_PROB) / (
+        1 + jnp.exp((difficulties - theta) * SPECIAL_K)
+    )
+
+    with plate("data", len(difficulties)), handlers.mask(mask=True if mask is None else mask):
+        return sample("obs", dist.Bernoulli(p), obs=answers)
+
+
+def answers_potential_fn_gen(*model_args) -> Callable:
+    """Gets the potential energy (negative log-density) of `answers_model`'s latent variables for
+    the model args given. Used so the model args can be passed to the compiled NUTS sampler."""
+    return lambda params: potential_energy(answers_model, model_args, {}, params)
+
+
+def sample_nuts(
+    num_warmup: int,
+    num_samples: int,
+    rng_key: jnp.ndarray,
+    init_theta: jnp.ndarray,
+    step_size: jnp.ndarray,
+    inverse_mass_matrix: jnp.ndarray,
+    *model_args,
+) -> Tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray, jnp.ndarray, jnp.ndarray]:
+    """NUTS sampler for `answers_model`. Use the compiled versions, `run_nuts` and `run_nuts_batch`.
+
+    Args:
+        num_warmup: number of warmup samples to take, adapting the step size and mass matrix
+        num_samples: number of samples of theta to return
+        rng_key: JAX random key
+        init_theta: value of theta the chain starts at
+        step_size: initial step size, before adaptation
+        inverse_mass_matrix: initial diagonal inverse mass matrix (1,), before adaptation
+        model_args: args of `answers_model`, with padded observations
+
+    Returns: samples of theta (num_samples,), whether each sample diverged (num_samples,), and the
+     adapted step size, adapted inverse mass matrix and last sample of theta
+    """
+    init_kernel, sample_kernel = hmc(potential_fn_gen=answers_potential_fn_gen, algo="NUTS")
+    hmc_state = init_kernel(
+        {"theta": init_theta},
+        num_warmup=num_warmup,
+        step_size=step_size,
+        inverse_mass_matrix=inverse_mass_matrix,
+        model_args=model_args,
+        rng_key=rng_key,
+    )
+
+    def sample_theta(state, _):
+        state = sample_kernel(state, model_args=model_args)
+        return state, (state.z["theta"], state.diverging)
+
+    hmc_state, (theta_samples, diverging) = lax.scan(
+        sample_theta, hmc_state, None, length=num_warmup + num_samples
+    )
+    return (
+        theta_samples[num_warmup:],
+        diverging[num_warmup:],
+        hmc_state.adapt_state.step_size,
+        hmc_state.adapt_state.inverse_mass_matrix,
+        hmc_state.z["theta"],
+    )
+
+
+# Compiled once per shape of the model args
+run_nuts = jax.jit(sample_nuts, static_argnums=(0, 1))
+# Vectorised over a batch of independent problems - all args but num_warmup and num_samples have a
+#  leading batch dimension, as do the outputs
+run_nuts_batch = jax.jit(
+    jax.vmap(sample_nuts, in_axes=(None, None) + (0,) * 10), static_argnums=(0, 1)
+)
+# As `run_nuts_batch`, but each item in the batch runs on its own JAX device
+run_nuts_parallel = jax.pmap(
+    sample_nuts, in_axes=(None, None) + (0,) * 10, static_broadcasted_argnums=(0, 1)
+)
+
+
+@partial(jax.jit, static_argnums=(0,))
+def run_nuts_warmup(
+    num_warmup: int,
+    rng_key: jnp.ndarray,
+    init_theta: jnp.ndarray,
+    step_size: jnp.ndarray,
+    inverse_mass_matrix: jnp.ndarray,
+    *model_args,
+) -> HMCState:
+    """Only the warmup phase of `run_nuts` - see its args. Returns the NUTS state after warmup, for
+    `continue_nuts()` to take samples from."""
+    init_kernel, sample_kernel = hmc(potential_fn_gen=answers_potential_fn_gen, algo="NUTS")
+    hmc_state = init_kernel(
+        {"theta": init_theta},
+        num_warmup=num_warmup,
+        step_size=step_size,
+        inverse_mass_matrix=inverse_mass_matrix,
+        model_args=model_args,
+        rng_key=rng_key,
+    )
+    return lax.fori_loop(
+        0, num_warmup, lambda _, state: sample_kernel(state, model_args=model_args), hmc_state
+    )
+
+
+@partial(jax.jit, static_argnums=(0,))
+def continue_nuts(
+    num_samples: int, hmc_state: HMCState, *model_args
+) -> Tuple[HMCState, jnp.ndarray, jnp.ndarray]:
+    """Takes more samples from a NUTS chain after its warmup, without adapting it any further.
+
+    Returns: the NUTS state after sampling, samples of theta (num_samples,) and whether each sample
+     diverged (num_samples,)
+    """
+    init_kernel, sample_kernel = hmc(potential_fn_gen=answers_potential_fn_gen, algo="NUTS")
+    # Only run to set up sample_kernel(). Without warmup or adaptation, it doesn't change the state
+    init_kernel(
+        hmc_state.z,
+        num_warmup=0,
+        step_size=hmc_state.adapt_state.step_size,
+        inverse_mass_matrix=hmc_state.adapt_state.inverse_mass_matrix,
+        adapt_step_size=False,
+        adapt_mass_matrix=False,
+        model_args=model_args,
+        rng_key=hmc_state.rng_key,
+    )
+
+    def sample_theta(state, _):
+        state = sample_kernel(state, model_args=model_args)
+        return state, (state.z["theta"], state.diverging)
+
+    hmc_state, (theta_samples, diverging) = lax.scan(
+        sample_theta, hmc_state, None, length=num_samples
+    )
+    return hmc_state, theta_samples, diverging
+
+
+def theta_diagnostics(theta_samples: np.ndarray) -> Tuple[float, float]:
+    """Effective sample size and split R-hat of samples of theta, from one chain (num_samples,) or
+    across several (num_chains, num_samples)."""
+    # The diagnostics expect a leading chains dimension
+    theta_samples = np.atleast_2d(theta_samples)
+    return (
+        float(effective_sample_size(theta_samples)),
+        float(split_gelman_rubin(theta_samples)),
+    )
+
+
+def rng_key(seed: int) -> jnp.ndarray:
+    return random.PRNGKey(seed)
+
+
+def rng_keys(seed: int, num_keys: int) -> jnp.ndarray:
+    """Independent random keys for each item in a batch (num_keys, 2)."""
+    return random.split(random.PRNGKey(seed), num_keys)
+
+
+def local_device_count() -> int:
+    return jax.local_device_count()
+
+
+def set_host_device_count(num_devices: int) -> None:
+    numpyro.set_host_device_count(num_devices)
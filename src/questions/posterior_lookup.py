@@ -0,0 +1,102 @@
+"""Memo of inferred posteriors, keyed on everything the posterior depends on.
+
+Answers are independent given theta, so the posterior depends only on the prior and how many
+answers fall in each (difficulty, guess probability, correct) cell - not their order. Difficulties
+are small integers and guess probabilities are 1/2 or 1/4, so there are few distinct cell counts.
+Keying on the prior's bucket rather than its exact value means most answers can be served from the
+memo without running inference.
+
+Inference is always run on the exact prior. The first posterior memoized for a bucket is served for
+every other prior in it, so a hit can be for a prior up to half a bucket away in mean and std dev.
+"""
+
+import threading
+from collections import Counter, OrderedDict
+from typing import Hashable, Optional, Tuple
+
+import numpy as np
+
+from questions.inference import GaussianParams, Posterior, WeightedThetaPosterior
+
+# Prior means and standard deviations are bucketed to the nearest multiple of this. For priors with
+#  std devs of at least 1 (as at the start of each batch) which the answers don't contradict,
+#  moving the prior within a bucket moves the posterior mean and std dev by less than half this
+POSTERIOR_LOOKUP_PRIOR_RESOLUTION = 0.05
+# Number of posteriors kept - each takes up to ~8KB
+POSTERIOR_LOOKUP_MAX_SIZE = 4096
+
+# Prior, theta values, their weights and the number of observations
+_PosteriorEntry = Tuple[GaussianParams, np.ndarray, np.ndarray, int]
+
+
+def prior_bucket(prior: GaussianParams) -> Tuple[int, int]:
+    """The bucket of the prior's mean and std dev. Std devs round up to at least one bucket, so
+    priors with no spread share a bucket with the narrowest others."""
+    return (
+        round(prior.mean / POSTERIOR_LOOKUP_PRIOR_RESOLUTION),
+        max(round(prior.std_dev / POSTERIOR_LOOKUP_PRIOR_RESOLUTION), 1),
+    )
+
+
+class PosteriorLookup:
+    """Least-recently-used memo from (engine, prior bucket, answer cell counts) to posteriors."""
+
+    def __init__(self, max_size: int = POSTERIOR_LOOKUP_MAX_SIZE):
+        self.max_size = max_size
+        self._posteriors: "OrderedDict[Hashable, _PosteriorEntry]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0}
+
+    @staticmethod
+    def key(
+        engine_name: str,
+        prior: GaussianParams,
+        difficulties: np.ndarray,
+        guess_probs: np.ndarray,
+        answers: np.ndarray,
+    ) -> Hashable:
+        """The key of the posterior of the answers given, from the engine given."""
+        cell_counts = Counter(
+            zip(
+                np.asarray(difficulties, dtype=float).tolist(),
+                np.round(np.asarray(guess_probs, dtype=float), 6).tolist(),
+                np.asarray(answers, dtype=int).tolist(),
+            )
+        )
+        return (engine_name, prior_bucket(prior), tuple(sorted(cell_counts.items())))
+
+    def get(self, key: Hashable) -> Optional[Posterior]:
+        with self._lock:
+            entry = self._posteriors.get(key)
+            self.stats["hits" if entry is not None else "misses"] += 1
+            if entry is None:
+                return None
+            self._posteriors.move_to_end(key)
+        prior, theta, weights, num_observations = entry
+        return WeightedThetaPosterior(
+            prior,
+            theta=theta.astype(float),
+            weights=weights.astype(float),
+            num_observations=num_observations,
+        )
+
+    def put(self, key: Hashable, posterior: Posterior) -> None:
+        theta, weights = posterior.theta_weights
+        entry = (
+            posterior.theta_prior,
+            np.asarray(theta, dtype=np.float32),
+            np.asarray(weights, dtype=np.float32),
+            posterior.num_observations,
+        )
+        with self._lock:
+            self._posteriors[key] = entry
+            self._posteriors.move_to_end(key)
+            while len(self._posteriors) > self.max_size:
+                self._posteriors.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._posteriors)
+
+
+# Shared by every request served by this process
+POSTERIOR_LOOKUP = PosteriorLookup()
@@ -1,11 +1,13 @@
-from typing import Any, Dict
+from typing import Any, Dict, List, Optional
 from uuid import UUID, uuid4
 
 from django.core.cache import cache
 
 from accounts.models import User
+from questions.inference import NUTSAdaptationState, Posterior
 from questions.models import QuestionResponse
 from questions.models.question_batch import QuestionBatch
+from questions.template_weights import QuestionCounts
 
 DEBUG = False
 
@@ -55,6 +57,18 @@ class QuestionBatchCacheManager:
     def _batch_json_key(self) -> str:
         return f"question_json:{self.question_batch_id}"
 
+    @property
+    def _posterior_key(self) -> str:
+        return f"posterior:{self.question_batch_id}"
+
+    @property
+    def _adaptation_state_key(self) -> str:
+        return f"adaptation_state:{self.question_batch_id}"
+
+    @property
+    def _question_counts_key(self) -> str:
+        return f"question_counts:{self.question_batch_id}"
+
     @property
     def q_batch_json(self) -> Dict[str, Any]:
         self._ensure_memory_fresh()
@@ -81,11 +95,52 @@ class QuestionBatchCacheManager:
     def max_num_questions(self) -> int:
         return self._q_batch_json["max_num_questions"]
 
+    @property
+    def posterior(self) -> Optional[Posterior]:
+        """The knowledge state posterior after the answers given so far, if stored.
+
+        This is the prior for the next answer given.
+        """
+        return cache.get(self._posterior_key)
+
+    def set_posterior(self, posterior: Posterior) -> None:
+        cache.set(self._posterior_key, posterior, timeout=1200)
+
+    @property
+    def adaptation_state(self) -> Optional[NUTSAdaptationState]:
+        """The inference engine's adaptation state after the last answer, if stored. Warm-starts
+        inference for the next answer."""
+        return cache.get(self._adaptation_state_key)
+
+    def set_adaptation_state(self, adaptation_state: Optional[NUTSAdaptationState]) -> None:
+        if adaptation_state is not None:
+            cache.set(self._adaptation_state_key, adaptation_state, timeout=1200)
+
+    @property
+    def question_counts(self) -> QuestionCounts:
+        """Counts of the questions asked so far, by template and question type. Kept up to date by
+        `add_question_asked()`, so they don't need recounting from all the questions."""
+        questions = self.q_batch_json["questions"]
+        question_counts = cache.get(self._question_counts_key)
+        if question_counts is None or question_counts.num_questions != len(questions):
+            question_counts = QuestionCounts.from_questions(questions)
+            cache.set(self._question_counts_key, question_counts, timeout=1200)
+        return question_counts
+
     def add_question_asked(self, question_json: Dict[str, Any]):
+        self.add_questions_asked([question_json])
+
+    def add_questions_asked(self, question_jsons: List[Dict[str, Any]]):
         if DEBUG:
-            print(f"Adding question asked {question_json['id']}")
+            print(
+                f"Adding questions asked {[question_json.get('id') for question_json in question_jsons]}"
+            )
         self._ensure_memory_fresh()
-        self._q_batch_json["questions"].append(question_json)
+        question_counts = self.question_counts
+        for question_json in question_jsons:
+            self._q_batch_json["questions"].append(question_json)
+            question_counts.add(question_json)
+        cache.set(self._question_counts_key, question_counts, timeout=1200)
         self._set_cache()
 
     def add_question_answered(self, q_response: QuestionResponse):
@@ -0,0 +1,322 @@
+"""Pools of questions rendered ahead of time for each question template.
+
+Rendering a question runs the Python in each of its template's <<>> expressions, so pool workers
+render questions in the background and question selection takes them from the pool. When a
+template's pool falls below its low-water mark, its concept is queued for the workers to top up
+the pools of all the concept's templates. If a pool has no question that can be asked, selection
+renders one itself.
+
+Start a worker with `python manage.py run_question_pool_workers`.
+"""
+import json
+import queue
+import threading
+import time
+import warnings
+from abc import ABC, abstractmethod
+from typing import Any, Dict, List, Optional, Tuple
+
+import redis
+
+from questions.models.question_template import PREREQ_QUESTION_DIFF, QuestionTemplate
+from questions.template_parser import ParsingError
+from questions.utils import SampledParamsDict
+
+# Number of questions rendered ahead of time for each template
+QUESTION_POOL_SIZE = 20
+# When fewer questions than this are left in a template's pool, its concept's pools are topped up
+QUESTION_POOL_LOW_WATER_MARK = 5
+# Questions taken from a pool at once - those already asked in the question batch are put back
+QUESTION_POOL_TAKE_SIZE = 5
+# Pools of templates which aren't used expire
+QUESTION_POOL_EXPIRY_SECS = 60 * 60 * 24
+# Concepts whose refill hasn't finished within this time (e.g. its worker was killed) can be queued
+#  to be refilled again
+QUESTION_POOL_REFILL_EXPIRY_SECS = 60 * 10
+
+QUESTION_POOL_REFILLS_KEY = "question_pool_refills"
+QUESTION_POOL_STATS_KEY = "question_pool_stats"
+
+
+def question_pool_key(template: QuestionTemplate) -> str:
+    """Key of the template's pool. Changes when the template is edited, so questions rendered
+    from an old version aren't asked."""
+    return f"question_pool:{template.id}:{template.last_updated.isoformat()}"
+
+
+def question_pool_refill_key(concept_id: str) -> str:
+    """Key of the time the concept's pools were queued to be refilled, set until they're
+    refilled."""
+    return f"question_pool_refill:{concept_id}"
+
+
+class QuestionPool(ABC):
+    """Stores pre-rendered questions, requests to refill them and pool statistics."""
+
+    @abstractmethod
+    def take(self, key: str, max_questions: int) -> Tuple[List[Dict[str, Any]], int]:
+        """Takes up to `max_questions` questions from the pool.
+
+        Returns: the questions taken and the number left in the pool
+        """
+
+    @abstractmethod
+    def put(self, key: str, questions: List[Dict[str, Any]]) -> None:
+        """Adds the questions to the end of the pool."""
+
+    @abstractmethod
+    def size(self, key: str) -> int:
+        """Number of questions in the pool."""
+
+    @abstractmethod
+    def request_refill(self, concept_id: str) -> None:
+        """Queues the concept's pools to be refilled, unless they were queued less than
+        `QUESTION_POOL_REFILL_EXPIRY_SECS` ago and haven't been refilled yet."""
+
+    @abstractmethod
+    def pop_refill_request(self, timeout: float) -> Optional[Tuple[str, float]]:
+        """Blocks until a concept is queued to be refilled, or returns None after `timeout`
+        seconds.
+
+        Returns: the concept's id and the time its refill was requested
+        """
+
+    @abstractmethod
+    def finish_refill(self, concept_id: str) -> None:
+        """Marks the concept's pools as refilled, so they can be queued again."""
+
+    @abstractmethod
+    def record(self, stat: str, amount: float = 1) -> None:
+        """Adds `amount` to the statistic."""
+
+    @abstractmethod
+    def stats(self) -> Dict[str, float]:
+        """Every statistic recorded."""
+
+
+class RedisQuestionPool(QuestionPool):
+    """Pools shared by all processes, stored as Redis lists of question JSON."""
+
+    def __init__(self, redis_url: str):
+        self._redis = redis.Redis.from_url(redis_url)
+
+    def take(self, key: str, max_questions: int) -> Tuple[List[Dict[str, Any]], int]:
+        pipeline = self._redis.pipeline(transaction=True)
+        pipeline.lrange(key, 0, max_questions - 1)
+        pipeline.ltrim(key, max_questions, -1)
+        pipeline.llen(key)
+        taken, _, num_left = pipeline.execute()
+        return [json.loads(question) for question in taken], num_left
+
+    def put(self, key: str, questions: List[Dict[str, Any]]) -> None:
+        pipeline = self._redis.pipeline(transaction=True)
+        pipeline.rpush(key, *[json.dumps(question, default=str) for question in questions])
+        pipeline.expire(key, QUESTION_POOL_EXPIRY_SECS)
+        pipeline.execute()
+
+    def size(self, key: str) -> int:
+        return self._redis.llen(key)
+
+    def request_refill(self, concept_id: str) -> None:
+        if self._redis.set(
+            question_pool_refill_key(concept_id),
+            time.time(),
+            nx=True,
+            ex=QUESTION_POOL_REFILL_EXPIRY_SECS,
+        ):
+            self._redis.rpush(QUESTION_POOL_REFILLS_KEY, concept_id)
+
+    def pop_refill_request(self, timeout: float) -> Optional[Tuple[str, float]]:
+        popped = self._redis.blpop([QUESTION_POOL_REFILLS_KEY], timeout=timeout)
+        if popped is None:
+            return None
+        concept_id = popped[1].decode()
+        request_time = self._redis.get(question_pool_refill_key(concept_id))
+        return concept_id, float(request_time) if request_time is not None else time.time()
+
+    def finish_refill(self, concept_id: str) -> None:
+        self._redis.delete(question_pool_refill_key(concept_id))
+
+    def record(self, stat: str, amount: float = 1) -> None:
+        self._redis.hincrbyfloat(QUESTION_POOL_STATS_KEY, stat, amount)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            stat.decode(): float(value)
+            for stat, value in self._redis.hgetall(QUESTION_POOL_STATS_KEY).items()
+        }
+
+
+class LocalQuestionPool(QuestionPool):
+    """In-process stand-in for `RedisQuestionPool`, for tests and local development."""
+
+    def __init__(self):
+        self._pools: Dict[str, List[Dict[str, Any]]] = {}
+        self._refills: "queue.Queue[str]" = queue.Queue()
+        self._refill_times: Dict[str, float] = {}
+        self._stats: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def take(self, key: str, max_questions: int) -> Tuple[List[Dict[str, Any]], int]:
+        with self._lock:
+            pool = self._pools.get(key, [])
+            self._pools[key] = pool[max_questions:]
+            return pool[:max_questions], len(self._pools[key])
+
+    def put(self, key: str, questions: List[Dict[str, Any]]) -> None:
+        with self._lock:
+            self._pools.setdefault(key, []).extend(questions)
+
+    def size(self, key: str) -> int:
+        return len(self._pools.get(key, []))
+
+    def request_refill(self, concept_id: str) -> None:
+        with self._lock:
+            secs_since_requested = time.time() - self._refill_times.get(concept_id, 0)
+            if secs_since_requested < QUESTION_POOL_REFILL_EXPIRY_SECS:
+                return
+            self._refill_times[concept_id] = time.time()
+        self._refills.put(concept_id)
+
+    def pop_refill_request(self, timeout: float) -> Optional[Tuple[str, float]]:
+        try:
+            concept_id = self._refills.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        return concept_id, self._refill_times.get(concept_id, time.time())
+
+    def finish_refill(self, concept_id: str) -> None:
+        with self._lock:
+            self._refill_times.pop(concept_id, None)
+
+    def record(self, stat: str, amount: float = 1) -> None:
+        with self._lock:
+            self._stats[stat] = self._stats.get(stat, 0) + amount
+
+    def stats(self) -> Dict[str, float]:
+        return dict(self._stats)
+
+
+def take_question(
+    pool: QuestionPool,
+    template: QuestionTemplate,
+    params_to_avoid: List[SampledParamsDict],
+    prerequisite_concept: bool = False,
+) -> Optional[Dict[str, Any]]:
+    """Takes a pre-rendered question from the template's pool whose parameters aren't in
+    `params_to_avoid`, or returns None if there isn't one. Queues the template's concept to be
+    refilled if its pool is running low."""
+    key = question_pool_key(template)
+    questions, num_left = pool.take(key, QUESTION_POOL_TAKE_SIZE)
+    question = next((q for q in questions if q["params"] not in params_to_avoid), None)
+    put_back = [q for q in questions if q is not question]
+    if put_back:
+        pool.put(key, put_back)
+    if num_left + len(put_back) < QUESTION_POOL_LOW_WATER_MARK:
+        pool.request_refill(template.concept.cytoscape_id)
+
+    pool.record("hits" if question is not None else "misses")
+    if question is None:
+        return None
+    question["template_id"] = template.id
+    if prerequisite_concept:
+        question["difficulty"] = PREREQ_QUESTION_DIFF
+    return question
+
+
+def refill_template_pool(pool: QuestionPool, template: QuestionTemplate) -> int:
+    """Renders questions with different parameters until the template's pool is full.
+
+    Returns: the number of questions rendered
+    """
+    key = question_pool_key(template)
+    questions: List[Dict[str, Any]] = []
+    try:
+        for _ in range(QUESTION_POOL_SIZE - pool.size(key)):
+            question = template.to_question_json(
+                params_to_avoid=[question["params"] for question in questions]
+            )
+            if question is None:
+                break
+            questions.append(question)
+    except (Exception, ParsingError) as e:
+        warnings.warn(f"Could not render questions from {template.id} for its pool. Error: {e}")
+    if questions:
+        pool.put(key, questions)
+    return len(questions)
+
+
+def refill_concept_pools(pool: QuestionPool, concept_id: str, request_time: float) -> None:
+    """Refills the pools of the concept's active templates and records how long after the refill
+    was requested they were full. The concept can be queued again afterwards, even if it failed."""
+    try:
+        num_rendered = sum(
+            refill_template_pool(pool, template)
+            for template in QuestionTemplate.objects.filter(
+                concept__cytoscape_id=concept_id, active=True
+            ).select_related("concept")
+        )
+    finally:
+        pool.finish_refill(concept_id)
+    pool.record("refills")
+    pool.record("questions_rendered", num_rendered)
+    pool.record("refill_lag_secs", time.time() - request_time)
+
+
+def question_pool_stats(pool: QuestionPool) -> Dict[str, float]:
+    """Pool hit rate and mean time from requesting a concept's pools be refilled to them being
+    full, along with the raw counts."""
+    stats = pool.stats()
+    num_takes = stats.get("hits", 0) + stats.get("misses", 0)
+    num_refills = stats.get("refills", 0)
+    return {
+        **stats,
+        "hit_rate": stats.get("hits", 0) / num_takes if num_takes else 0.0,
+        "mean_refill_lag_secs": (
+            stats.get("refill_lag_secs", 0) / num_refills if num_refills else 0.0
+        ),
+    }
+
+
+class QuestionPoolWorker:
+    """Takes requests to refill concepts' pools from the queue and refills them."""
+
+    def __init__(self, pool: QuestionPool):
+        self.pool = pool
+
+    def run_once(self, timeout: float = 1) -> bool:
+        """Refills a concept's pools if requested within `timeout` seconds. Returns whether any
+        were refilled."""
+        request = self.pool.pop_refill_request(timeout=timeout)
+        if request is None:
+            return False
+        refill_concept_pools(self.pool, *request)
+        return True
+
+    def run_forever(self) -> None:
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                warnings.warn(f"Question pool worker failed to refill pools. Error: {e}")
+
+
+# Pools by URL, so each process makes one Redis connection pool per URL
+_question_pools: Dict[str, QuestionPool] = {}
+_question_pools_lock = threading.Lock()
+
+
+def get_question_pool(question_pool_url: str) -> QuestionPool:
+    """Gets the question pool for the URL, made once per process. "local" gives an in-process pool
+    refilled by a worker running in a background thread."""
+    with _question_pools_lock:
+        pool = _question_pools.get(question_pool_url)
+        if pool is None:
+            if question_pool_url == "local":
+                pool = LocalQuestionPool()
+                worker = QuestionPoolWorker(pool)
+                threading.Thread(target=worker.run_forever, daemon=True).start()
+            else:
+                pool = RedisQuestionPool(question_pool_url)
+            _question_pools[question_pool_url] = pool
+    return pool
@@ -0,0 +1,152 @@
+"""Benchmarks of rendering question templates and parsing their parameter lines, run with
+`python manage.py benchmark_templates`.
+
+By default templates are rendered from `questions/tests/template_test_data.py`.
+"""
+
+import re
+import time
+from dataclasses import dataclass
+from typing import Callable, List, Optional, Sequence, Tuple
+
+from questions.template_parser import (
+    STRING_REGEX,
+    CompiledTemplate,
+    expand_params_in_text,
+    num_param_combinations,
+    param_value_strings,
+    params_from_combination_index,
+    parse_params,
+    split_param_line,
+)
+from questions.tests import template_test_data
+from questions.utils import SampledParamsDict
+
+# Parameter combinations each template is rendered with
+BENCHMARK_MAX_COMBINATIONS = 100
+# Number of items in the lists of the parameter lines parsed
+BENCHMARK_LIST_ITEMS = [5, 10, 15, 20, 100, 1000, 10000]
+
+# The regex parameter lines were matched with before `split_param_line()`, to compare against
+NUMBER_REGEX = r"-?\d+\.?\d*(e-?\d+)?"
+LIST_REGEX = f"\\[(({NUMBER_REGEX}|{STRING_REGEX})+.*,\\s*)*({NUMBER_REGEX}|{STRING_REGEX})]"
+PARAM_ELEMENT_REGEX = f"({NUMBER_REGEX}|{STRING_REGEX}|{LIST_REGEX})"
+PARAM_LINE_REGEX = (
+    r"\s*param\s+([^-{}:@&%$£?!~#+=,]+):\s*({("
+    + PARAM_ELEMENT_REGEX
+    + ",\\s*)*"
+    + PARAM_ELEMENT_REGEX
+    + "})\\s*"
+)
+
+
+@dataclass
+class RenderingBenchmark:
+    name: str
+    num_expressions: int
+    # Renders per second substituting values into the text of each <<>> expression and running it
+    text_renders_per_sec: float
+    # Renders per second of the compiled template, and how long it took to compile
+    compiled_renders_per_sec: float
+    compile_ms: float
+
+    @property
+    def speedup(self) -> float:
+        return self.compiled_renders_per_sec / self.text_renders_per_sec
+
+
+def test_data_templates() -> List[Tuple[str, str]]:
+    """Names and texts of the templates in `template_test_data.py`."""
+    return [
+        (name, value.QUESTION_TEMPLATE_STRING)
+        for name, value in vars(template_test_data).items()
+        if hasattr(value, "QUESTION_TEMPLATE_STRING")
+    ]
+
+
+def renders_per_sec(
+    render: Callable[[SampledParamsDict], str],
+    combinations: Sequence[SampledParamsDict],
+    min_secs: float,
+) -> float:
+    """Renders each combination in turn until at least `min_secs` have passed."""
+    num_renders, start_time = 0, time.perf_counter()
+    while time.perf_counter() - start_time < min_secs:
+        for sampled_params in combinations:
+            render(sampled_params)
+        num_renders += len(combinations)
+    return num_renders / (time.perf_counter() - start_time)
+
+
+def benchmark_rendering(
+    templates: Sequence[Tuple[str, str]], min_secs: float = 1
+) -> List[RenderingBenchmark]:
+    """Renders each (name, template text) with up to `BENCHMARK_MAX_COMBINATIONS` combinations of
+    its parameters, from its text and compiled, and compares the rendering rates."""
+    benchmarks = []
+    for name, text in templates:
+        param_options = parse_params(text)
+        value_strings = param_value_strings(param_options)
+        combinations = [
+            params_from_combination_index(value_strings, index)
+            for index in range(
+                min(num_param_combinations(param_options), BENCHMARK_MAX_COMBINATIONS)
+            )
+        ]
+        start_time = time.perf_counter()
+        compiled = CompiledTemplate(text, param_options)
+        compile_ms = (time.perf_counter() - start_time) * 1000
+        assert all(
+            compiled.render(sampled_params) == expand_params_in_text(text, sampled_params)
+            for sampled_params in combinations
+        ), f"The compiled template {name} renders different text!"
+        benchmarks.append(
+            RenderingBenchmark(
+                name=name,
+                num_expressions=len(compiled.segments) // 2,
+                text_renders_per_sec=renders_per_sec(
+                    lambda sampled_params: expand_params_in_text(text, sampled_params),
+                    combinations,
+                    min_secs,
+                ),
+                compiled_renders_per_sec=renders_per_sec(compiled.render, combinations, min_secs),
+                compile_ms=compile_ms,
+            )
+        )
+    return benchmarks
+
+
+@dataclass
+class ParamLineBenchmark:
+    num_list_items: int
+    # Time to match the worst case line with the regex, None if it wasn't - each list item doubles it
+    regex_ms: Optional[float]
+    split_ms: float
+
+
+def worst_case_param_line(num_list_items: int) -> str:
+    """A parameter line with a list which isn't closed. The regex tries every way of splitting the
+    list into items before it fails."""
+    return "param A: {[" + ", ".join(["1"] * num_list_items) + " x}"
+
+
+def benchmark_param_lines(
+    num_list_items: Sequence[int] = BENCHMARK_LIST_ITEMS, max_regex_secs: float = 1
+) -> List[ParamLineBenchmark]:
+    """Times `split_param_line()` and the regex it replaced on the worst case line with each number
+    of list items. Once the regex takes over `max_regex_secs`, it isn't run on longer lines."""
+    benchmarks, run_regex = [], True
+    for num_items in sorted(num_list_items):
+        line = worst_case_param_line(num_items)
+        regex_ms = None
+        if run_regex:
+            start_time = time.perf_counter()
+            assert re.fullmatch(PARAM_LINE_REGEX, line) is None
+            regex_ms = (time.perf_counter() - start_time) * 1000
+            run_regex = regex_ms < max_regex_secs * 1000
+        start_time = time.perf_counter()
+        # Unwrapped, so the line isn't found in the cache
+        assert split_param_line.__wrapped__(line) is None
+        split_ms = (time.perf_counter() - start_time) * 1000
+        benchmarks.append(ParamLineBenchmark(num_items, regex_ms, split_ms))
+    return benchmarks
@@ -0,0 +1,100 @@
+"""Compiled catalog of the question templates that question selection chooses between.
+
+Selecting a question needs each template's parameter options, number of possible questions,
+number of answers, difficulty and question type. Parsing these from `template_text` takes regexes
+over every line, so they're compiled once per set of template versions (template id +
+`last_updated`) into arrays. Catalogs are kept in this process and in the cache shared by all
+processes.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Sequence
+
+import numpy as np
+from django.core.cache import cache
+
+from questions.models.question_template import PREREQ_QUESTION_DIFF, QuestionTemplate
+from questions.template_parser import num_param_combinations, parse_params
+from questions.template_weights import TemplateCatalog
+
+TEMPLATE_CATALOG_CACHE_TIMEOUT = 60 * 60 * 24
+# Number of catalogs kept in each process
+TEMPLATE_CATALOG_MAX_SIZE = 1024
+
+# Catalogs found in this process's memory, found in the shared cache and compiled
+TEMPLATE_CATALOG_STATS = {"hits": 0, "cache_hits": 0, "compiles": 0}
+
+
+def template_catalog_key(
+    concept_templates: Sequence[QuestionTemplate], prereq_templates: Sequence[QuestionTemplate]
+) -> str:
+    """Cache key of the catalog of these templates. Changes when any template is edited."""
+    versions = hashlib.md5()
+    for prerequisite, templates in [(False, concept_templates), (True, prereq_templates)]:
+        for template in templates:
+            versions.update(f"{prerequisite}:{template.id}:{template.last_updated};".encode())
+    return f"template_catalog:{versions.hexdigest()}"
+
+
+def compile_template_catalog(
+    concept_templates: Sequence[QuestionTemplate], prereq_templates: Sequence[QuestionTemplate]
+) -> TemplateCatalog:
+    templates = [*concept_templates, *prereq_templates]
+    param_options = [parse_params(template.template_text) for template in templates]
+    invalid_param_combinations = [template.invalid_param_combinations for template in templates]
+    num_answers = np.array([template.number_of_answers for template in templates])
+    return TemplateCatalog(
+        template_ids=[template.id for template in templates],
+        param_options=param_options,
+        invalid_param_combinations=invalid_param_combinations,
+        num_questions=np.array(
+            [
+                num_param_combinations(options) - len(invalid or [])
+                for options, invalid in zip(param_options, invalid_param_combinations)
+            ]
+        ),
+        num_answers=num_answers,
+        # (LMVP-369) Difficulty isn't well defined for the next concept. A hard question on a
+        #  prerequisite isn't clearly a hard question on the next concept, but it isn't necessarily
+        #  easy either.
+        difficulties=np.array(
+            [template.difficulty for template in concept_templates]
+            + [PREREQ_QUESTION_DIFF] * len(prereq_templates),
+            dtype=float,
+        ),
+        guess_probs=1 / num_answers,
+        question_types=np.array([template.question_type for template in templates], dtype=object),
+    )
+
+
+_template_catalogs: "OrderedDict[str, TemplateCatalog]" = OrderedDict()
+_template_catalogs_lock = threading.Lock()
+
+
+def get_template_catalog(
+    concept_templates: Sequence[QuestionTemplate], prereq_templates: Sequence[QuestionTemplate]
+) -> TemplateCatalog:
+    """Gets the catalog of the templates given from this process's memory or the cache, or
+    compiles it if neither has it."""
+    key = template_catalog_key(concept_templates, prereq_templates)
+    with _template_catalogs_lock:
+        catalog = _template_catalogs.get(key)
+        if catalog is not None:
+            _template_catalogs.move_to_end(key)
+            TEMPLATE_CATALOG_STATS["hits"] += 1
+            return catalog
+
+    catalog = cache.get(key)
+    if catalog is not None:
+        TEMPLATE_CATALOG_STATS["cache_hits"] += 1
+    else:
+        TEMPLATE_CATALOG_STATS["compiles"] += 1
+        catalog = compile_template_catalog(concept_templates, prereq_templates)
+        cache.set(key, catalog, timeout=TEMPLATE_CATALOG_CACHE_TIMEOUT)
+
+    with _template_catalogs_lock:
+        _template_catalogs[key] = catalog
+        while len(_template_catalogs) > TEMPLATE_CATALOG_MAX_SIZE:
+            _template_catalogs.popitem(last=False)
+    return catalog
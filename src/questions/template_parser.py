@@ -1,10 +1,13 @@
+import ast
+import copy
+import functools
 import json
 import random
 import re
 import warnings
 from contextlib import redirect_stdout
 from io import StringIO
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple, Union
 
 import numpy as np
 
@@ -18,13 +21,12 @@ class ParsingError(BaseException):
 ParamOptionsDict = Dict[str, List[Any]]
 
 
-NUMBER_REGEX = r"-?\d+\.?\d*(e-?\d+)?"
 STRING_REGEX = """("[^"]*"|'[^']*'|[\u201c\u201d][^\u201c\u201d]*[\u201c\u201d]|[\u2018\u2019][^\u2018\u2019]*[\u2018\u2019])"""
-LIST_REGEX = f"\[(({NUMBER_REGEX}|{STRING_REGEX})+.*,\s*)*({NUMBER_REGEX}|{STRING_REGEX})]"
+EXPRESSION_REGEX = re.compile(r"(<<([^>]+)>>)")
 
 
 def is_number(value: str) -> bool:
-    return re.fullmatch(NUMBER_REGEX, value) is not None
+    return _scan(value, _NUMBER, _NUMBER_END)
 
 
 def is_string(value: str) -> bool:
@@ -32,7 +34,7 @@ def is_string(value: str) -> bool:
 
 
 def is_list(value: str) -> bool:
-    return re.fullmatch(LIST_REGEX, value) is not None
+    return _scan(value, _LIST, _AFTER_VALUE, single_value=True)
 
 
 def says_feedback(line: str) -> bool:
@@ -43,41 +45,129 @@ def answer_regex(line: str) -> Optional[re.Match]:
     return re.search(r"^\s*\(?([abcdABCD])[).]\s*(\S+.*)", line)
 
 
+def param_value_strings(param_options: ParamOptionsDict) -> Dict[str, List[str]]:
+    """Each parameter's distinct values, as the strings they're sampled as.
+
+    Each combination of parameter values is numbered by a mixed-radix integer, with a digit for
+    each parameter's value in this order - the first parameter is the most significant digit.
+    """
+    return {
+        name: list(dict.fromkeys(str(value) for value in values))
+        for name, values in param_options.items()
+    }
+
+
+def param_combination_index(
+    value_strings: Dict[str, List[str]], sampled_params: SampledParamsDict
+) -> Optional[int]:
+    """Number of the combination of parameter values given, or None if it isn't a combination of
+    these parameters (e.g. the template's been edited since it was sampled)."""
+    if sampled_params.keys() != value_strings.keys():
+        return None
+    index = 0
+    for name, values in value_strings.items():
+        if sampled_params[name] not in values:
+            return None
+        index = index * len(values) + values.index(sampled_params[name])
+    return index
+
+
+def params_from_combination_index(
+    value_strings: Dict[str, List[str]], index: int
+) -> SampledParamsDict:
+    """The combination of parameter values with the number given."""
+    sampled_params = {}
+    for name, values in reversed(list(value_strings.items())):
+        index, value_index = divmod(index, len(values))
+        sampled_params[name] = values[value_index]
+    return {name: sampled_params[name] for name in value_strings}
+
+
+def used_param_combinations(
+    value_strings: Dict[str, List[str]], params_to_avoid: Optional[List[SampledParamsDict]]
+) -> Set[int]:
+    """Numbers of the combinations of parameter values in `params_to_avoid`."""
+    used = {param_combination_index(value_strings, params) for params in params_to_avoid or []}
+    used.discard(None)
+    return used
+
+
+def combinations_bitmap(indices: Iterable[int], num_combinations: int) -> bytes:
+    """Bitmap of combinations of parameter values, with the bit of each index given set. Bit i is
+    bit i % 8 of byte i // 8."""
+    bits = np.zeros(num_combinations, dtype=np.uint8)
+    bits[list(indices)] = 1
+    return np.packbits(bits, bitorder="little").tobytes()
+
+
+def unset_combinations(bitmap: bytes, num_combinations: int) -> Set[int]:
+    """Indices of the combinations of parameter values whose bits aren't set in the bitmap."""
+    bits = np.unpackbits(
+        np.frombuffer(bitmap, dtype=np.uint8), count=num_combinations, bitorder="little"
+    )
+    return set(np.flatnonzero(bits == 0).tolist())
+
+
+def sample_unused_index(num_combinations: int, used: Set[int]) -> Optional[int]:
+    """Samples uniformly from the integers in [0, num_combinations) not in `used`, in O(k log k)
+    time for k used integers. Returns None if they're all used."""
+    num_unused = num_combinations - len(used)
+    if num_unused <= 0:
+        return None
+    # Take the r-th unused integer - it's r plus the number of used integers before it
+    index = random.randrange(num_unused)
+    for used_index in sorted(used):
+        if used_index > index:
+            break
+        index += 1
+    return index
+
+
 def check_valid_params_exist(
-    param_options: ParamOptionsDict, params_to_avoid: Optional[List[SampledParamsDict]] = None
+    param_options: ParamOptionsDict,
+    params_to_avoid: Optional[List[SampledParamsDict]] = None,
+    invalid_combinations: Optional[Set[int]] = None,
 ) -> bool:
-    """Check that at least one valid parameter combination exists."""
-    is_valid = params_to_avoid is None or len(params_to_avoid) < np.prod(
-        [len(vals) for vals in param_options.values()]
-    )
+    """Check that at least one valid parameter combination exists.
+
+    `invalid_combinations` are the indices of combinations which don't generate valid questions.
+    """
+    value_strings = param_value_strings(param_options)
+    used = used_param_combinations(value_strings, params_to_avoid) | (invalid_combinations or set())
+    is_valid = len(used) < num_param_combinations(param_options)
     if not is_valid:
-        warnings.warn(
-            f"All possible parameter values have been sampled."
-            f"\nparam_option_dict: {param_options}\nparams_to_avoid: {params_to_avoid}"
-        )
+        warn_all_params_sampled(param_options, params_to_avoid)
     return is_valid
 
 
+def warn_all_params_sampled(
+    param_options: ParamOptionsDict, params_to_avoid: Optional[List[SampledParamsDict]]
+) -> None:
+    warnings.warn(
+        f"All possible parameter values have been sampled."
+        f"\nparam_option_dict: {param_options}\nparams_to_avoid: {params_to_avoid}"
+    )
+
+
 def sample_params(
-    param_options: ParamOptionsDict, params_to_avoid: Optional[List[SampledParamsDict]] = None
+    param_options: ParamOptionsDict,
+    params_to_avoid: Optional[List[SampledParamsDict]] = None,
+    invalid_combinations: Optional[Set[int]] = None,
 ) -> Optional[SampledParamsDict]:
-    """Samples question template parameter values from possible options from a uniform categorical
-    distribution.
+    """Samples question template parameter values uniformly from the combinations of possible
+    options not in params_to_avoid and whose indices aren't in invalid_combinations.
 
-    Redraw if the sampled parameters are in the list of params_to_avoid, unless all possible values
-    are in that list.
+    Returns None if there are no such combinations.
     """
-    if not check_valid_params_exist(param_options, params_to_avoid):
-        return None
-    for _ in range(10000):
-        sampled_params = {
-            name: str(random.choice(value_options)) for name, value_options in param_options.items()
-        }
-        if params_to_avoid is None or sampled_params not in params_to_avoid:
-            return sampled_params
-    raise Exception(
-        f"Could not sample parameters from {param_options} after 10000 tries, while avoiding {params_to_avoid}"
+    value_strings = param_value_strings(param_options)
+    index = sample_unused_index(
+        num_param_combinations(param_options),
+        used_param_combinations(value_strings, params_to_avoid) | (invalid_combinations or set()),
     )
+    if index is None:
+        warn_all_params_sampled(param_options, params_to_avoid)
+        return None
+    return params_from_combination_index(value_strings, index)
 
 
 def expand_params_in_text(text: str, sampled_params: SampledParamsDict) -> str:
@@ -87,17 +177,162 @@ def expand_params_in_text(text: str, sampled_params: SampledParamsDict) -> str:
     """
 
     def replace_with_expression_output(match: re.Match) -> str:
-        python_expression = match.groups()[1]
-        for variable, value in sampled_params.items():
-            python_expression = python_expression.replace(variable, convert_string_to_python(value))
         try:
-            return run_python_code_string(python_expression)
+            return expand_expression(match.groups()[1], sampled_params)
         except ParsingError as e:
-            raise ParsingError(
-                f"Error when parsing:\n\n{text}\nWith params: {sampled_params}\n\n{e}"
+            raise expansion_error(text, sampled_params, e)
+
+    return EXPRESSION_REGEX.sub(replace_with_expression_output, text)
+
+
+def expand_expression(python_expression: str, sampled_params: SampledParamsDict) -> str:
+    """Output of a <<>> expression, with the parameters' values substituted into its text."""
+    for variable, value in sampled_params.items():
+        python_expression = python_expression.replace(variable, convert_string_to_python(value))
+    return run_python_code_string(python_expression)
+
+
+def expansion_error(
+    text: str, sampled_params: SampledParamsDict, error: ParsingError
+) -> ParsingError:
+    return ParsingError(f"Error when parsing:\n\n{text}\nWith params: {sampled_params}\n\n{error}")
+
+
+# Names with a different meaning in `run_python_code_string()` - expressions using them aren't
+#  compiled
+UNCOMPILABLE_NAMES = {"print", "f", "python_code"}
+
+
+class CompiledExpression:
+    """A <<>> expression compiled into a function of the parameters it uses.
+
+    `expand_expression()` substitutes parameters' values into the expression's text, so it's only
+    compiled if evaluating it with the values as arguments gives the same output - every
+    occurrence of each parameter's name is a variable read, not part of another name, a string or
+    an attribute. Otherwise, or if a value couldn't be substituted as the same literal, it's
+    expanded from its text.
+    """
+
+    def __init__(self, source: str, param_names: List[str]):
+        self.source = source
+        self.param_names = [name for name in param_names if name in source]
+        # Parameters which read differently if their value is a negative number - e.g. `A ** 2`
+        #  is `-5 ** 2` with A = -5
+        self.sign_sensitive: Set[str] = set()
+        self.function: Optional[Callable[..., Any]] = None
+        lambda_source = f"lambda {', '.join(self.param_names)}: (\n{source}\n)"
+        try:
+            tree = ast.parse(lambda_source, mode="eval")
+        except SyntaxError:
+            return
+        names_read: List[str] = []
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Name):
+                if node.id in UNCOMPILABLE_NAMES:
+                    return
+                if isinstance(node.ctx, ast.Load):
+                    names_read.append(node.id)
+            elif (
+                isinstance(node, ast.Attribute)
+                and isinstance(node.value, ast.Name)
+                and node.value.id in self.param_names
+            ):
+                return
+            elif isinstance(node, ast.JoinedStr):
+                return
+            elif isinstance(node, ast.BinOp) and isinstance(node.op, ast.Pow):
+                self.sign_sensitive.add(getattr(node.left, "id", ""))
+            elif isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name):
+                self.sign_sensitive.add(node.value.id)
+            elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+                self.sign_sensitive.add(node.func.id)
+        if any(source.count(name) != names_read.count(name) for name in param_names):
+            return
+        self.sign_sensitive &= set(self.param_names)
+        self.function = eval(compile(tree, "<<>>", "eval"), globals())
+
+    def evaluate(self, sampled_params: SampledParamsDict, values: Dict[str, Any]) -> str:
+        """Output of the expression given the parameters' values as literals - those missing
+        from `values` couldn't be substituted as literals."""
+        if (
+            self.function is None
+            or any(name not in values for name in self.param_names)
+            or any(sampled_params[name].startswith("-") for name in self.sign_sensitive)
+        ):
+            return expand_expression(self.source, sampled_params)
+        try:
+            # Each substitution of a list is a new list
+            output = self.function(
+                *[
+                    copy.deepcopy(values[name]) if isinstance(values[name], list) else values[name]
+                    for name in self.param_names
+                ]
             )
+        except Exception:
+            # Gives the same error as expanding the expression
+            return expand_expression(self.source, sampled_params)
+        return str(remove_floating_point_errors(output) if isinstance(output, float) else output)
+
+
+class CompiledTemplate:
+    """Template text split into literal text and compiled <<>> expressions, so rendering it with
+    a combination of parameter values evaluates each expression and joins the pieces. Renders the
+    same text as `expand_params_in_text()`."""
+
+    def __init__(self, text: str, param_names: Iterable[str]):
+        self.text = text
+        self.param_names = list(param_names)
+        self.segments: List[Union[str, CompiledExpression]] = []
+        position = 0
+        for match in EXPRESSION_REGEX.finditer(text):
+            self.segments.append(text[position : match.start()])
+            self.segments.append(CompiledExpression(match.groups()[1], self.param_names))
+            position = match.end()
+        self.segments.append(text[position:])
+
+    def render(self, sampled_params: SampledParamsDict) -> str:
+        if len(self.segments) == 1:
+            return self.text
+        if sampled_params.keys() != set(self.param_names):
+            return expand_params_in_text(self.text, sampled_params)
+        values = param_literals(sampled_params)
+        try:
+            return "".join(
+                segment if isinstance(segment, str) else segment.evaluate(sampled_params, values)
+                for segment in self.segments
+            )
+        except ParsingError as e:
+            raise expansion_error(self.text, sampled_params, e)
 
-    return re.sub(r"(<<([^>]+)>>)", replace_with_expression_output, text)
+
+def param_literals(sampled_params: SampledParamsDict) -> Dict[str, Any]:
+    """The values `expand_expression()` substitutes for parameters, for those whose substituted
+    text is a single literal of the value's type whatever it's substituted into."""
+    names = list(sampled_params)
+    values = {}
+    for position, (name, value) in enumerate(sampled_params.items()):
+        literal = param_literal(value)
+        # Substituted values are substituted into in turn by the parameters after them
+        if literal is not NOT_A_LITERAL and not any(
+            later_name in convert_string_to_python(value) for later_name in names[position + 1 :]
+        ):
+            values[name] = literal
+    return values
+
+
+NOT_A_LITERAL = object()
+
+
+@functools.lru_cache(maxsize=4096)
+def param_literal(value: str) -> Any:
+    """The value of a parameter's substituted text, or NOT_A_LITERAL if it isn't a literal of the
+    value's type. Lists are shared by every call, so mustn't be changed."""
+    try:
+        literal = ast.literal_eval(convert_string_to_python(value))
+    except (ValueError, SyntaxError, TypeError, MemoryError, RecursionError):
+        return NOT_A_LITERAL
+    expected_type = (int, float) if is_number(value) else list if value.startswith("[") else str
+    return literal if isinstance(literal, expected_type) else NOT_A_LITERAL
 
 
 def convert_string_to_python(value: str) -> str:
@@ -120,8 +355,12 @@ def run_python_code_string(python_code: str) -> str:
 def number_of_questions(template_text: str) -> int:
     """Get the number of questions that can be generated from a template from a parameter options
     dictionary."""
-    params = parse_params(template_text)
-    return int(np.prod([len(values) for values in params.values()]))
+    return num_param_combinations(parse_params(template_text))
+
+
+def num_param_combinations(param_options: ParamOptionsDict) -> int:
+    """Number of distinct combinations of parameter values - each gives a different question."""
+    return int(np.prod([len(values) for values in param_value_strings(param_options).values()]))
 
 
 def parse_params(template_text: str) -> ParamOptionsDict:
@@ -146,12 +385,12 @@ def parse_params(template_text: str) -> ParamOptionsDict:
 
 def parse_param_line(line: str) -> Tuple[str, List[Any]]:
     """Parse 1 line from a question template starting with 'param '."""
-    regex = param_line_regex(line)
-    if regex is None:
+    param_line = split_param_line(line)
+    if param_line is None:
         raise ParsingError(f"{line}\n is an invalid question template parameter line")
 
     # replace strings starting and ending with ' with double quotes
-    values_string = re.sub(STRING_REGEX, lambda x: '"' + x.group(0)[1:-1] + '"', regex.groups()[1])
+    values_string = re.sub(STRING_REGEX, lambda x: '"' + x.group(0)[1:-1] + '"', param_line.values)
 
     # Replace outside { and } with [ and ] to make it valid json
     values_string = "[" + values_string[1:-1] + "]"
@@ -159,29 +398,171 @@ def parse_param_line(line: str) -> Tuple[str, List[Any]]:
     # Prevents a bug due to json.loads() erroring due to latex \ in strings in params
     values_string = re.sub(STRING_REGEX, lambda x: x.group(0).replace("\\", "\\\\"), values_string)
 
-    return regex.groups()[0], json.loads(values_string)
+    return param_line.name, json.loads(values_string)
+
+
+class ParamLine(NamedTuple):
+    name: str
+    # The values in their braces, e.g. "{1, 'a', [2, 3]}"
+    values: str
+
+
+# Characters which can't be in parameter names
+PARAM_NAME_EXCLUDED_CHARS = frozenset("-{}:@&%$£?!~#+=,")
+
 
+@functools.lru_cache(maxsize=4096)
+def split_param_line(line: str) -> Optional[ParamLine]:
+    """Splits a parameter line, 'param <name>: {<value>, ...}', into its name and values.
 
-def param_line_regex(line: str) -> Optional[re.Match]:
-    """Matches line with regex for parameter line.
+    Param lines are tested on every line of a template each time it's parsed, so this is a single
+    left-to-right pass rather than a regex - the regex's lists ('[', numbers or strings, then
+    anything, ',') backtracked exponentially on long lines.
 
     Returns:
-        None if not a match, otherwise a re.Match object with .groups() corresponding to contents
-         of normal brackets (), ordered by first open bracket (.
+        None if the line isn't a parameter line
     """
-    param_element_regex = f"({NUMBER_REGEX}|{STRING_REGEX}|{LIST_REGEX})"
-    return re.fullmatch(
-        r"\s*param\s+([^-{}:@&%$£?!~#+=,]+):\s*({("
-        + param_element_regex
-        + ",\s*)*"
-        + param_element_regex
-        + "})\s*",
-        line,
-    )
+    keyword_start = len(line) - len(line.lstrip())
+    if not line.startswith("param", keyword_start):
+        return None
+    name_start = len(line) - len(line[keyword_start + 5 :].lstrip())
+    num_spaces = name_start - keyword_start - 5
+    colon = line.find(":", name_start)
+    if num_spaces == 0 or colon < 0:
+        return None
+    # With no name before the ':', the last whitespace character is the name
+    if colon == name_start and num_spaces >= 2:
+        name_start -= 1
+    name = line[name_start:colon]
+    if not name or not PARAM_NAME_EXCLUDED_CHARS.isdisjoint(name):
+        return None
+
+    values_start = len(line) - len(line[colon + 1 :].lstrip())
+    values_end = len(line.rstrip())
+    if (
+        values_end - values_start < 3
+        or line[values_start] != "{"
+        or line[values_end - 1] != "}"
+        or not _scan(line[values_start + 1 : values_end - 1], _VALUE, _AFTER_VALUE)
+    ):
+        return None
+    return ParamLine(name, line[values_start:values_end])
 
 
 def is_param_line(line: str) -> bool:
-    return param_line_regex(line) is not None
+    return split_param_line(line) is not None
+
+
+# Scanner of parameter values - an NFA run in all its states at once, so it's linear in the length
+#  of the text. It accepts what these regexes did, where a number is -?\d+\.?\d*(e-?\d+)? and a
+#  string is quoted:
+#  values: (value,\s*)*value
+#  value:  number|string|list
+#  list:   \[((number|string)+.*,\s*)*(number|string)]
+# States are strings, except inside numbers and strings, which are scanned in a context - what
+#  comes after them - and are (context, number state) or (context, closing quotes) tuples.
+
+# Before a value, after one, and after its ',' and the whitespace following it
+_VALUE, _AFTER_VALUE, _VALUE_SPACE = "value", "after value", "value space"
+# Before a list, before a list item's first number or string, before its others, after them up to
+#  the item's ',', after the ',' and the whitespace following it, and before the list's ']'
+_LIST, _LIST_ITEM, _LIST_ITEM_MORE = "list", "list item", "list item more"
+_LIST_ITEM_REST, _LIST_SPACE, _LIST_END = "list item rest", "list space", "list end"
+# Before and after a single number
+_NUMBER, _NUMBER_END = "number", "number end"
+
+# Number states: after '-', the integer part, '.', the fractional part, 'e', 'e-' and the exponent
+_MINUS, _INT, _DOT, _FRAC, _E, _E_MINUS, _EXP = range(7)
+_NUMBER_ENDS = {_INT, _DOT, _FRAC, _EXP}
+# Closing quotes of each opening quote
+_QUOTES = {
+    '"': '"',
+    "'": "'",
+    "\u201c": "\u201c\u201d",
+    "\u201d": "\u201c\u201d",
+    "\u2018": "\u2018\u2019",
+    "\u2019": "\u2018\u2019",
+}
+# States after a number or string in each context
+_TOKEN_ENDS = {
+    _VALUE: (_AFTER_VALUE,),
+    _LIST_ITEM: (_LIST_ITEM_REST, _LIST_ITEM_MORE),
+    _LIST_END: (_LIST_END,),
+    _NUMBER: (_NUMBER_END,),
+}
+
+
+def _token_start(context: str, char: str, strings: bool = True) -> List:
+    """States after the first character of a number or string."""
+    if char == "-":
+        return [(context, _MINUS)]
+    if char.isdecimal():
+        return [(context, _INT), *_TOKEN_ENDS[context]]
+    if strings and char in _QUOTES:
+        return [(context, _QUOTES[char])]
+    return []
+
+
+def _next_number_state(number_state: int, char: str) -> Optional[int]:
+    if char.isdecimal():
+        if number_state in (_E, _E_MINUS, _EXP):
+            return _EXP
+        return _FRAC if number_state in (_DOT, _FRAC) else _INT
+    if char == "." and number_state == _INT:
+        return _DOT
+    if char == "e" and number_state in (_INT, _DOT, _FRAC):
+        return _E
+    if char == "-" and number_state == _E:
+        return _E_MINUS
+    return None
+
+
+def _step(state: Union[str, Tuple[str, Any]], char: str, single_value: bool) -> List:
+    """States after reading a character in the state. If `single_value`, nothing can follow the
+    first value."""
+    if isinstance(state, tuple):
+        context, token_state = state
+        if isinstance(token_state, str):  # In a string, closed by any of `token_state`
+            return list(_TOKEN_ENDS[context]) if char in token_state else [state]
+        token_state = _next_number_state(token_state, char)
+        if token_state is None:
+            return []
+        if token_state in _NUMBER_ENDS:
+            return [(context, token_state), *_TOKEN_ENDS[context]]
+        return [(context, token_state)]
+    if state == _VALUE:
+        return _token_start(_VALUE, char) + ([_LIST_ITEM] if char == "[" else [])
+    if state == _AFTER_VALUE:
+        return [_VALUE_SPACE, _VALUE] if char == "," and not single_value else []
+    if state == _VALUE_SPACE:
+        return [_VALUE_SPACE, _VALUE] if char.isspace() else []
+    if state == _LIST_ITEM:
+        return _token_start(_LIST_ITEM, char) + _token_start(_LIST_END, char)
+    if state == _LIST_ITEM_MORE:
+        return _token_start(_LIST_ITEM, char)
+    if state == _LIST_ITEM_REST:
+        if char == "\n":
+            return []
+        return [_LIST_ITEM_REST, _LIST_SPACE, _LIST_ITEM] if char == "," else [_LIST_ITEM_REST]
+    if state == _LIST_SPACE:
+        return [_LIST_SPACE, _LIST_ITEM] if char.isspace() else []
+    if state == _LIST_END:
+        return [_AFTER_VALUE] if char == "]" else []
+    if state == _LIST:
+        return [_LIST_ITEM] if char == "[" else []
+    if state == _NUMBER:
+        return _token_start(_NUMBER, char, strings=False)
+    return []
+
+
+def _scan(text: str, start_state: str, end_state: str, single_value: bool = False) -> bool:
+    """Whether the scanner can get from `start_state` to `end_state` reading the text."""
+    states = {start_state}
+    for char in text:
+        states = {next_state for state in states for next_state in _step(state, char, single_value)}
+        if not states:
+            return False
+    return end_state in states
 
 
 def contains_non_whitespace_characters(line: str) -> str:
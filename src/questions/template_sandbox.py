@@ -0,0 +1,285 @@
+"""Renders question templates in a pool of sandboxed worker processes.
+
+Rendering a question runs the Python in its template's <<>> expressions, which template authors
+write. Run in a web process, an expression which never finishes blocks the request's thread - and
+the MCMC mutex, if it's held around question selection - indefinitely. Instead, the sandbox's
+workers are forked ahead of time from a fork server which has imported the template parser, and
+each:
+- renders the template with each combination of parameter values in a request, sending back each
+  result as it's ready
+- stops a render once it's used `cpu_limit_secs` of CPU time
+- can't allocate more than `SANDBOX_MEMORY_LIMIT_BYTES` more memory or write files
+
+A worker which sends nothing for `cpu_limit_secs + kill_grace_secs` (e.g. stuck in C code, which
+doesn't check for signals) is killed and replaced. Either way, the render raises
+`RenderTimeoutError` and so does every later render of that template text, so a pathological
+template costs each process one timeout. Rendered texts are cached by template text and parameter
+values, which they're determined by.
+
+Set `TEMPLATE_SANDBOX_WORKERS` to render in the sandbox.
+"""
+import hashlib
+import multiprocessing
+import queue
+import resource
+import signal
+import threading
+from collections import OrderedDict
+from multiprocessing.connection import Connection
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from questions.template_parser import CompiledTemplate, ParsingError
+from questions.utils import SampledParamsDict
+
+# CPU time each render can use
+SANDBOX_CPU_LIMIT_SECS = 1.0
+# Time on top of the CPU time limit a worker can take to send a result before it's killed
+SANDBOX_KILL_GRACE_SECS = 1.0
+# Memory each worker can allocate on top of what it's using when it starts
+SANDBOX_MEMORY_LIMIT_BYTES = 512 * 1024 * 1024
+# Workers are replaced after this many renders, so changes expressions make to modules don't last
+SANDBOX_MAX_RENDERS_PER_WORKER = 10000
+# Compiled templates kept by each worker
+SANDBOX_COMPILED_TEMPLATES_MAX_SIZE = 256
+# Results kept, and template texts which timed out remembered, by each sandbox
+SANDBOX_RESULT_CACHE_SIZE = 4096
+SANDBOX_TIMED_OUT_MAX_SIZE = 1024
+
+# Results sent back by workers - ("text", rendered text), ("error", message) or ("timeout", message)
+WorkerResult = Tuple[str, str]
+
+
+class RenderTimeoutError(ParsingError, TimeoutError):
+    """A template's <<>> expressions took longer to run than the sandbox allows, or crashed the
+    worker rendering them."""
+
+
+class CPULimitExceeded(BaseException):
+    """Raised in a worker when a render has used up its CPU time. Not an `Exception`, so neither
+    expressions nor `run_python_code_string()` catch it."""
+
+
+def raise_cpu_limit_exceeded(signal_number: int, frame: Any) -> None:
+    raise CPULimitExceeded()
+
+
+def limit_worker_resources(memory_limit_bytes: int) -> None:
+    """Caps the worker's address space at `memory_limit_bytes` more than it's using and stops it
+    writing to files or dumping core."""
+    try:
+        with open("/proc/self/statm") as statm:
+            address_space_bytes = int(statm.read().split()[0]) * resource.getpagesize()
+    except OSError:
+        address_space_bytes = 0
+    resource.setrlimit(resource.RLIMIT_AS, (address_space_bytes + memory_limit_bytes,) * 2)
+    # Writing past the limit fails with an error instead of killing the worker
+    signal.signal(signal.SIGXFSZ, signal.SIG_IGN)
+    resource.setrlimit(resource.RLIMIT_FSIZE, (0, 0))
+    resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+
+
+def render_with_cpu_limit(
+    compiled: CompiledTemplate, sampled_params: SampledParamsDict, cpu_limit_secs: float
+) -> WorkerResult:
+    try:
+        signal.setitimer(signal.ITIMER_PROF, cpu_limit_secs)
+        try:
+            return "text", compiled.render(sampled_params)
+        finally:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+    except CPULimitExceeded:
+        return "timeout", f"Rendering took over {cpu_limit_secs}s of CPU time"
+    except ParsingError as error:
+        return "error", str(error)
+    except Exception as error:
+        return "error", f"{type(error).__name__}: {error}"
+
+
+def run_sandbox_worker(connection: Connection, memory_limit_bytes: int) -> None:
+    """Entry point of each sandbox worker process.
+
+    Takes requests of (template text, parameter names, combinations of parameter values, CPU
+    limit) from the connection and sends back a `WorkerResult` for each combination, stopping after
+    the first timeout. Exits when the connection's closed.
+    """
+    limit_worker_resources(memory_limit_bytes)
+    signal.signal(signal.SIGPROF, raise_cpu_limit_exceeded)
+    compiled_templates: "OrderedDict[Tuple[str, Tuple[str, ...]], CompiledTemplate]" = OrderedDict()
+    while True:
+        try:
+            text, param_names, combinations, cpu_limit_secs = connection.recv()
+        except EOFError:
+            return
+        key = (text, tuple(param_names))
+        compiled = compiled_templates.pop(key, None) or CompiledTemplate(text, param_names)
+        compiled_templates[key] = compiled
+        while len(compiled_templates) > SANDBOX_COMPILED_TEMPLATES_MAX_SIZE:
+            compiled_templates.popitem(last=False)
+        for sampled_params in combinations:
+            result = render_with_cpu_limit(compiled, sampled_params, cpu_limit_secs)
+            connection.send(result)
+            if result[0] == "timeout":
+                break
+
+
+class SandboxWorker:
+    """A worker process and the connection requests are sent to it on."""
+
+    def __init__(self, context: Any, memory_limit_bytes: int):
+        self.connection, worker_connection = context.Pipe()
+        self.process = context.Process(
+            target=run_sandbox_worker, args=(worker_connection, memory_limit_bytes), daemon=True
+        )
+        self.process.start()
+        worker_connection.close()
+        self.num_renders = 0
+
+    def stop(self, kill: bool = False) -> None:
+        self.connection.close()
+        if kill:
+            self.process.kill()
+        self.process.join(timeout=1)
+
+
+class TemplateSandbox:
+    """Pool of sandbox workers, shared by the threads of a process."""
+
+    def __init__(
+        self,
+        num_workers: int,
+        cpu_limit_secs: float = SANDBOX_CPU_LIMIT_SECS,
+        kill_grace_secs: float = SANDBOX_KILL_GRACE_SECS,
+        memory_limit_bytes: int = SANDBOX_MEMORY_LIMIT_BYTES,
+    ):
+        self.cpu_limit_secs = cpu_limit_secs
+        self.kill_grace_secs = kill_grace_secs
+        self.memory_limit_bytes = memory_limit_bytes
+        # Workers are forked from a server process, as forking a process with threads (e.g. a web
+        #  process) can copy locks other threads held
+        self._context = multiprocessing.get_context("forkserver")
+        self._context.set_forkserver_preload(["questions.template_sandbox"])
+        self._idle_workers: "queue.Queue[SandboxWorker]" = queue.Queue()
+        for _ in range(num_workers):
+            self._idle_workers.put(SandboxWorker(self._context, memory_limit_bytes))
+        self._results: "OrderedDict[Tuple[str, Tuple], WorkerResult]" = OrderedDict()
+        self._timed_out: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"renders": 0, "cache_hits": 0, "timeouts": 0, "workers_killed": 0}
+
+    def render(
+        self, text: str, param_names: List[str], combinations: List[SampledParamsDict]
+    ) -> List[Union[str, ParsingError]]:
+        """Renders the template text with each combination of parameter values in a worker, in
+        one request.
+
+        Returns: each rendered text, or the error rendering it raised
+        """
+        text_key = hashlib.md5(text.encode()).hexdigest()
+        results: List[Optional[WorkerResult]] = []
+        with self._lock:
+            timeout_message = self._timed_out.get(text_key)
+            for sampled_params in combinations:
+                result = self._results.get((text_key, tuple(sampled_params.items())))
+                if result is not None:
+                    self._results.move_to_end((text_key, tuple(sampled_params.items())))
+                    self.stats["cache_hits"] += 1
+                results.append(result)
+        to_render = [index for index, result in enumerate(results) if result is None]
+
+        if to_render and timeout_message is None:
+            rendered = self._render_in_worker(
+                text, param_names, [combinations[index] for index in to_render]
+            )
+            with self._lock:
+                self.stats["renders"] += len(rendered)
+                for index, result in zip(to_render, rendered):
+                    results[index] = result
+                    if result[0] == "timeout":
+                        self.stats["timeouts"] += 1
+                        timeout_message = result[1]
+                        self._timed_out[text_key] = timeout_message
+                        while len(self._timed_out) > SANDBOX_TIMED_OUT_MAX_SIZE:
+                            self._timed_out.popitem(last=False)
+                    else:
+                        self._results[(text_key, tuple(combinations[index].items()))] = result
+                while len(self._results) > SANDBOX_RESULT_CACHE_SIZE:
+                    self._results.popitem(last=False)
+
+        return [text_or_error(result, timeout_message, text) for result in results]
+
+    def _render_in_worker(
+        self, text: str, param_names: List[str], combinations: List[SampledParamsDict]
+    ) -> List[WorkerResult]:
+        """Sends the request to an idle worker, waiting for one if none are.
+
+        Returns: the worker's results, up to and including the first timeout
+        """
+        worker = self._idle_workers.get()
+        results: List[WorkerResult] = []
+        try:
+            worker.connection.send((text, param_names, combinations, self.cpu_limit_secs))
+            while len(results) < len(combinations) and (not results or results[-1][0] != "timeout"):
+                if worker.connection.poll(self.cpu_limit_secs + self.kill_grace_secs):
+                    results.append(worker.connection.recv())
+                else:
+                    results.append(
+                        (
+                            "timeout",
+                            f"No result after {self.cpu_limit_secs + self.kill_grace_secs}s",
+                        )
+                    )
+                    worker = self._replace_worker(worker, kill=True)
+        except (EOFError, OSError):
+            results.append(("timeout", "The worker rendering the template exited"))
+            worker = self._replace_worker(worker, kill=True)
+        finally:
+            worker.num_renders += len(results)
+            if worker.num_renders >= SANDBOX_MAX_RENDERS_PER_WORKER:
+                worker = self._replace_worker(worker)
+            self._idle_workers.put(worker)
+        return results
+
+    def close(self) -> None:
+        """Stops the workers which aren't rendering."""
+        while True:
+            try:
+                self._idle_workers.get_nowait().stop()
+            except queue.Empty:
+                return
+
+    def _replace_worker(self, worker: SandboxWorker, kill: bool = False) -> SandboxWorker:
+        if kill:
+            with self._lock:
+                self.stats["workers_killed"] += 1
+        worker.stop(kill)
+        return SandboxWorker(self._context, self.memory_limit_bytes)
+
+
+def text_or_error(
+    result: Optional[WorkerResult], timeout_message: Optional[str], text: str
+) -> Union[str, ParsingError]:
+    """The rendered text or the error of a worker's result. No result means the template had
+    timed out, with `timeout_message`."""
+    kind, value = result if result is not None else ("timeout", timeout_message)
+    if kind == "text":
+        return value
+    if kind == "error":
+        return ParsingError(value)
+    return RenderTimeoutError(f"Template timed out: {value}\n{text}")
+
+
+_template_sandbox: Optional[TemplateSandbox] = None
+_template_sandbox_lock = threading.Lock()
+
+
+def get_template_sandbox(num_workers: int) -> TemplateSandbox:
+    """The process's sandbox, started with `num_workers` workers the first time it's used."""
+    global _template_sandbox
+    with _template_sandbox_lock:
+        if _template_sandbox is None:
+            _template_sandbox = TemplateSandbox(num_workers)
+        return _template_sandbox
+
+
+def template_sandbox_stats() -> Optional[Dict[str, int]]:
+    return _template_sandbox.stats if _template_sandbox is not None else None
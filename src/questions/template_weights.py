@@ -0,0 +1,119 @@
+"""Weights question selection draws question templates with.
+
+Only needs numpy (no Django), so question batches can be planned - and tested - without a
+database or cache.
+"""
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Set
+
+import numpy as np
+
+from questions.template_parser import ParamOptionsDict
+
+# Ideal probability of correct
+IDEAL_DIFF = 0.75
+
+
+@dataclass
+class TemplateCatalog:
+    """Compiled question templates, in the order of the template options they were compiled
+    from - a concept's templates, then templates from its prerequisites."""
+
+    template_ids: List[Any]
+    param_options: List[ParamOptionsDict]
+    # Indices of each template's parameter combinations which don't generate valid questions, or
+    #  None if the template hasn't been checked
+    invalid_param_combinations: List[Optional[Set[int]]]
+    # Number of distinct valid questions (parameter combinations) each template can generate
+    num_questions: np.ndarray
+    num_answers: np.ndarray
+    difficulties: np.ndarray
+    guess_probs: np.ndarray
+    question_types: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.template_ids)
+
+
+@dataclass
+class QuestionCounts:
+    """Number of questions asked in a question batch from each template and of each question type.
+    Template ids are strings."""
+
+    num_questions: int = 0
+    templates: Counter = field(default_factory=Counter)
+    question_types: Counter = field(default_factory=Counter)
+
+    @classmethod
+    def from_questions(cls, questions: List[Dict[str, Any]]) -> "QuestionCounts":
+        counts = cls()
+        for question_json in questions:
+            counts.add(question_json)
+        return counts
+
+    def add(self, question_json: Dict[str, Any]) -> None:
+        self.num_questions += 1
+        self.templates[str(question_json["template_id"])] += 1
+        self.question_types[question_json["question_type"]] += 1
+
+
+def prob_correct_to_weighting(correct_probs: np.ndarray) -> np.ndarray:
+    """Weighting curve taking probabilities of getting each question correct and outputting the
+    difficulty weighting."""
+    assert np.all(correct_probs >= 0) and np.all(
+        correct_probs <= 1
+    ), f"{correct_probs} is not a valid probability value (0<= p <=1)"
+    # Below is `std_dev = 0.2 if < IDEAL_DIFF else 0.05` in numpy
+    std_dev = 0.12 * (correct_probs <= IDEAL_DIFF) + 0.08
+    return np.exp(-(1 / 2) * (((correct_probs - IDEAL_DIFF) / std_dev) ** 2))
+
+
+def get_novelty_terms(
+    catalog: TemplateCatalog,
+    question_counts: QuestionCounts,
+    template_counts_to_avoid: Dict[str, int],
+) -> np.ndarray:
+    """Calculate the novelty terms for all template options to weight different templates."""
+    template_ids = [str(template_id) for template_id in catalog.template_ids]
+    # Number of questions (n_qs) that can be generated from each template. At least 1, as a
+    #  template whose combinations are all invalid would otherwise divide by 0
+    n_qs = np.maximum(catalog.num_questions, 1)
+
+    # [1.0] Avoid questions on the same template
+    # [1.1] Worst are questions from the same batch - avoid like the plague. Weight by the sqrt of
+    #  n_qs
+    num_batch_qs = np.array([question_counts.templates[t_id] for t_id in template_ids])
+    novelty_terms = np.exp(-2.5 * num_batch_qs / np.sqrt(n_qs))
+
+    # [1.2] Then there are questions asked today or correct from the past
+    num_qs_to_avoid = np.array([template_counts_to_avoid.get(t_id, 0) for t_id in template_ids])
+    novelty_terms *= 0.6 * np.exp(-2.5 * num_qs_to_avoid / n_qs) + 0.4
+
+    # [2.0] Lastly avoid giving all the same type of question in a batch
+    num_questions_asked = question_counts.num_questions
+    if num_questions_asked > 3:
+        num_qs_of_type = np.array(
+            [question_counts.question_types[q_type] for q_type in catalog.question_types]
+        )
+        novelty_terms *= 0.6 * np.exp(-2 * num_qs_of_type / num_questions_asked) + 0.4
+
+    assert np.any(
+        novelty_terms >= 0
+    ), f"All novelty terms are 0, thus all questions have been seen before ({novelty_terms})"
+    return novelty_terms
+
+
+def gumbel_top_k(weights: np.ndarray, k: int) -> np.ndarray:
+    """Draws k different indices, each in proportion to the weights of the indices not yet drawn.
+    Fewer are drawn if fewer than k weights are positive.
+
+    Perturbing the log-weights with Gumbel noise and taking the k largest draws them in one
+    vectorised step.
+    """
+    # nan_to_num converts very small nans to 0
+    weights = np.nan_to_num(weights)
+    with np.errstate(divide="ignore"):
+        keys = np.log(weights) + np.random.gumbel(size=len(weights))
+    num_to_draw = min(k, int(np.sum(weights > 0)))
+    return np.argsort(-keys)[:num_to_draw]
@@ -0,0 +1,39 @@
+from datetime import datetime
+from typing import TYPE_CHECKING, Callable
+from uuid import uuid4
+
+import pytest
+
+from .template_test_data import QuestionWithParamsOne
+
+if TYPE_CHECKING:
+    from questions.models.question_template import QuestionTemplate
+
+
+@pytest.fixture
+def make_template() -> Callable[..., "QuestionTemplate"]:
+    """Makes unsaved question templates from the template classes in `template_test_data.py`."""
+    # Imported here so tests which don't use templates run without Django's settings
+    from knowledge_maps.models import Concept
+    from questions.models.question_template import QuestionTemplate
+
+    def make(
+        data_class=QuestionWithParamsOne, difficulty: float = 2, question_type: str = "practice"
+    ) -> QuestionTemplate:
+        return QuestionTemplate(
+            id=uuid4(),
+            title="test",
+            concept=Concept(name="test", cytoscape_id="1"),
+            difficulty=difficulty,
+            question_type=question_type,
+            template_text=data_class.QUESTION_TEMPLATE_STRING,
+            correct_answer_letter=data_class.CORRECT_ANSWER_LETTER,
+            last_updated=datetime(2022, 1, 1),
+        )
+
+    return make
+
+
+@pytest.fixture
+def template(make_template: Callable[..., "QuestionTemplate"]) -> "QuestionTemplate":
+    return make_template()
@@ -0,0 +1,91 @@
+from typing import List
+
+import numpy as np
+
+from questions.batch_plan_tree import compute_batch_plan
+from questions.inference import GaussianParams, QuadratureInference
+
+from .test_question_selection import CATALOG, question_json
+
+PRIOR = GaussianParams(mean=1, std_dev=1)
+QUESTIONS = [
+    {
+        **question_json(index),
+        "difficulty": CATALOG.difficulties[index],
+        "answers_order_randomised": ["a"] * CATALOG.num_answers[index],
+    }
+    for index in [1, 2]
+]
+
+
+def planned_paths(plan, node: int = 0, difficulties=(), guess_probs=(), correct=()) -> List:
+    """Every node in the plan with the questions and answers on the way to it."""
+    paths = [(node, np.array(difficulties), np.array(guess_probs), np.array(correct))]
+    for answer in [0, 1]:
+        child = plan.children[node, answer]
+        if child >= 0:
+            paths += planned_paths(
+                plan,
+                child,
+                (*difficulties, plan.difficulties[child]),
+                (*guess_probs, plan.guess_probs[child]),
+                (*correct, answer),
+            )
+    return paths
+
+
+def test_compute_batch_plan():
+    plan = compute_batch_plan(PRIOR, CATALOG, QUESTIONS, {}, max_num_questions=5, min_path_prob=0)
+    paths = planned_paths(plan)
+    assert len(plan) == len(paths) == 1 + 2 + 4 + 8 + 16
+    for node, difficulties, guess_probs, correct in paths:
+        assert plan.depths[node] == len(correct)
+        assert plan.find_node(difficulties, guess_probs, correct) == node
+        if len(correct) == 0:
+            continue
+        # Posteriors match inference run on the answers
+        posterior = QuadratureInference(PRIOR)
+        posterior.run_mcmc_inference(difficulties, guess_probs, correct)
+        assert np.allclose(plan.weights[node], posterior.theta_weights[1], atol=1e-6)
+        assert np.isclose(
+            plan.posterior(node).inferred_theta_params.mean, posterior.inferred_theta_params.mean
+        )
+        # The first answers are to the questions asked when the batch started. Later answers are to
+        #  the questions planned as many answers earlier as there were questions waiting
+        if len(correct) <= len(QUESTIONS):
+            assert difficulties[-1] == QUESTIONS[len(correct) - 1]["difficulty"]
+        else:
+            num_answers = len(correct) - len(QUESTIONS)
+            planned_at = plan.find_node(
+                difficulties[:num_answers], guess_probs[:num_answers], correct[:num_answers]
+            )
+            assert difficulties[-1] == CATALOG.difficulties[plan.template_indices[planned_at]]
+        # A question is planned after each answer until 5 have been asked
+        assert (plan.template_indices[node] >= 0) == (len(correct) < 4)
+
+
+def test_compute_batch_plan__pruned():
+    plan = compute_batch_plan(PRIOR, CATALOG, QUESTIONS, {}, max_num_questions=10, max_depth=10)
+    for node, difficulties, guess_probs, correct in planned_paths(plan):
+        path_prob = 1.0
+        for depth in range(len(correct)):
+            posterior = plan.posterior(
+                plan.find_node(difficulties[:depth], guess_probs[:depth], correct[:depth])
+            )
+            prob_correct = posterior.calculate_correct_probs(
+                difficulties[depth : depth + 1], guess_probs[depth : depth + 1]
+            )[0]
+            path_prob *= prob_correct if correct[depth] else 1 - prob_correct
+        assert path_prob >= 0.05
+    assert len(plan) < 2**11
+
+
+def test_find_node__left_plan():
+    plan = compute_batch_plan(PRIOR, CATALOG, QUESTIONS, {}, max_num_questions=5, min_path_prob=0)
+    difficulties = np.array([question["difficulty"] for question in QUESTIONS])
+    guess_probs = CATALOG.guess_probs[[1, 2]]
+    assert plan.find_node(difficulties, guess_probs, np.array([1, 0])) is not None
+    # A different question was asked than planned
+    assert plan.find_node(difficulties + 1, guess_probs, np.array([1, 0])) is None
+    # More answers than planned
+    assert plan.find_node(*[np.zeros(5)] * 3) is None
@@ -1,9 +1,30 @@
+import subprocess
+import sys
 from typing import Tuple
 
 import numpy as np
 import pytest
 
-from questions.inference import GaussianParams, MCMCInference
+from questions.inference import (
+    MCMC_OBSERVATION_BUCKETS,
+    NUTS_COMPILE_CACHE_STATS,
+    NUTS_WARM_START_STATS,
+    AdaptiveMCMCInference,
+    GaussianApproximationInference,
+    GaussianParams,
+    InferenceProblem,
+    KnowledgeStateInference,
+    LaplaceInference,
+    MCMCInference,
+    NUTSConvergenceTargets,
+    QuadratureInference,
+    VariationalInference,
+    WeightedThetaPosterior,
+    get_inference_engine,
+    nuts_diagnostics_ok,
+    observation_bucket_size,
+    pad_observations,
+)
 
 # Difficulties
 OBSERVED_DIFFS = np.array([1, 3, 2, 2, 3, 3, 1, 2, 3, 1, 3, 2, 2, 3, 3, 1, 2, 3])
@@ -62,3 +83,336 @@ def test_predictions_consistent(
 
     assert orig_mcmc_pred.shape == mcmc2_pred.shape
     assert all(np.abs(orig_mcmc_pred - mcmc2_pred) < 0.05)
+
+
+@pytest.mark.parametrize(
+    "answers",
+    [
+        np.array([1]),
+        np.array([1, 0, 0, 0, 1, 0, 1, 0, 0, 1]),
+        np.array([1, 1, 0, 1, 1, 1, 1, 0, 1, 1]),
+    ],
+)
+@pytest.mark.parametrize("theta_params", [GaussianParams(0, 0.25), GaussianParams(5, 1)])
+def test_quadrature_agrees_with_nuts(answers: np.ndarray, theta_params: GaussianParams):
+    mcmc = MCMCInference(theta_params)
+    quadrature = QuadratureInference(theta_params)
+    for inference in [mcmc, quadrature]:
+        inference.run_mcmc_inference(
+            difficulties=OBSERVED_DIFFS[: len(answers)],
+            guess_probs=OBSERVED_PROBS[: len(answers)],
+            answers=answers,
+        )
+    mcmc_theta, quadrature_theta = mcmc.inferred_theta_params, quadrature.inferred_theta_params
+    assert abs(mcmc_theta.mean - quadrature_theta.mean) < 0.2 * quadrature_theta.std_dev
+
+    questions_to_predict = (np.arange(5), np.array([0.25, 0.5, 0.25, 0.5, 0.25]))
+    mcmc_pred = mcmc.calculate_correct_probs(*questions_to_predict)
+    quadrature_pred = quadrature.calculate_correct_probs(*questions_to_predict)
+    assert all(np.abs(mcmc_pred - quadrature_pred) < 0.05)
+
+
+def test_quadrature_without_observations():
+    quadrature = QuadratureInference(GaussianParams(0, 0.25))
+    with pytest.raises(AssertionError):
+        quadrature.run_mcmc_inference(
+            difficulties=np.array([]), guess_probs=np.array([]), answers=np.array([])
+        )
+
+
+def test_get_inference_engine():
+    assert get_inference_engine("nuts") is MCMCInference
+    assert get_inference_engine("quadrature") is QuadratureInference
+    with pytest.raises(AssertionError):
+        get_inference_engine("not_an_engine")
+
+
+def test_incomplete_engine_not_instantiated():
+    class IncompleteInference(GaussianApproximationInference):
+        pass
+
+    with pytest.raises(TypeError):
+        IncompleteInference(GaussianParams(0, 1))
+
+
+def test_weighted_theta_posterior():
+    inference = QuadratureInference(GaussianParams(1, 1))
+    inference.run_mcmc_inference(OBSERVED_DIFFS[:5], OBSERVED_PROBS[:5], np.array([1, 0, 0, 1, 1]))
+    posterior = WeightedThetaPosterior(
+        GaussianParams(1, 1), *inference.theta_weights, num_observations=5
+    )
+    # A posterior, but not an inference engine - it can't be updated with more answers
+    assert not isinstance(posterior, KnowledgeStateInference)
+    assert posterior.inferred_theta_params.mean == pytest.approx(
+        inference.inferred_theta_params.mean
+    )
+    assert posterior.inferred_theta_params.std_dev == pytest.approx(
+        inference.inferred_theta_params.std_dev
+    )
+    questions = (np.arange(4), np.full(4, 0.25))
+    assert np.allclose(
+        posterior.calculate_correct_probs(*questions), inference.calculate_correct_probs(*questions)
+    )
+
+
+@pytest.mark.parametrize(
+    "answers",
+    [
+        np.array([1, 0, 0, 0, 1, 0, 1, 0, 0, 1]),
+        np.array([1, 1, 0, 1, 1, 1, 1, 0, 1, 1]),
+    ],
+)
+@pytest.mark.parametrize("theta_params", [GaussianParams(0, 0.25), GaussianParams(5, 1)])
+def test_quadrature_sequential_updates(answers: np.ndarray, theta_params: GaussianParams):
+    batch = QuadratureInference(theta_params)
+    batch.run_mcmc_inference(
+        difficulties=OBSERVED_DIFFS[: len(answers)],
+        guess_probs=OBSERVED_PROBS[: len(answers)],
+        answers=answers,
+    )
+    sequential = QuadratureInference(theta_params)
+    for i in range(len(answers)):
+        sequential.run_mcmc_inference(
+            difficulties=OBSERVED_DIFFS[i : i + 1],
+            guess_probs=OBSERVED_PROBS[i : i + 1],
+            answers=answers[i : i + 1],
+        )
+    assert sequential.num_observations == batch.num_observations == len(answers)
+    assert np.isclose(sequential.inferred_theta_params.mean, batch.inferred_theta_params.mean)
+    assert np.isclose(sequential.inferred_theta_params.std_dev, batch.inferred_theta_params.std_dev)
+
+
+@pytest.mark.parametrize("theta_params", [GaussianParams(0, 0.25), GaussianParams(5, 2)])
+def test_prior_predictions_match(theta_params: GaussianParams):
+    """With no answers observed, both engines predict with the prior, so must agree closely."""
+    questions_to_predict = (np.arange(8), np.array([0.25, 0.5] * 4))
+    mcmc_pred = MCMCInference(theta_params).calculate_correct_probs(*questions_to_predict)
+    quadrature_pred = QuadratureInference(theta_params).calculate_correct_probs(
+        *questions_to_predict
+    )
+    assert all(np.abs(mcmc_pred - quadrature_pred) < 1e-4)
+
+
+def test_correct_probs_memoized():
+    quadrature = QuadratureInference(GaussianParams(2, 1))
+    questions_to_predict = (np.arange(4), np.array([0.25, 0.5, 0.25, 0.5]))
+    first_pred = quadrature.calculate_correct_probs(*questions_to_predict)
+    assert quadrature.calculate_correct_probs(*questions_to_predict) is first_pred
+
+    # Updating the posterior must invalidate the memoized probabilities
+    quadrature.run_mcmc_inference(np.array([3]), np.array([0.25]), np.array([1]))
+    assert all(quadrature.calculate_correct_probs(*questions_to_predict) > first_pred)
+
+
+@pytest.mark.parametrize("num_observations", [1, 4, 5, 6, 10, 11, 18])
+def test_pad_observations(num_observations: int):
+    padded_diffs, padded_guess_probs, padded_answers, mask = pad_observations(
+        OBSERVED_DIFFS[:num_observations],
+        OBSERVED_PROBS[:num_observations],
+        np.ones(num_observations),
+    )
+    bucket_size = observation_bucket_size(num_observations)
+    assert bucket_size >= num_observations
+    assert (
+        bucket_size in MCMC_OBSERVATION_BUCKETS or bucket_size % MCMC_OBSERVATION_BUCKETS[-1] == 0
+    )
+    assert padded_diffs.shape == padded_guess_probs.shape == padded_answers.shape == mask.shape
+    assert len(mask) == bucket_size and np.sum(mask) == num_observations
+    assert all(padded_diffs[mask] == OBSERVED_DIFFS[:num_observations])
+
+
+def test_nuts_kernel_reused_within_bucket():
+    for num_observations in [2, 3]:
+        MCMCInference(GaussianParams(1, 1)).run_mcmc_inference(
+            difficulties=OBSERVED_DIFFS[:num_observations],
+            guess_probs=OBSERVED_PROBS[:num_observations],
+            answers=np.ones(num_observations),
+        )
+    hits = NUTS_COMPILE_CACHE_STATS["hits"]
+    misses = NUTS_COMPILE_CACHE_STATS["misses"]
+    MCMCInference(GaussianParams(2, 0.5)).run_mcmc_inference(
+        difficulties=OBSERVED_DIFFS[:4], guess_probs=OBSERVED_PROBS[:4], answers=np.zeros(4)
+    )
+    assert NUTS_COMPILE_CACHE_STATS["hits"] == hits + 1
+    assert NUTS_COMPILE_CACHE_STATS["misses"] == misses
+
+
+def run_warm_started_nuts(num_observations: int) -> Tuple[MCMCInference, MCMCInference]:
+    """Runs NUTS on all but the last answer, then warm-starts a new run on all the answers from its
+    adaptation state."""
+    answers = np.array([1, 0, 1, 1, 0, 1, 1, 0, 1])[:num_observations]
+    cold_mcmc = MCMCInference(GaussianParams(1, 1))
+    cold_mcmc.run_mcmc_inference(
+        OBSERVED_DIFFS[: num_observations - 1], OBSERVED_PROBS[: num_observations - 1], answers[:-1]
+    )
+    warm_mcmc = MCMCInference(GaussianParams(1, 1))
+    warm_mcmc.import_adaptation_state(cold_mcmc.adaptation_state)
+    warm_mcmc.run_mcmc_inference(
+        OBSERVED_DIFFS[:num_observations], OBSERVED_PROBS[:num_observations], answers
+    )
+    quadrature = QuadratureInference(GaussianParams(1, 1))
+    quadrature.run_mcmc_inference(
+        OBSERVED_DIFFS[:num_observations], OBSERVED_PROBS[:num_observations], answers
+    )
+    return warm_mcmc, quadrature
+
+
+def test_nuts_warm_start():
+    warm_starts = NUTS_WARM_START_STATS["warm_starts"]
+    fallbacks = NUTS_WARM_START_STATS["fallbacks"]
+    warm_mcmc, quadrature = run_warm_started_nuts(num_observations=7)
+    assert NUTS_WARM_START_STATS["warm_starts"] == warm_starts + 1
+    assert NUTS_WARM_START_STATS["fallbacks"] == fallbacks
+    assert warm_mcmc.adaptation_state is not None
+    assert (
+        abs(warm_mcmc.inferred_theta_params.mean - quadrature.inferred_theta_params.mean)
+        < 0.2 * quadrature.inferred_theta_params.std_dev
+    )
+
+
+def test_nuts_warm_start_falls_back(monkeypatch):
+    monkeypatch.setattr("questions.inference.nuts_diagnostics_ok", lambda *args: False)
+    fallbacks = NUTS_WARM_START_STATS["fallbacks"]
+    warm_mcmc, quadrature = run_warm_started_nuts(num_observations=7)
+    assert NUTS_WARM_START_STATS["fallbacks"] == fallbacks + 1
+    assert (
+        abs(warm_mcmc.inferred_theta_params.mean - quadrature.inferred_theta_params.mean)
+        < 0.2 * quadrature.inferred_theta_params.std_dev
+    )
+
+
+def test_nuts_diagnostics_ok():
+    rng = np.random.default_rng(1)
+    independent_samples = rng.normal(size=1000)
+    assert nuts_diagnostics_ok(independent_samples, np.zeros(1000, dtype=bool))
+    # A single divergence fails the check
+    assert not nuts_diagnostics_ok(independent_samples, np.arange(1000) == 500)
+    # A slowly-mixing chain, drifting away from where it started
+    assert not nuts_diagnostics_ok(np.cumsum(independent_samples), np.zeros(1000, dtype=bool))
+
+
+def test_adaptive_nuts():
+    answers = np.array([1, 0, 1, 1, 0, 1, 1])
+    observations = (OBSERVED_DIFFS[: len(answers)], OBSERVED_PROBS[: len(answers)], answers)
+    adaptive_mcmc = AdaptiveMCMCInference(GaussianParams(1, 1))
+    adaptive_mcmc.run_mcmc_inference(*observations)
+    quadrature = QuadratureInference(GaussianParams(1, 1))
+    quadrature.run_mcmc_inference(*observations)
+
+    targets = adaptive_mcmc.convergence_targets
+    diagnostics = adaptive_mcmc.diagnostics
+    assert diagnostics.num_samples == len(adaptive_mcmc.theta_weights[0])
+    assert diagnostics.effective_sample_size >= targets.min_effective_sample_size
+    assert diagnostics.r_hat <= targets.max_r_hat
+    assert diagnostics.num_warmup_steps <= targets.max_warmup_samples
+    assert (
+        abs(adaptive_mcmc.inferred_theta_params.mean - quadrature.inferred_theta_params.mean)
+        < 0.2 * quadrature.inferred_theta_params.std_dev
+    )
+
+
+def test_adaptive_nuts_caps():
+    targets = NUTSConvergenceTargets(min_effective_sample_size=np.inf, max_samples=500)
+    mcmc = MCMCInference(GaussianParams(1, 1), convergence_targets=targets)
+    mcmc.run_mcmc_inference(OBSERVED_DIFFS[:3], OBSERVED_PROBS[:3], np.array([1, 0, 1]))
+    assert mcmc.diagnostics.num_samples == targets.max_samples
+    assert mcmc.diagnostics.num_warmup_steps <= targets.max_warmup_samples
+
+
+BATCHED_PROBLEMS = [
+    InferenceProblem(GaussianParams(1, 1), OBSERVED_DIFFS[:3], OBSERVED_PROBS[:3], np.ones(3)),
+    InferenceProblem(GaussianParams(0, 0.5), OBSERVED_DIFFS[:7], OBSERVED_PROBS[:7], np.zeros(7)),
+    InferenceProblem(
+        GaussianParams(2, 2), OBSERVED_DIFFS[:12], OBSERVED_PROBS[:12], np.arange(12) % 2
+    ),
+]
+
+
+@pytest.mark.parametrize("engine", [MCMCInference, QuadratureInference])
+def test_batched_inference(engine):
+    posteriors = engine.run_batched_inference(BATCHED_PROBLEMS)
+    assert len(posteriors) == len(BATCHED_PROBLEMS)
+    for posterior, problem in zip(posteriors, BATCHED_PROBLEMS):
+        expected = QuadratureInference(problem.prior)
+        expected.run_mcmc_inference(problem.difficulties, problem.guess_probs, problem.answers)
+        assert posterior.num_observations == len(problem.answers)
+        assert (
+            abs(posterior.inferred_theta_params.mean - expected.inferred_theta_params.mean)
+            < 0.2 * expected.inferred_theta_params.std_dev
+        )
+
+
+@pytest.mark.filterwarnings("ignore:There are fewer JAX devices")
+@pytest.mark.parametrize("chain_method", ["vectorized", "parallel"])
+def test_multi_chain_nuts(chain_method: str):
+    answers = np.array([1, 0, 1, 1, 0, 1, 1])
+    observations = (OBSERVED_DIFFS[: len(answers)], OBSERVED_PROBS[: len(answers)], answers)
+    mcmc = MCMCInference(GaussianParams(1, 1), num_chains=2, chain_method=chain_method)
+    mcmc.run_mcmc_inference(*observations)
+    quadrature = QuadratureInference(GaussianParams(1, 1))
+    quadrature.run_mcmc_inference(*observations)
+
+    assert mcmc.diagnostics.num_chains == 2
+    assert mcmc.diagnostics.num_samples == len(mcmc.theta_weights[0]) == 1000
+    assert mcmc.diagnostics.r_hat < 1.05
+    assert (
+        abs(mcmc.inferred_theta_params.mean - quadrature.inferred_theta_params.mean)
+        < 0.2 * quadrature.inferred_theta_params.std_dev
+    )
+
+
+# The Laplace approximation ignores the skew of the posterior, so is less accurate
+@pytest.mark.parametrize(
+    "engine, tolerance, prob_tolerance",
+    [(LaplaceInference, 0.7, 0.25), (VariationalInference, 0.2, 0.05)],
+)
+@pytest.mark.parametrize("problem", BATCHED_PROBLEMS)
+def test_gaussian_approximations(
+    engine, tolerance: float, prob_tolerance: float, problem: InferenceProblem
+):
+    approximation = engine(problem.prior)
+    approximation.run_mcmc_inference(problem.difficulties, problem.guess_probs, problem.answers)
+    quadrature = QuadratureInference(problem.prior)
+    quadrature.run_mcmc_inference(problem.difficulties, problem.guess_probs, problem.answers)
+
+    expected = quadrature.inferred_theta_params
+    assert approximation.num_observations == len(problem.answers)
+    assert (
+        abs(approximation.inferred_theta_params.mean - expected.mean) < tolerance * expected.std_dev
+    )
+    assert abs(approximation.inferred_theta_params.std_dev / expected.std_dev - 1) < tolerance
+    questions_to_predict = (np.arange(5), np.array([0.25, 0.5, 0.25, 0.5, 0.25]))
+    assert all(
+        np.abs(
+            approximation.calculate_correct_probs(*questions_to_predict)
+            - quadrature.calculate_correct_probs(*questions_to_predict)
+        )
+        < prob_tolerance
+    )
+
+
+def test_laplace_finds_global_mode():
+    # The answers contradict the prior, which leaves a local mode near the prior mean
+    prior = GaussianParams(4.6, 1.25)
+    answers = np.array([0, 1, 0, 1, 1, 0, 0, 0, 1, 1, 0, 0, 1, 1, 1, 0, 0, 1])
+    laplace = LaplaceInference(prior)
+    laplace.run_mcmc_inference(OBSERVED_DIFFS, OBSERVED_PROBS, answers)
+    quadrature = QuadratureInference(prior)
+    quadrature.run_mcmc_inference(OBSERVED_DIFFS, OBSERVED_PROBS, answers)
+    expected = quadrature.inferred_theta_params
+    assert abs(laplace.inferred_theta_params.mean - expected.mean) < 0.5 * expected.std_dev
+
+
+def test_jax_imported_lazily():
+    imported = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, questions.inference, questions.inference_service; "
+            "print('jax' in sys.modules, 'numpyro' in sys.modules)",
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert imported.stdout.split() == ["False", "False"]
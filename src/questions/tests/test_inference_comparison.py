@@ -0,0 +1,44 @@
+import numpy as np
+
+from questions.inference import GaussianParams, InferenceProblem
+from questions.inference_comparison import (
+    EngineComparison,
+    cheapest_engine_within_tolerance,
+    compare_inference_engines,
+)
+
+PROBLEMS = [
+    InferenceProblem(GaussianParams(1, 1), np.array([1.0, 2, 3]), np.full(3, 0.25), np.ones(3)),
+    InferenceProblem(
+        GaussianParams(2, 0.5), np.array([1.0, 2, 2, 3]), np.full(4, 0.5), np.array([1, 0, 1, 0])
+    ),
+]
+
+
+def test_compare_inference_engines():
+    comparisons = compare_inference_engines(
+        PROBLEMS, ["laplace", "variational"], reference_engine_name="quadrature"
+    )
+    assert [comparison.engine_name for comparison in comparisons] == [
+        "quadrature",
+        "laplace",
+        "variational",
+    ]
+    reference = comparisons[0]
+    assert reference.max_mean_error == reference.p95_correct_prob_error == 0
+    for comparison in comparisons:
+        assert comparison.num_problems == len(PROBLEMS)
+        assert comparison.p95_mean_error <= comparison.max_mean_error < 0.5
+        assert 0 < comparison.median_latency_ms <= comparison.p95_latency_ms
+
+
+def test_cheapest_engine_within_tolerance():
+    def comparison(engine_name: str, mean_error: float, median_latency_ms: float):
+        return EngineComparison(
+            engine_name, 10, mean_error, mean_error, 0, 0, median_latency_ms, median_latency_ms
+        )
+
+    comparisons = [comparison("nuts", 0, 100), comparison("a", 0.1, 5), comparison("b", 0.5, 1)]
+    assert cheapest_engine_within_tolerance(comparisons, 0.2, 0.05) == "a"
+    assert cheapest_engine_within_tolerance(comparisons, 1, 0.05) == "b"
+    assert cheapest_engine_within_tolerance(comparisons[1:], 0.01, 0.05) is None
@@ -0,0 +1,173 @@
+import threading
+import time
+from typing import Any, Dict
+
+import numpy as np
+import pytest
+
+from questions.inference import GaussianParams, QuadratureInference
+from questions.inference_service import (
+    InferenceJobError,
+    InferenceTimeoutError,
+    InferenceWorker,
+    LocalInferenceQueue,
+    get_inference_queue,
+    run_inference_jobs,
+    submit_inference,
+)
+
+from .test_inference import OBSERVED_DIFFS, OBSERVED_PROBS
+
+ANSWERS = np.array([1, 0, 0, 1, 1, 0, 1])
+
+
+@pytest.fixture
+def inference_queue() -> LocalInferenceQueue:
+    inference_queue = LocalInferenceQueue()
+    for _ in range(2):
+        worker = InferenceWorker(inference_queue)
+        threading.Thread(target=worker.run_forever, daemon=True).start()
+    return inference_queue
+
+
+@pytest.mark.parametrize("engine_name", ["quadrature", "nuts"])
+def test_submit_inference(inference_queue: LocalInferenceQueue, engine_name: str):
+    prior = GaussianParams(1, 1)
+    posterior = submit_inference(
+        inference_queue,
+        engine_name,
+        prior,
+        OBSERVED_DIFFS[: len(ANSWERS)],
+        OBSERVED_PROBS[: len(ANSWERS)],
+        ANSWERS,
+        timeout=60,
+    )
+    expected = QuadratureInference(prior)
+    expected.run_mcmc_inference(
+        OBSERVED_DIFFS[: len(ANSWERS)], OBSERVED_PROBS[: len(ANSWERS)], ANSWERS
+    )
+    assert posterior.num_observations == len(ANSWERS)
+    assert (
+        abs(posterior.inferred_theta_params.mean - expected.inferred_theta_params.mean)
+        < 0.2 * expected.inferred_theta_params.std_dev
+    )
+    questions_to_predict = (np.arange(4), np.full(4, 0.25))
+    assert all(
+        np.abs(
+            posterior.calculate_correct_probs(*questions_to_predict)
+            - expected.calculate_correct_probs(*questions_to_predict)
+        )
+        < 0.05
+    )
+
+
+def test_submit_inference_timeout():
+    with pytest.raises(InferenceTimeoutError):
+        submit_inference(
+            LocalInferenceQueue(),  # No workers are taking jobs from this queue
+            "quadrature",
+            GaussianParams(1, 1),
+            OBSERVED_DIFFS[:1],
+            OBSERVED_PROBS[:1],
+            np.ones(1),
+            timeout=0.1,
+        )
+
+
+def test_failed_job_raises(inference_queue: LocalInferenceQueue):
+    with pytest.raises(InferenceJobError):
+        submit_inference(
+            inference_queue,
+            "quadrature",
+            GaussianParams(1, 1),
+            np.array([]),
+            np.array([]),
+            np.array([]),
+            timeout=60,
+        )
+
+
+def test_adaptation_state_returned(inference_queue: LocalInferenceQueue):
+    posterior = submit_inference(
+        inference_queue,
+        "nuts",
+        GaussianParams(1, 1),
+        OBSERVED_DIFFS[: len(ANSWERS) - 1],
+        OBSERVED_PROBS[: len(ANSWERS) - 1],
+        ANSWERS[:-1],
+        timeout=60,
+    )
+    assert posterior.adaptation_state is not None
+    warm_posterior = submit_inference(
+        inference_queue,
+        "nuts",
+        GaussianParams(1, 1),
+        OBSERVED_DIFFS[: len(ANSWERS)],
+        OBSERVED_PROBS[: len(ANSWERS)],
+        ANSWERS,
+        timeout=60,
+        adaptation_state=posterior.adaptation_state,
+    )
+    assert warm_posterior.num_observations == len(ANSWERS)
+    assert warm_posterior.adaptation_state is not None
+
+
+def inference_job(
+    job_id: str, num_observations: int, expires_at: float = float("inf")
+) -> Dict[str, Any]:
+    return {
+        "id": job_id,
+        "engine": "quadrature",
+        "prior": [1, 1],
+        "difficulties": OBSERVED_DIFFS[:num_observations].tolist(),
+        "guess_probs": OBSERVED_PROBS[:num_observations].tolist(),
+        "answers": ANSWERS[:num_observations].tolist(),
+        "expires_at": expires_at,
+    }
+
+
+def test_jobs_coalesced_into_batch():
+    inference_queue = LocalInferenceQueue()
+    for num_observations in range(1, 5):
+        inference_queue.push_job(inference_job(str(num_observations), num_observations))
+    assert InferenceWorker(inference_queue, max_batch_size=3).run_once(timeout=0.1)
+    # The first 3 jobs are run together, leaving the last in the queue
+    for num_observations in range(1, 4):
+        result = inference_queue.pop_result(str(num_observations), timeout=0.1)
+        assert result["num_observations"] == num_observations
+    assert inference_queue.pop_jobs(max_jobs=10) == [inference_job("4", 4)]
+
+
+def test_batch_run_when_full():
+    inference_queue = LocalInferenceQueue()
+    worker = InferenceWorker(inference_queue, batch_window_secs=10, max_batch_size=2)
+    inference_queue.push_job(inference_job("1", 1))
+    # Jobs arriving within the window join the batch, which is run as soon as it's full
+    threading.Timer(0.05, inference_queue.push_job, args=(inference_job("2", 2),)).start()
+    start_time = time.perf_counter()
+    assert worker.run_once(timeout=0.1)
+    assert time.perf_counter() - start_time < 5
+    for num_observations in [1, 2]:
+        result = inference_queue.pop_result(str(num_observations), timeout=0.1)
+        assert result["num_observations"] == num_observations
+
+
+def test_expired_jobs_dropped():
+    inference_queue = LocalInferenceQueue()
+    inference_queue.push_job(inference_job("expired", 1, expires_at=time.time() - 1))
+    inference_queue.push_job(inference_job("1", 1))
+    assert InferenceWorker(inference_queue).run_once(timeout=0.1)
+    assert inference_queue.pop_result("expired", timeout=0.1) is None
+    assert inference_queue.pop_result("1", timeout=0.1)["num_observations"] == 1
+
+
+def test_failed_job_in_batch():
+    failing_job = {**inference_job("failing", 0), "difficulties": [], "answers": []}
+    results = run_inference_jobs([inference_job("1", 1), failing_job, inference_job("2", 2)])
+    assert "error" in results[1]
+    assert results[0]["num_observations"] == 1 and results[2]["num_observations"] == 2
+
+
+def test_inference_queue_per_url():
+    redis_url = "redis://localhost:6379/0"  # Not connected to until a job is pushed
+    assert get_inference_queue(redis_url) is get_inference_queue(redis_url)
@@ -0,0 +1,103 @@
+import itertools
+
+import numpy as np
+
+from questions.inference import GaussianParams, QuadratureInference
+from questions.posterior_lookup import POSTERIOR_LOOKUP_PRIOR_RESOLUTION, PosteriorLookup
+
+from .test_inference import OBSERVED_DIFFS, OBSERVED_PROBS
+
+ANSWERS = np.array([1, 0, 0, 1, 1, 0, 1])
+
+
+def run_quadrature(prior: GaussianParams, order: np.ndarray) -> QuadratureInference:
+    inference = QuadratureInference(prior)
+    inference.run_mcmc_inference(OBSERVED_DIFFS[order], OBSERVED_PROBS[order], ANSWERS[order])
+    return inference
+
+
+def test_key_ignores_answer_order_and_prior_within_bucket():
+    order = np.arange(len(ANSWERS))
+    reordered = order[::-1]
+    key = PosteriorLookup.key(
+        "nuts", GaussianParams(1, 1), OBSERVED_DIFFS[order], OBSERVED_PROBS[order], ANSWERS[order]
+    )
+    assert key == PosteriorLookup.key(
+        "nuts",
+        GaussianParams(1.01, 0.99),
+        OBSERVED_DIFFS[reordered],
+        OBSERVED_PROBS[reordered],
+        ANSWERS[reordered],
+    )
+    different_answers = PosteriorLookup.key(
+        "nuts", GaussianParams(1, 1), OBSERVED_DIFFS[order], OBSERVED_PROBS[order], 1 - ANSWERS
+    )
+    different_prior = PosteriorLookup.key(
+        "nuts", GaussianParams(1.5, 1), OBSERVED_DIFFS[order], OBSERVED_PROBS[order], ANSWERS
+    )
+    assert key != different_answers and key != different_prior
+
+
+def test_posterior_independent_of_answer_order():
+    order = np.arange(len(ANSWERS))
+    posterior = run_quadrature(GaussianParams(1, 1), order).inferred_theta_params
+    reordered_posterior = run_quadrature(GaussianParams(1, 1), order[::-1]).inferred_theta_params
+    assert abs(posterior.mean - reordered_posterior.mean) < 1e-9
+    assert abs(posterior.std_dev - reordered_posterior.std_dev) < 1e-9
+
+
+def test_posterior_within_bucket():
+    order = np.arange(len(ANSWERS))
+    posterior = run_quadrature(GaussianParams(1, 1), order).inferred_theta_params
+    # Priors at the corners of the bucket
+    offsets = [-0.49 * POSTERIOR_LOOKUP_PRIOR_RESOLUTION, 0.49 * POSTERIOR_LOOKUP_PRIOR_RESOLUTION]
+    for mean_offset, std_dev_offset in itertools.product(offsets, offsets):
+        prior = GaussianParams(1 + mean_offset, 1 + std_dev_offset)
+        assert PosteriorLookup.key(
+            "quadrature", prior, OBSERVED_DIFFS, OBSERVED_PROBS, ANSWERS
+        ) == (
+            PosteriorLookup.key(
+                "quadrature", GaussianParams(1, 1), OBSERVED_DIFFS, OBSERVED_PROBS, ANSWERS
+            )
+        )
+        bucket_posterior = run_quadrature(prior, order).inferred_theta_params
+        assert abs(bucket_posterior.mean - posterior.mean) < POSTERIOR_LOOKUP_PRIOR_RESOLUTION / 2
+        assert (
+            abs(bucket_posterior.std_dev - posterior.std_dev)
+            < POSTERIOR_LOOKUP_PRIOR_RESOLUTION / 2
+        )
+
+
+def test_lookup_returns_stored_posterior():
+    lookup = PosteriorLookup()
+    prior = GaussianParams(1.01, 0.99)
+    order = np.arange(len(ANSWERS))
+    key = PosteriorLookup.key("quadrature", prior, OBSERVED_DIFFS, OBSERVED_PROBS, ANSWERS)
+    assert lookup.get(key) is None
+    posterior = run_quadrature(prior, order)
+    lookup.put(key, posterior)
+
+    looked_up = lookup.get(key)
+    assert lookup.stats == {"hits": 1, "misses": 1}
+    assert looked_up.num_observations == len(ANSWERS)
+    assert abs(looked_up.inferred_theta_params.mean - posterior.inferred_theta_params.mean) < 1e-4
+    questions_to_predict = (np.arange(4), np.full(4, 0.25))
+    assert all(
+        np.abs(
+            looked_up.calculate_correct_probs(*questions_to_predict)
+            - posterior.calculate_correct_probs(*questions_to_predict)
+        )
+        < 1e-4
+    )
+
+
+def test_least_recently_used_evicted():
+    lookup = PosteriorLookup(max_size=2)
+    posterior = run_quadrature(GaussianParams(1, 1), np.arange(len(ANSWERS)))
+    for key in ["a", "b"]:
+        lookup.put(key, posterior)
+    lookup.get("a")
+    lookup.put("c", posterior)
+    assert len(lookup) == 2
+    assert lookup.get("b") is None
+    assert lookup.get("a") is not None and lookup.get("c") is not None
@@ -0,0 +1,109 @@
+import time
+from datetime import timedelta
+
+import pytest
+
+from questions.models.question_template import PREREQ_QUESTION_DIFF, QuestionTemplate
+from questions.question_pool import (
+    QUESTION_POOL_LOW_WATER_MARK,
+    QUESTION_POOL_REFILL_EXPIRY_SECS,
+    QUESTION_POOL_SIZE,
+    LocalQuestionPool,
+    QuestionPoolWorker,
+    get_question_pool,
+    question_pool_key,
+    question_pool_stats,
+    refill_template_pool,
+    take_question,
+)
+
+
+def test_refill_template_pool(template: QuestionTemplate):
+    pool = LocalQuestionPool()
+    assert refill_template_pool(pool, template) == QUESTION_POOL_SIZE
+    assert refill_template_pool(pool, template) == 0
+
+    questions, _ = pool.take(question_pool_key(template), QUESTION_POOL_SIZE)
+    params = [tuple(question["params"].items()) for question in questions]
+    assert len(set(params)) == QUESTION_POOL_SIZE
+
+
+def test_take_question(template: QuestionTemplate):
+    pool = LocalQuestionPool()
+    refill_template_pool(pool, template)
+    key = question_pool_key(template)
+    questions, _ = pool.take(key, QUESTION_POOL_SIZE)
+    pool.put(key, questions[:3])
+
+    question = take_question(pool, template, [questions[0]["params"]])
+    assert question is not None and question["params"] == questions[1]["params"]
+    assert question["template_id"] == template.id
+    assert question["difficulty"] == template.difficulty
+    # The questions which weren't taken are put back
+    assert pool.size(key) == 2
+
+    question = take_question(pool, template, [], prerequisite_concept=True)
+    assert question["difficulty"] == PREREQ_QUESTION_DIFF
+
+
+def test_take_question__refill_requested(template: QuestionTemplate):
+    pool = LocalQuestionPool()
+    assert take_question(pool, template, []) is None
+    concept_id, _ = pool.pop_refill_request(timeout=0)
+    assert concept_id == template.concept.cytoscape_id
+
+    refill_template_pool(pool, template)
+    pool.finish_refill(concept_id)
+    for _ in range(QUESTION_POOL_SIZE - QUESTION_POOL_LOW_WATER_MARK):
+        assert take_question(pool, template, []) is not None
+    assert pool.pop_refill_request(timeout=0) is None
+    # Requested once when the pool falls below the low-water mark, until it's refilled
+    take_question(pool, template, [])
+    take_question(pool, template, [])
+    assert pool.pop_refill_request(timeout=0) is not None
+    assert pool.pop_refill_request(timeout=0) is None
+
+    stats = question_pool_stats(pool)
+    assert stats["misses"] == 1
+    assert stats["hit_rate"] == pytest.approx(stats["hits"] / (stats["hits"] + 1))
+
+
+class FailingManager:
+    def filter(self, *args, **kwargs):
+        raise RuntimeError("The database is down")
+
+
+def test_refill_concept_pools__failed(monkeypatch):
+    pool = LocalQuestionPool()
+    pool.request_refill("1")
+    monkeypatch.setattr(QuestionTemplate, "objects", FailingManager())
+    with pytest.raises(RuntimeError):
+        QuestionPoolWorker(pool).run_once(timeout=0)
+    # The concept can be queued again
+    pool.request_refill("1")
+    assert pool.pop_refill_request(timeout=0)[0] == "1"
+
+
+def test_refill_request_expires(monkeypatch):
+    pool = LocalQuestionPool()
+    pool.request_refill("1")
+    # Taken by a worker which is killed before finishing the refill
+    pool.pop_refill_request(timeout=0)
+    pool.request_refill("1")
+    assert pool.pop_refill_request(timeout=0) is None
+
+    expired_time = time.time() + QUESTION_POOL_REFILL_EXPIRY_SECS + 1
+    monkeypatch.setattr(time, "time", lambda: expired_time)
+    pool.request_refill("1")
+    assert pool.pop_refill_request(timeout=0)[0] == "1"
+
+
+def test_question_pool_key_changes_on_edit(template: QuestionTemplate):
+    key = question_pool_key(template)
+    template.last_updated += timedelta(seconds=1)
+    assert question_pool_key(template) != key
+
+
+def test_question_pool_per_url():
+    redis_url = "redis://localhost:6379/0"  # Not connected to until the pool is used
+    assert get_question_pool(redis_url) is get_question_pool(redis_url)
@@ -0,0 +1,84 @@
+from io import StringIO
+from uuid import uuid4
+
+from django.core.management import call_command
+from django.test import TestCase
+
+from accounts.models import User
+from knowledge_maps.models import Concept
+from questions.models import QuestionResponse, QuestionTemplate
+from questions.models.question_batch import QuestionBatch
+from questions.models.question_response import question_snapshot
+from questions.models.question_template import PREREQ_QUESTION_DIFF
+
+from .template_test_data import QuestionWithParamsOne
+
+PARAMS = {"A": "1", "B": "2"}
+
+
+def test_json__snapshot(template: QuestionTemplate):
+    question = template.render_question(PARAMS, prerequisite_concept=True)
+    response = QuestionResponse(
+        id=uuid4(),
+        question_template_id=template.id,
+        question_params=question["params"],
+        answer_letters=question["answer_letters"],
+        question_snapshot=question_snapshot(question),
+        predicted_prob_correct=0.5,
+    )
+    # Shown as it was asked without the template, which has been edited since
+    template.template_text = "Edited"
+    assert response.json == {**question, "id": response.id}
+    assert response.difficulty == question["difficulty"]
+    assert response.number_of_answers == len(question["answers_order_randomised"])
+
+
+class BackfillQuestionSnapshotsTests(TestCase):
+    @staticmethod
+    def create_response(
+        user: User, template: QuestionTemplate, concept: Concept
+    ) -> QuestionResponse:
+        q_batch = QuestionBatch.objects.create(
+            user=user,
+            concept=concept,
+            initial_display_knowledge_level=0,
+            initial_knowledge_mean=0,
+            initial_knowledge_std_dev=1,
+            session_id="test",
+        )
+        return QuestionResponse.objects.create(
+            user=user,
+            question_template=template,
+            question_params=PARAMS,
+            question_batch=q_batch,
+            predicted_prob_correct=0.5,
+            session_id="test",
+        )
+
+    def test_backfill(self):
+        user = User.objects.create(id="test", name="test", picture="https://learney.me")
+        concept = Concept.objects.create(name="test", cytoscape_id="1")
+        prereq_concept = Concept.objects.create(name="prereq", cytoscape_id="2")
+        template = QuestionTemplate.objects.create(
+            title="test",
+            concept=concept,
+            difficulty=2,
+            question_type="practice",
+            template_text=QuestionWithParamsOne.QUESTION_TEMPLATE_STRING,
+            correct_answer_letter=QuestionWithParamsOne.CORRECT_ANSWER_LETTER,
+        )
+        response = self.create_response(user, template, concept)
+        prereq_response = self.create_response(user, template, prereq_concept)
+        assert QuestionResponse.objects.filter(question_snapshot__isnull=True).count() == 2
+
+        call_command("backfill_question_snapshots", chunk_size=1, stdout=StringIO())
+
+        response.refresh_from_db()
+        prereq_response.refresh_from_db()
+        question = template.to_question_json(PARAMS, answer_letters=response.answer_letters)
+        assert response.question_snapshot == question_snapshot(question)
+        assert response.json == {**question, "id": response.id}
+        assert response.difficulty == template.difficulty
+        assert response.number_of_answers == template.number_of_answers
+        assert prereq_response.difficulty == PREREQ_QUESTION_DIFF
+        assert not QuestionResponse.objects.filter(question_snapshot__isnull=True).exists()
@@ -0,0 +1,84 @@
+from dataclasses import replace
+from uuid import uuid4
+
+import numpy as np
+
+from questions.template_weights import (
+    QuestionCounts,
+    TemplateCatalog,
+    get_novelty_terms,
+    gumbel_top_k,
+)
+
+TEMPLATE_IDS = [uuid4() for _ in range(4)]
+CATALOG = TemplateCatalog(
+    template_ids=TEMPLATE_IDS,
+    param_options=[{}] * 4,
+    invalid_param_combinations=[None] * 4,
+    num_questions=np.array([1, 4, 9, 16]),
+    num_answers=np.array([4, 4, 2, 4]),
+    difficulties=np.array([0.0, 1, 2, 3]),
+    guess_probs=np.array([0.25, 0.25, 0.5, 0.25]),
+    question_types=np.array(["practice", "conceptual", "practice", "practice"], dtype=object),
+)
+
+
+def question_json(template_index: int):
+    return {
+        "template_id": TEMPLATE_IDS[template_index],
+        "question_type": CATALOG.question_types[template_index],
+    }
+
+
+def expected_novelty(template_index: int, questions, template_counts_to_avoid) -> float:
+    """Novelty term of a template, counted directly from the questions asked."""
+    n_qs = CATALOG.num_questions[template_index]
+    template_id = TEMPLATE_IDS[template_index]
+    num_batch_qs = sum(question["template_id"] == template_id for question in questions)
+    novelty = np.exp(-2.5 * num_batch_qs / np.sqrt(n_qs))
+    novelty *= 0.6 * np.exp(-2.5 * template_counts_to_avoid.get(str(template_id), 0) / n_qs) + 0.4
+    if len(questions) > 3:
+        num_of_type = sum(
+            question["question_type"] == CATALOG.question_types[template_index]
+            for question in questions
+        )
+        novelty *= 0.6 * np.exp(-2 * num_of_type / len(questions)) + 0.4
+    return novelty
+
+
+def test_novelty_terms():
+    template_counts_to_avoid = {str(TEMPLATE_IDS[1]): 2, str(TEMPLATE_IDS[3]): 1}
+    questions = []
+    question_counts = QuestionCounts()
+    for template_index in [0, 1, 1, 2, 3, 1]:
+        novelty_terms = get_novelty_terms(CATALOG, question_counts, template_counts_to_avoid)
+        assert np.allclose(
+            novelty_terms,
+            [expected_novelty(index, questions, template_counts_to_avoid) for index in range(4)],
+        )
+        questions.append(question_json(template_index))
+        question_counts.add(questions[-1])
+
+    assert question_counts == QuestionCounts.from_questions(questions)
+    assert question_counts.templates[str(TEMPLATE_IDS[1])] == 3
+    assert question_counts.question_types == {"practice": 3, "conceptual": 3}
+
+
+def test_novelty_terms__no_valid_questions():
+    catalog = replace(CATALOG, num_questions=np.array([0, 4, 9, 16]))
+    novelty_terms = get_novelty_terms(catalog, QuestionCounts(), {})
+    assert np.all(np.isfinite(novelty_terms)) and np.all(novelty_terms >= 0)
+
+
+def test_gumbel_top_k():
+    weights = np.array([0.1, 0, 0.5, 0.4, 0, np.nan])
+    for k in [1, 2, 3, 6]:
+        indices = gumbel_top_k(weights, k)
+        assert len(indices) == min(k, 3)
+        assert set(indices) <= {0, 2, 3}
+
+    # First draws are in proportion to the weights
+    first_draws = [gumbel_top_k(weights, 2)[0] for _ in range(4000)]
+    assert np.allclose(
+        np.bincount(first_draws, minlength=6) / 4000, np.nan_to_num(weights), atol=0.03
+    )
@@ -0,0 +1,98 @@
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+
+import pytest
+from django.core.management import call_command
+from django.test import TestCase
+
+from knowledge_maps.models import Concept
+from questions.models import question_template
+from questions.models.question_template import QuestionTemplate
+
+from .template_test_data import QuestionWithParamsOne, QuestionWithParamsTwo
+
+PARAMS = {"A": "1", "B": "2"}
+
+
+def fail_to_render(*args, **kwargs):
+    raise RuntimeError("The template was rendered")
+
+
+def test_render_question__answer_letters(template: QuestionTemplate):
+    question = template.render_question(PARAMS)
+    assert sorted(question["answer_letters"]) == ["a", "b", "c", "d"]
+    for _ in range(10):
+        assert template.render_question(PARAMS, answer_letters=question["answer_letters"]) == (
+            question
+        )
+    # Letters which aren't the template's are ignored
+    question = template.render_question(PARAMS, answer_letters=["a", "b"])
+    assert sorted(question["answer_letters"]) == ["a", "b", "c", "d"]
+
+
+def test_render_question__cached(template: QuestionTemplate, monkeypatch):
+    question = template.render_question(PARAMS)
+    monkeypatch.setattr(QuestionTemplate, "render_texts", fail_to_render)
+    assert template.render_question(PARAMS, answer_letters=question["answer_letters"]) == question
+    # From the shared cache, in another process
+    question_template._rendered_bodies.clear()
+    assert template.render_question(PARAMS, answer_letters=question["answer_letters"]) == question
+
+    # Edited templates are rendered again, whether or not they've been saved
+    template.template_text = QuestionWithParamsTwo.QUESTION_TEMPLATE_STRING
+    with pytest.raises(RuntimeError):
+        template.render_question(PARAMS)
+    template.template_text = QuestionWithParamsOne.QUESTION_TEMPLATE_STRING
+    template.last_updated += timedelta(seconds=1)
+    with pytest.raises(RuntimeError):
+        template.render_question(PARAMS)
+
+
+class CheckQuestionTemplatesTests(TestCase):
+    def test_deactivates_templates_without_valid_combinations(self):
+        template = QuestionTemplate.objects.create(
+            title="test",
+            concept=Concept.objects.create(name="test", cytoscape_id="1"),
+            difficulty=2,
+            question_type="practice",
+            template_text=QuestionWithParamsOne.QUESTION_TEMPLATE_STRING,
+            correct_answer_letter=QuestionWithParamsOne.CORRECT_ANSWER_LETTER,
+        )
+        assert template.active
+        # Edited without saving the model (as by a migration), so it hasn't been checked. Its
+        #  answers are the same whenever A == B
+        QuestionTemplate.objects.filter(id=template.id).update(
+            template_text=QuestionWithParamsOne.QUESTION_TEMPLATE_STRING.replace(
+                "param B: {1, 2, 3, 4, 5, 6, 7, 8, 9}", "param B: {1}"
+            ).replace("param A: {1, 2, 3, 4, 5, 6, 7, 8, 9}", "param A: {1}")
+        )
+
+        stdout = StringIO()
+        call_command("check_question_templates", stdout=stdout)
+
+        template.refresh_from_db()
+        assert not template.active
+        assert template.valid_params_bitmap is not None
+        assert template.params_checked_hash == template.template_text_hash
+        assert "0/1 valid" in stdout.getvalue()
+        assert "deactivated 1" in stdout.getvalue()
+
+
+class QuestionTemplateSaveTests(TestCase):
+    def test_save__update_fields(self):
+        template = QuestionTemplate.objects.create(
+            title="test",
+            concept=Concept.objects.create(name="test", cytoscape_id="1"),
+            difficulty=2,
+            question_type="practice",
+            template_text=QuestionWithParamsOne.QUESTION_TEMPLATE_STRING,
+            correct_answer_letter=QuestionWithParamsOne.CORRECT_ANSWER_LETTER,
+        )
+        template.template_text = QuestionWithParamsTwo.QUESTION_TEMPLATE_STRING
+        template.active = False
+        with mock.patch.object(QuestionTemplate, "check_param_combinations") as check:
+            template.save(update_fields=["active"])
+            check.assert_not_called()
+            template.save(update_fields=["template_text"])
+            check.assert_called_once()
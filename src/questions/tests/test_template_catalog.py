@@ -0,0 +1,70 @@
+from datetime import timedelta
+from typing import Callable
+
+import numpy as np
+import pytest
+
+from questions.models.question_template import PREREQ_QUESTION_DIFF, QuestionTemplate
+from questions.template_catalog import (
+    TEMPLATE_CATALOG_STATS,
+    get_template_catalog,
+    template_catalog_key,
+)
+from questions.template_parser import number_of_questions, parse_params
+
+from .template_test_data import QuestionWithoutParams, QuestionWithParamsOne, QuestionWithParamsTwo
+
+
+@pytest.fixture
+def templates(make_template: Callable[..., QuestionTemplate]):
+    concept_templates = [
+        make_template(QuestionWithParamsOne, 1, "practice"),
+        make_template(QuestionWithParamsTwo, 2, "conceptual"),
+    ]
+    prereq_templates = [make_template(QuestionWithoutParams, 3, "practice")]
+    return concept_templates, prereq_templates
+
+
+def test_template_catalog(templates):
+    concept_templates, prereq_templates = templates
+    catalog = get_template_catalog(concept_templates, prereq_templates)
+    all_templates = concept_templates + prereq_templates
+
+    assert len(catalog) == 3
+    assert catalog.template_ids == [template.id for template in all_templates]
+    assert catalog.param_options == [parse_params(t.template_text) for t in all_templates]
+    assert list(catalog.num_questions) == [
+        number_of_questions(template.template_text) for template in all_templates
+    ]
+    assert list(catalog.num_answers) == [template.number_of_answers for template in all_templates]
+    assert np.allclose(catalog.guess_probs, 1 / catalog.num_answers)
+    assert list(catalog.difficulties) == [1, 2, PREREQ_QUESTION_DIFF]
+    assert list(catalog.question_types) == ["practice", "conceptual", "practice"]
+
+
+def test_template_catalog_reused(templates):
+    concept_templates, prereq_templates = templates
+    catalog = get_template_catalog(concept_templates, prereq_templates)
+    hits = TEMPLATE_CATALOG_STATS["hits"]
+    assert get_template_catalog(concept_templates, prereq_templates) is catalog
+    assert TEMPLATE_CATALOG_STATS["hits"] == hits + 1
+
+
+def test_template_catalog_key_changes_on_edit(templates):
+    concept_templates, prereq_templates = templates
+    key = template_catalog_key(concept_templates, prereq_templates)
+    assert template_catalog_key(concept_templates + prereq_templates, []) != key
+
+    concept_templates[0].last_updated += timedelta(seconds=1)
+    assert template_catalog_key(concept_templates, prereq_templates) != key
+
+
+def test_template_catalog__checked_templates(templates):
+    concept_templates, prereq_templates = templates
+    concept_templates[0].check_param_combinations()
+    catalog = get_template_catalog(concept_templates, prereq_templates)
+
+    # Answers are the same when A == B
+    assert catalog.invalid_param_combinations[0] == {index * 9 + index for index in range(9)}
+    assert catalog.num_questions[0] == 81 - 9
+    assert catalog.invalid_param_combinations[1] is None
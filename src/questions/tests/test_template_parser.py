@@ -1,4 +1,6 @@
-from typing import Callable
+import time
+from collections import Counter
+from typing import Callable, Set
 from uuid import uuid4
 
 import pytest
@@ -6,6 +8,7 @@ from django.test import TestCase
 
 from knowledge_maps.models import Concept
 from questions.models.question_template import QuestionTemplate
+from questions.template_benchmark import worst_case_param_line
 from questions.template_parser import *
 
 from .template_test_data import *
@@ -99,6 +102,8 @@ def test_is_string(test_data: str) -> None:
         ("[1, 2, 2.3, 55]", True),
         ("[1, '2', 2]", True),
         ("[' ', '2', '2.3', '55']", True),
+        ("[1], [2]", False),
+        ("[1]x", False),
     ],
 )
 def test_is_list(test_data: str) -> None:
@@ -166,6 +171,19 @@ def test_parse_param_line__success(param_info: Tuple[str, str, List[Any]]) -> No
     assert param_options == param_info[2]
 
 
+def test_parse_param_line__long_list() -> None:
+    # Lists which aren't closed took the parameter line regex exponential time in their length
+    start_time = time.perf_counter()
+    assert not is_param_line(worst_case_param_line(2000))
+    assert time.perf_counter() - start_time < 1
+
+    param_name, param_options = parse_param_line(
+        worst_case_param_line(2000).replace(" x}", "], [2]}")
+    )
+    assert param_name == "A"
+    assert param_options == [[1] * 2000, [2]]
+
+
 @pytest.mark.parametrize("remaining_text", ["Question", "sefoiuahsekf ywesfkjblb"])
 @pytest.mark.parametrize(
     "params_info",
@@ -267,6 +285,56 @@ def test_expand_params_in_text__success_tricky_numbers(
     ) == test_data_pairs[1](*converted_params)
 
 
+@pytest.mark.parametrize(
+    "template",
+    [QuestionWithParamsOne, QuestionWithParamsTwo, QuestionWithoutParams],
+)
+def test_compiled_template(template) -> None:
+    param_options = parse_params(template.QUESTION_TEMPLATE_STRING)
+    compiled = CompiledTemplate(template.QUESTION_TEMPLATE_STRING, param_options)
+    value_strings = param_value_strings(param_options)
+    for index in range(num_param_combinations(param_options)):
+        sampled_params = params_from_combination_index(value_strings, index)
+        assert compiled.render(sampled_params) == expand_params_in_text(
+            template.QUESTION_TEMPLATE_STRING, sampled_params
+        )
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "<<A ** 2>> <<2 ** A>> <<-A>> <<abs(A)>>",
+        "<<[A * x for x in range(3)]>> <<max(L)>> <<L + [A]>> <<L.pop()>> <<L>>",
+        "<<AB + A>> <<B>> <<'A' + S>> <<S * 2>> <<len(S)>>",
+        "<<A / 3>> <<round(A / 7, 2)>> <<A if A > 0 else -A>>",
+        "<<A + >>",
+        "<<A + C>>",
+    ],
+)
+@pytest.mark.parametrize(
+    "sampled_params",
+    [
+        {"A": "-5", "AB": "2", "B": "3", "L": "[1, 2]", "S": "x"},
+        {"A": "4", "AB": "-2.5", "B": "S", "L": "[3]", "S": 'say "hi"'},
+        {"A": "1e-2", "AB": "0", "B": "x", "L": "['a', 'b']", "S": "A, B"},
+    ],
+)
+def test_compiled_template__same_as_expanding_text(text: str, sampled_params) -> None:
+    """Compiled expressions give the same output or error as substituting values into their text,
+    including where the substitution changes their meaning."""
+    compiled = CompiledTemplate(text, sampled_params)
+    try:
+        expected = expand_params_in_text(text, sampled_params)
+    except ParsingError as error:
+        with pytest.raises(ParsingError) as compiled_error:
+            compiled.render(sampled_params)
+        assert str(compiled_error.value) == str(error)
+        return
+    assert compiled.render(sampled_params) == expected
+    # Parameters which aren't the template's are substituted into its text
+    assert CompiledTemplate(text, []).render(sampled_params) == expected
+
+
 @pytest.mark.parametrize(
     "params",
     [
@@ -314,6 +382,78 @@ def test_sample_params__avoid__error(test_data: Tuple[ParamOptionsDict, List[Sam
     assert sample_params(test_data[0], test_data[1]) is None
 
 
+@pytest.mark.parametrize(
+    "params",
+    [
+        {"A": [1, 2, 3]},
+        {"A": [1, 2, 3], "B": ["x", "y"], "C": [[1, 2], [3, 4, 5], 6, 7]},
+        {"A": [1, 1, 2], "B": [3]},
+    ],
+)
+def test_param_combination_index(params: ParamOptionsDict):
+    value_strings = param_value_strings(params)
+    num_combinations = num_param_combinations(params)
+    combinations = [
+        params_from_combination_index(value_strings, index) for index in range(num_combinations)
+    ]
+    assert len({tuple(combination.items()) for combination in combinations}) == num_combinations
+    for index, combination in enumerate(combinations):
+        assert list(combination) == list(params)
+        assert param_combination_index(value_strings, combination) == index
+
+
+def test_param_combination_index__not_a_combination():
+    value_strings = param_value_strings({"A": [1, 2], "B": [3]})
+    assert param_combination_index(value_strings, {"A": "4", "B": "3"}) is None
+    assert param_combination_index(value_strings, {"A": "1"}) is None
+
+
+@pytest.mark.parametrize(
+    "used",
+    [set(), {0}, {9}, {0, 1, 2}, {3, 5, 6, 7}, {0, 1, 2, 3, 4, 5, 6, 7, 8}],
+)
+def test_sample_unused_index(used: Set[int]):
+    counts = Counter(sample_unused_index(10, used) for _ in range(2000))
+    assert set(counts) == set(range(10)) - used
+    # Uniform over the unused indices
+    assert min(counts.values()) > 2000 / (10 - len(used)) / 2
+
+
+@pytest.mark.parametrize("num_combinations", [1, 8, 13])
+def test_combinations_bitmap(num_combinations: int):
+    indices = set(range(0, num_combinations, 3))
+    bitmap = combinations_bitmap(indices, num_combinations)
+    assert len(bitmap) == (num_combinations + 7) // 8
+    assert unset_combinations(bitmap, num_combinations) == set(range(num_combinations)) - indices
+
+
+def test_sample_params__invalid_combinations():
+    params = {"A": [1, 2, 3], "B": [1, 2]}
+    value_strings = param_value_strings(params)
+    invalid = {0, 2, 3}
+    for _ in range(20):
+        sampled_params = sample_params(params, invalid_combinations=invalid)
+        assert param_combination_index(value_strings, sampled_params) not in invalid
+    assert not check_valid_params_exist(params, [{"A": "1", "B": "2"}, {"A": "3"}], {0, 2, 3, 4, 5})
+    assert sample_params(params, [{"A": "1", "B": "2"}], {0, 2, 3, 4, 5}) is None
+
+
+def test_sample_unused_index__all_used():
+    assert sample_unused_index(3, {0, 1, 2}) is None
+
+
+def test_sample_params__avoid__uses_every_combination():
+    params = {"A": [1, 2, 3, 4], "B": [1, 2, 3], "C": ["x", "y"]}
+    params_to_avoid: List[SampledParamsDict] = []
+    for _ in range(num_param_combinations(params)):
+        assert check_valid_params_exist(params, params_to_avoid)
+        sampled_params = sample_params(params, params_to_avoid)
+        assert sampled_params is not None and sampled_params not in params_to_avoid
+        params_to_avoid.append(sampled_params)
+    assert not check_valid_params_exist(params, params_to_avoid)
+    assert sample_params(params, params_to_avoid) is None
+
+
 @pytest.mark.parametrize(
     "text",
     [
@@ -411,9 +551,25 @@ class TestQuestionFromTemplate(TestCase):
                 "question_type": "test",
             }
             answers_order_randomised = question_dict.pop("answers_order_randomised")
+            answer_letters = question_dict.pop("answer_letters")
             assert all(answer in answers_order_randomised for answer in data_class.ANSWERS)
+            assert len(answer_letters) == len(answers_order_randomised)
             assert question_dict == expected_question_dict
 
     def test_question_from_template__sample(self):
         for template in self.templates:
             template.to_question_json()
+
+    def test_question_from_template__checked(self):
+        template = self.templates[0]
+        template.check_param_combinations()
+        # Answers are the same when A == B
+        assert len(template.param_errors) == 9
+        assert template.duplicate_question_groups == []
+        assert template.invalid_param_combinations == {index * 9 + index for index in range(9)}
+        for _ in range(50):
+            question = template.to_question_json()
+            assert question["params"]["A"] != question["params"]["B"]
+
+        template.template_text = template.template_text.replace("param B", "param C")
+        assert template.invalid_param_combinations is None
@@ -0,0 +1,77 @@
+import time
+from typing import Iterator
+
+import pytest
+
+from questions.template_parser import (
+    CompiledTemplate,
+    ParsingError,
+    param_value_strings,
+    params_from_combination_index,
+    parse_params,
+)
+from questions.template_sandbox import RenderTimeoutError, TemplateSandbox
+
+from .template_test_data import QuestionWithParamsOne, QuestionWithParamsTwo
+
+CPU_LIMIT_SECS = 0.2
+KILL_GRACE_SECS = 0.3
+# Expressions which never finish - one in Python, which the CPU time limit stops, and one in C,
+#  which doesn't check for signals so its worker is killed
+PYTHON_LOOP = "<<next(i for i in iter(int, 1) if i)>>"
+C_LOOP = "<<sum(range(10**15))>>"
+
+
+@pytest.fixture
+def sandbox() -> Iterator[TemplateSandbox]:
+    sandbox = TemplateSandbox(
+        num_workers=1, cpu_limit_secs=CPU_LIMIT_SECS, kill_grace_secs=KILL_GRACE_SECS
+    )
+    yield sandbox
+    sandbox.close()
+
+
+@pytest.mark.parametrize(
+    "template_text",
+    [
+        QuestionWithParamsOne.QUESTION_TEMPLATE_STRING,
+        QuestionWithParamsTwo.QUESTION_TEMPLATE_STRING,
+    ],
+)
+def test_render(sandbox: TemplateSandbox, template_text: str):
+    param_options = parse_params(template_text)
+    value_strings = param_value_strings(param_options)
+    combinations = [params_from_combination_index(value_strings, index) for index in range(10)]
+    compiled = CompiledTemplate(template_text, param_options)
+    assert sandbox.render(template_text, list(param_options), combinations) == [
+        compiled.render(sampled_params) for sampled_params in combinations
+    ]
+    # Rendered again from the cache
+    sandbox.render(template_text, list(param_options), combinations)
+    assert sandbox.stats["renders"] == sandbox.stats["cache_hits"] == len(combinations)
+
+
+def test_render__error(sandbox: TemplateSandbox):
+    [error] = sandbox.render("<<A / 0>>", ["A"], [{"A": "1"}])
+    assert isinstance(error, ParsingError) and "division by zero" in str(error)
+    # Memory is limited
+    [error] = sandbox.render("<<len(bytearray(2 * 1024**3))>>", [], [{}])
+    assert isinstance(error, ParsingError)
+
+
+@pytest.mark.parametrize("loop", [PYTHON_LOOP, C_LOOP])
+def test_render__timeout(sandbox: TemplateSandbox, loop: str):
+    start_time = time.perf_counter()
+    rendered = sandbox.render(f"Question {loop}", [], [{}, {}])
+    assert all(isinstance(error, RenderTimeoutError) for error in rendered)
+    assert time.perf_counter() - start_time < CPU_LIMIT_SECS + KILL_GRACE_SECS + 0.5
+    assert sandbox.stats["timeouts"] == 1
+    assert sandbox.stats["workers_killed"] == (loop == C_LOOP)
+
+    # The template isn't rendered again
+    start_time = time.perf_counter()
+    [error] = sandbox.render(f"Question {loop}", [], [{}])
+    assert isinstance(error, RenderTimeoutError)
+    assert time.perf_counter() - start_time < 0.1
+    # Other templates still render
+    assert sandbox.render("Question <<1 + 1>>", [], [{}]) == ["Question 2"]
@@ -19,6 +19,7 @@ from questions.views import (
     AuthorisedUsersView,
     ConceptInfoView,
     CurrentConceptView,
+    PerformanceStatsView,
     QuestionBatchView,
     QuestionResponseView,
     QuestionTemplateView,
@@ -33,6 +34,7 @@ urlpatterns = [
     path("api/v0/current_concept", CurrentConceptView.as_view(), name="next_concept"),
     path("api/v0/question_batch", QuestionBatchView.as_view(), name="question_batch"),
     path("api/v0/questions", QuestionView.as_view(), name="questions"),
+    path("api/v0/performance_stats", PerformanceStatsView.as_view(), name="performance_stats"),
     path("api/v0/question_response", QuestionResponseView.as_view(), name="question_responses"),
     path("api/v0/question_template", QuestionTemplateView.as_view(), name="question_template"),
     path(
@@ -2,6 +2,7 @@ from .auth import AuthorisedUsersView
 from .concept_info import ConceptInfoView
 from .current_concept import CurrentConceptView
 from .onboarding import UserOnboardingView
+from .performance_stats import PerformanceStatsView
 from .question import QuestionView
 from .question_batch import QuestionBatchView
 from .question_response import QuestionResponseView
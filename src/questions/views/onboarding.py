@@ -8,7 +8,7 @@ from rest_framework.views import APIView
 from accounts.models import User
 from knowledge_maps.models import Concept, KnowledgeMapModel
 from learned.models import LearnedModel
-from questions.inference import GaussianParams
+from questions.gaussian_params import GaussianParams
 from questions.models.inferred_knowledge_state import InferredKnowledgeState
 
 LEVEL_TO_KNOWLEDGE_STATE = {
@@ -0,0 +1,36 @@
+from rest_framework import status
+from rest_framework.request import Request
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from learney_web.settings import QUESTION_POOL_URL
+from questions.batch_plan import BATCH_PLAN_STATS
+from questions.inference import NUTS_COMPILE_CACHE_STATS, NUTS_WARM_START_STATS
+from questions.posterior_lookup import POSTERIOR_LOOKUP
+from questions.question_pool import get_question_pool, question_pool_stats
+from questions.template_catalog import TEMPLATE_CATALOG_STATS
+from questions.template_sandbox import template_sandbox_stats
+from questions.views.question_response import SPECULATION_STATS
+
+
+class PerformanceStatsView(APIView):
+    def get(self, request: Request, format=None) -> Response:
+        """Performance counters for the process serving this request."""
+        return Response(
+            {
+                "nuts_compile_cache": NUTS_COMPILE_CACHE_STATS,
+                "nuts_warm_starts": NUTS_WARM_START_STATS,
+                "posterior_lookup": {**POSTERIOR_LOOKUP.stats, "size": len(POSTERIOR_LOOKUP)},
+                "template_catalog": TEMPLATE_CATALOG_STATS,
+                "speculation": SPECULATION_STATS,
+                "batch_plans": BATCH_PLAN_STATS,
+                "template_sandbox": template_sandbox_stats(),
+                # Shared by all processes using the pool
+                "question_pool": (
+                    question_pool_stats(get_question_pool(QUESTION_POOL_URL))
+                    if QUESTION_POOL_URL is not None
+                    else None
+                ),
+            },
+            status=status.HTTP_200_OK,
+        )
@@ -4,13 +4,15 @@ from rest_framework.request import Request
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from learney_web.settings import IS_PROD, mixpanel
+from learney_web.settings import BATCH_PLANNING, IS_PROD, mixpanel
+from questions.batch_plan import start_batch_planning
 from questions.models import QuestionResponse
 from questions.models.inferred_knowledge_state import InferredKnowledgeState
 from questions.models.question_batch import QuestionBatch
 from questions.question_batch_cache_manager import QuestionBatchCacheManager
 from questions.question_selection import select_questions
 from questions.utils import get_today
+from questions.views.question_response import start_speculation
 
 # from silk.profiling.profiler import silk_profile
 
@@ -95,6 +97,10 @@ class QuestionBatchView(APIView):
                 .exclude(response=None)
                 .count(),
             )
+        if BATCH_PLANNING:
+            # Prerequisites' templates are included if the selection above included them. Answers
+            #  are served by live selection until the plan is cached
+            start_batch_planning(qb_cache_manager.question_batch_id, ks)
 
         print(
             f"Knowledge state: ({round(ks.knowledge_state.mean, 2)}, {round(ks.knowledge_state.std_dev, 2)}),\t"
@@ -109,4 +115,5 @@ class QuestionBatchView(APIView):
             for q in question_batch_json["questions"]
             if answers_dict.get(str(q["id"]))
         ]
+        start_speculation(qb_cache_manager.question_batch_id)
         return Response(question_batch_json, status=status.HTTP_200_OK)
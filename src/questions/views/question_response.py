@@ -1,6 +1,9 @@
+import threading
 import time
+import warnings
+from dataclasses import dataclass
 from datetime import datetime
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 
 import numpy as np
 import pytz
@@ -11,15 +14,41 @@ from rest_framework.response import Response
 from rest_framework.views import APIView
 
 from accounts.models import User
-from learney_web.settings import IS_PROD, mixpanel
-from questions.inference import GaussianParams, MCMCInference
+from learney_web.settings import (
+    BATCH_PLANNING,
+    INFERENCE_ENGINE,
+    INFERENCE_SERVICE_TIMEOUT,
+    INFERENCE_SERVICE_URL,
+    IS_PROD,
+    SPECULATIVE_SELECTION,
+    mixpanel,
+)
+from questions.batch_plan import BATCH_PLAN_STATS, get_batch_plan, select_planned_question
+from questions.inference import (
+    GaussianParams,
+    Posterior,
+    get_inference_engine,
+    uses_nuts,
+)
+from questions.inference_service import (
+    InferenceJobError,
+    InferenceTimeoutError,
+    get_inference_queue,
+    submit_inference,
+)
 from questions.models import QuestionResponse
 from questions.models.inferred_knowledge_state import InferredKnowledgeState
+from questions.posterior_lookup import POSTERIOR_LOOKUP
 from questions.question_batch_cache_manager import QuestionBatchCacheManager
-from questions.question_selection import MCMC_MUTEX, select_questions
+from questions.question_selection import MCMC_MUTEX, save_questions_asked, select_questions
 
 # from silk.profiling.profiler import silk_profile
 
+SPECULATION_TIMEOUT = 1200
+# Answers served from a speculative branch, answers with no branch computed in time and branches
+#  thrown away because the question batch changed after they were computed
+SPECULATION_STATS = {"hits": 0, "misses": 0, "conflicts": 0}
+
 
 class QuestionResponseView(APIView):
     # @silk_profile(name="Question Response - Infer Knowledge and Select new Question")
@@ -63,9 +92,16 @@ class QuestionResponseView(APIView):
                 },
             )
 
-        # If there are multiple processes running numpyro, it errors. So we use this mutex to prevent that.
-        while cache.get(MCMC_MUTEX) is not None:
-            # The second mutex checks the process holding the first mutex is related to the same user.
+        # If there are multiple processes running numpyro, it errors. So we use this mutex to prevent
+        #  that when NUTS runs in the web processes. Separate inference workers & quadrature don't
+        #  need it.
+        mutexes = (
+            [MCMC_MUTEX, f"{MCMC_MUTEX}_{user_id}"]
+            if nuts_runs_in_web_process()
+            else [f"{MCMC_MUTEX}_{user_id}"]
+        )
+        while cache.get(mutexes[0]) is not None:
+            # The user's mutex checks the process holding the first mutex is related to the same user.
             if cache.get(f"{MCMC_MUTEX}_{user_id}") is not None:
                 # If it is, we increment this counter of the number of questions to select and
                 print("Peace out!")
@@ -76,43 +112,108 @@ class QuestionResponseView(APIView):
                 )
             else:
                 time.sleep(0.25)
-        cache.set_many({MCMC_MUTEX: True, f"{MCMC_MUTEX}_{user_id}": 1}, timeout=30)
-        # Infer new knowledge state
-        mcmc = MCMCInference(qb_cache_manager.q_batch.initial_knowledge_state)
-        print(f"difficulties={difficulties}\nguess_probs={guess_probs}\ncorrect={correct}")
-        mcmc.run_mcmc_inference(difficulties=difficulties, guess_probs=guess_probs, answers=correct)
-        new_theta = mcmc.inferred_theta_params
-        new_ks = GaussianParams(mean=new_theta.mean, std_dev=new_theta.std_dev)
-
-        # Update InferredKnowledgeState in the DB
-        ks_model = InferredKnowledgeState.get(user_id=user_id, concept_id=concept_id)
-        print(
-            f"Previous knowledge state: ({round(ks_model.mean, 2)}, {round(ks_model.std_dev, 2)})"
-        )
-        print(f"New knowledge state: ({round(new_theta.mean, 2)}, {round(new_theta.std_dev, 2)})")
-        ks_model.mean = new_theta.mean
-        ks_model.std_dev = new_theta.std_dev
-        ks_model.highest_level_achieved = max(ks_model.highest_level_achieved, new_ks.level)
-        ks_model.save()
-
-        # Below cache get re-run because it may have been updated by another process!
-        num_left_to_ask = qb_cache_manager.max_num_questions - len(
-            qb_cache_manager.q_batch_json["answers_given"]
-        )
-        # Pick new questions to ask
-        if num_left_to_ask > 0:
-            next_questions = select_questions(
-                q_batch_cache_manager=qb_cache_manager,
-                user=qb_cache_manager.user,
-                session_id=request.data["session_id"],
-                mcmc=mcmc,
-                number_to_select=None if num_left_to_ask > 1 else 1,
+        cache.set_many({mutex: 1 for mutex in mutexes}, timeout=30)
+        try:
+            # Infer new knowledge state - unless it was inferred while the question was being answered
+            print(f"difficulties={difficulties}\nguess_probs={guess_probs}\ncorrect={correct}")
+            branch = (
+                take_speculative_branch(qb_cache_manager, question_response_id, bool(correct[-1]))
+                if speculation_enabled()
+                else None
             )
-        else:
-            next_questions = []
+            plan = get_batch_plan(question_batch_id) if BATCH_PLANNING and branch is None else None
+            plan_node = (
+                plan.find_node(difficulties, guess_probs, correct) if plan is not None else None
+            )
+            if plan is not None:
+                BATCH_PLAN_STATS["hits" if plan_node is not None else "misses"] += 1
+            if branch is not None:
+                mcmc = branch.posterior
+                store_posterior(qb_cache_manager, mcmc)
+            elif plan_node is not None:
+                mcmc = plan.posterior(plan_node)
+            else:
+                mcmc = infer_knowledge_state(qb_cache_manager, difficulties, guess_probs, correct)
+            if IS_PROD and mcmc.diagnostics is not None:
+                mixpanel.track(
+                    user_id,
+                    "Knowledge State Inferred",
+                    {
+                        "concept_id": concept_id,
+                        "Question Batch ID": question_batch_id,
+                        "Inference Engine": INFERENCE_ENGINE,
+                        "Warmup Steps": mcmc.diagnostics.num_warmup_steps,
+                        "Samples": mcmc.diagnostics.num_samples,
+                        "Effective Sample Size": mcmc.diagnostics.effective_sample_size,
+                        "R-hat": mcmc.diagnostics.r_hat,
+                        "Divergences": mcmc.diagnostics.num_divergences,
+                        "Wall Time (s)": mcmc.diagnostics.wall_time_secs,
+                    },
+                )
+            new_theta = mcmc.inferred_theta_params
+            new_ks = GaussianParams(mean=new_theta.mean, std_dev=new_theta.std_dev)
+
+            # Update InferredKnowledgeState in the DB
+            ks_model = InferredKnowledgeState.get(user_id=user_id, concept_id=concept_id)
+            print(
+                f"Previous knowledge state: ({round(ks_model.mean, 2)}, {round(ks_model.std_dev, 2)})"
+            )
+            print(
+                f"New knowledge state: ({round(new_theta.mean, 2)}, {round(new_theta.std_dev, 2)})"
+            )
+            ks_model.mean = new_theta.mean
+            ks_model.std_dev = new_theta.std_dev
+            ks_model.highest_level_achieved = max(ks_model.highest_level_achieved, new_ks.level)
+            ks_model.save()
 
-        # Release mutex
-        cache.delete_many([MCMC_MUTEX, f"{MCMC_MUTEX}_{user_id}"])
+            # Below cache get re-run because it may have been updated by another process!
+            num_left_to_ask = qb_cache_manager.max_num_questions - len(
+                qb_cache_manager.q_batch_json["answers_given"]
+            )
+            # Pick new questions to ask
+            if num_left_to_ask > 0 and branch is not None and branch.next_questions:
+                next_questions = save_speculative_questions(
+                    qb_cache_manager, branch, request.data["session_id"]
+                )
+                # More questions are needed if more answers arrived while the mutex was held
+                num_more_to_select = (cache.get(f"{MCMC_MUTEX}_{user_id}") or 1) - len(
+                    next_questions
+                )
+                if num_left_to_ask > 1 and num_more_to_select > 0:
+                    next_questions += select_questions(
+                        q_batch_cache_manager=qb_cache_manager,
+                        user=qb_cache_manager.user,
+                        session_id=request.data["session_id"],
+                        mcmc=mcmc,
+                        number_to_select=num_more_to_select,
+                    )
+            elif num_left_to_ask > 0:
+                # The plan is for one question per answer
+                next_questions = (
+                    select_planned_question(
+                        qb_cache_manager,
+                        plan,
+                        plan_node,
+                        ks_model,
+                        request.data["session_id"],
+                        mcmc,
+                    )
+                    if plan_node is not None and (cache.get(f"{MCMC_MUTEX}_{user_id}") or 1) == 1
+                    else []
+                )
+                if not next_questions:
+                    next_questions = select_questions(
+                        q_batch_cache_manager=qb_cache_manager,
+                        user=qb_cache_manager.user,
+                        session_id=request.data["session_id"],
+                        mcmc=mcmc,
+                        number_to_select=None if num_left_to_ask > 1 else 1,
+                    )
+            else:
+                next_questions = []
+        finally:
+            # Release mutex
+            cache.delete_many(mutexes)
 
         # Is the question_batch completed?
         concept_completed = new_ks.level > qb_cache_manager.q_batch.concept.max_difficulty_level
@@ -170,6 +271,8 @@ class QuestionResponseView(APIView):
                         ),
                     },
                 )
+        else:
+            start_speculation(question_batch_id)
 
         return Response(
             {
@@ -195,3 +298,227 @@ def get_training_data(q_batch_json: Dict[str, Any]) -> Tuple[np.ndarray, np.ndar
     guess_probs = [1 / len(q["answers_order_randomised"]) for q in questions]
     correct = [q["correct_answer"] == responses[str(q["id"])] for q in questions]
     return np.array(difficulties), np.array(guess_probs), np.array(correct)
+
+
+def infer_knowledge_state(
+    qb_cache_manager: QuestionBatchCacheManager,
+    difficulties: np.ndarray,
+    guess_probs: np.ndarray,
+    correct: np.ndarray,
+    store: bool = True,
+) -> Posterior:
+    """Infers the knowledge state from all the answers given in the question batch.
+
+    If the inference engine supports sequential updates, only the newest answer is folded into the
+    posterior stored after the previous answer. So each answer costs the same, however far into the
+    batch it is.
+
+    Otherwise, the posterior is looked up in the memo of posteriors for the same answers. If it's
+    not there, inference is run (by an inference worker, if an inference service is set up) and
+    the result is memoized, unless the inference service timed out or failed and quadrature was run
+    instead.
+    The engine is warm-started from the adaptation state stored after the previous answer.
+
+    If `store` is False, the posterior and adaptation state aren't stored for the next answer (e.g.
+    when the answers are speculative).
+    """
+    engine = get_inference_engine(INFERENCE_ENGINE)
+    prior = qb_cache_manager.q_batch.initial_knowledge_state
+    if engine.supports_sequential_updates:
+        posterior = qb_cache_manager.posterior
+        # If the stored posterior is missing or out of sync with the answers, start from the prior
+        if isinstance(posterior, engine) and posterior.num_observations == len(correct) - 1:
+            posterior.run_mcmc_inference(
+                difficulties=difficulties[-1:], guess_probs=guess_probs[-1:], answers=correct[-1:]
+            )
+        else:
+            posterior = engine(prior)
+            posterior.run_mcmc_inference(
+                difficulties=difficulties, guess_probs=guess_probs, answers=correct
+            )
+        if store:
+            qb_cache_manager.set_posterior(posterior)
+        return posterior
+
+    lookup_key = POSTERIOR_LOOKUP.key(INFERENCE_ENGINE, prior, difficulties, guess_probs, correct)
+    posterior = POSTERIOR_LOOKUP.get(lookup_key)
+    if posterior is None:
+        posterior, engine_name = run_inference(
+            qb_cache_manager, prior, difficulties, guess_probs, correct, store
+        )
+        if engine_name == INFERENCE_ENGINE:
+            POSTERIOR_LOOKUP.put(lookup_key, posterior)
+    return posterior
+
+
+def run_inference(
+    qb_cache_manager: QuestionBatchCacheManager,
+    prior: GaussianParams,
+    difficulties: np.ndarray,
+    guess_probs: np.ndarray,
+    correct: np.ndarray,
+    store: bool = True,
+) -> Tuple[Posterior, str]:
+    """Runs inference with the engine set, in an inference worker if an inference service is set
+    up and otherwise in this process. If `store` is False, the adaptation state isn't stored.
+
+    Returns: the posterior and the name of the engine which inferred it - quadrature if the
+        inference service timed out or failed
+    """
+    engine_name = INFERENCE_ENGINE
+    adaptation_state = qb_cache_manager.adaptation_state
+    if INFERENCE_SERVICE_URL is not None:
+        try:
+            posterior = submit_inference(
+                get_inference_queue(INFERENCE_SERVICE_URL),
+                INFERENCE_ENGINE,
+                prior,
+                difficulties,
+                guess_probs,
+                correct,
+                timeout=INFERENCE_SERVICE_TIMEOUT,
+                adaptation_state=adaptation_state,
+            )
+            if store:
+                qb_cache_manager.set_adaptation_state(posterior.adaptation_state)
+            return posterior, engine_name
+        except (InferenceTimeoutError, InferenceJobError) as e:
+            # Quadrature is quick and doesn't use numpyro, so is safe to run in this process
+            warnings.warn(f"{e} Falling back to quadrature inference in the web process.")
+            engine_name = "quadrature"
+    posterior = get_inference_engine(engine_name)(prior)
+    posterior.import_adaptation_state(adaptation_state)
+    posterior.run_mcmc_inference(
+        difficulties=difficulties, guess_probs=guess_probs, answers=correct
+    )
+    if store:
+        qb_cache_manager.set_adaptation_state(posterior.adaptation_state)
+    return posterior, engine_name
+
+
+def store_posterior(
+    qb_cache_manager: QuestionBatchCacheManager, posterior: Posterior
+) -> None:
+    """Stores a posterior inferred without storing it (see `infer_knowledge_state()`)."""
+    if get_inference_engine(INFERENCE_ENGINE).supports_sequential_updates:
+        qb_cache_manager.set_posterior(posterior)
+    qb_cache_manager.set_adaptation_state(posterior.adaptation_state)
+
+
+@dataclass
+class SpeculativeBranch:
+    """The posterior and next questions after one of the possible answers to the question
+    awaiting an answer, computed while the learner reads the question."""
+
+    # Number of questions in the question batch when the branch was computed
+    num_questions: int
+    posterior: Posterior
+    # Not yet saved in the DB or added to the question batch
+    next_questions: List[Dict[str, Any]]
+
+
+def speculation_key(question_response_id: Any, correct: bool) -> str:
+    return f"speculation:{question_response_id}:{int(correct)}"
+
+
+def nuts_runs_in_web_process() -> bool:
+    """Whether NUTS runs in the web processes - in requests if there's no inference service, or in
+    each process's worker thread if it's "local"."""
+    return uses_nuts(INFERENCE_ENGINE) and INFERENCE_SERVICE_URL in (None, "local")
+
+
+def speculation_enabled() -> bool:
+    """Speculation runs NUTS in a background thread, so only if it isn't run in this process by
+    requests too."""
+    return SPECULATIVE_SELECTION and not nuts_runs_in_web_process()
+
+
+def start_speculation(question_batch_id: Any) -> None:
+    if speculation_enabled():
+        threading.Thread(
+            target=speculate_next_questions, args=(question_batch_id,), daemon=True
+        ).start()
+
+
+def speculate_next_questions(question_batch_id: Any) -> None:
+    """For the question awaiting an answer, infers the posterior and selects the next question
+    after both a correct and an incorrect answer, and caches both branches."""
+    try:
+        qb_cache_manager = QuestionBatchCacheManager(question_batch_id)
+        q_batch_json = qb_cache_manager.q_batch_json
+        num_answers = len(q_batch_json["answers_given"])
+        questions = q_batch_json["questions"]
+        if num_answers >= len(questions):
+            return
+        question = questions[num_answers]
+        difficulties, guess_probs, correct = get_training_data(q_batch_json)
+        for answer_correct in [True, False]:
+            posterior = infer_knowledge_state(
+                qb_cache_manager,
+                np.append(difficulties, question["difficulty"]),
+                np.append(guess_probs, 1 / len(question["answers_order_randomised"])),
+                np.append(correct, answer_correct),
+                store=False,
+            )
+            next_questions = (
+                select_questions(
+                    q_batch_cache_manager=qb_cache_manager,
+                    user=qb_cache_manager.user,
+                    session_id="",
+                    mcmc=posterior,
+                    save_question_to_db=False,
+                    number_to_select=1,
+                    add_to_batch=False,
+                )
+                if num_answers + 1 < qb_cache_manager.max_num_questions
+                else []
+            )
+            cache.set(
+                speculation_key(question["id"], answer_correct),
+                SpeculativeBranch(len(questions), posterior, next_questions),
+                timeout=SPECULATION_TIMEOUT,
+            )
+    except Exception as e:
+        warnings.warn(f"Speculation failed for question batch {question_batch_id}. Error: {e}")
+
+
+def take_speculative_branch(
+    qb_cache_manager: QuestionBatchCacheManager, question_response_id: Any, correct: bool
+) -> Optional[SpeculativeBranch]:
+    """Takes the branch computed for this answer, if one was computed and the question batch
+    hasn't changed since (apart from this answer)."""
+    branch = cache.get(speculation_key(question_response_id, correct))
+    cache.delete_many([speculation_key(question_response_id, outcome) for outcome in [True, False]])
+    if branch is None:
+        SPECULATION_STATS["misses"] += 1
+        return None
+    q_batch_json = qb_cache_manager.q_batch_json
+    if branch.num_questions != len(q_batch_json["questions"]) or (
+        branch.posterior.num_observations != len(q_batch_json["answers_given"])
+    ):
+        SPECULATION_STATS["conflicts"] += 1
+        return None
+    SPECULATION_STATS["hits"] += 1
+    return branch
+
+
+def save_speculative_questions(
+    qb_cache_manager: QuestionBatchCacheManager, branch: SpeculativeBranch, session_id: str
+) -> List[Dict[str, Any]]:
+    """Saves the branch's next questions in the DB and adds them to the question batch."""
+    next_questions = branch.next_questions
+    predicted_probs_correct = branch.posterior.calculate_correct_probs(
+        difficulties=np.array([question["difficulty"] for question in next_questions]),
+        guess_probs=np.array(
+            [1 / len(question["answers_order_randomised"]) for question in next_questions]
+        ),
+    )
+    save_questions_asked(
+        qb_cache_manager,
+        qb_cache_manager.user,
+        session_id,
+        next_questions,
+        list(predicted_probs_correct),
+    )
+    qb_cache_manager.add_questions_asked(next_questions)
+    return next_questions
@@ -12,6 +12,10 @@ from questions.template_parser import ParsingError
 class QuestionTemplateView(APIView):
     def get(self, request: Request, format=None) -> Response:
         template_data = QuestionTemplate.objects.values().get(id=request.GET["template_id"])
+        # The results of checking its parameter combinations aren't edited (and the bitmap isn't
+        #  JSON serializable)
+        for field in QuestionTemplate.PARAM_CHECK_FIELDS:
+            template_data.pop(field)
         return Response(template_data, status=status.HTTP_200_OK)
 
     def post(self, request: Request, format=None) -> Response:
@@ -8,7 +8,7 @@ import boto3
 from accounts.models import User
 from botocore.exceptions import ClientError
 from learney_web.settings import AWS_CREDENTIALS, IS_PROD, mixpanel
-from questions.models import QuestionResponse, QuestionTemplate
+from questions.models import QuestionTemplate
 
 CHARSET = "UTF-8"
 
@@ -26,7 +26,6 @@ class ReportBrokenQuestionView(APIView):
     def post(self, request: Request, format=None) -> Response:
         question = request.data["question"]
         template_id = request.data["question"]["template_id"]
-        response_id = request.data["question"]["id"]
 
         user = User.objects.get(id=request.data["user_id"])
         question_template = QuestionTemplate.objects.prefetch_related("concept").get(id=template_id)
@@ -34,14 +33,11 @@ class ReportBrokenQuestionView(APIView):
 
         # Deactivate question template!
         question_template.active = False
-        question_template.save()
+        question_template.save(update_fields=["active"])
 
-        # Other views store novelty terms and the active question templates to pick from in cache,
-        # so we need to invalidate these
+        # Other views store the active question templates to pick from in cache, so we need to
+        # invalidate these
         cache.delete(f"template_options_{question_template.concept.cytoscape_id}")
-        cache.delete(
-            f"novelty_terms_{QuestionResponse.objects.get(id=response_id).question_batch.id}"
-        )
 
         subject = f"'{question_template}' broken on '{concept_name}'"
 